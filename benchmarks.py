@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from fynesse import benchmark
+
+# Run the offline benchmark suite against a local benchmark database, record the results against the current commit and compare them with the previous commit.
+parser = argparse.ArgumentParser(description="fynesse benchmarks")
+parser.add_argument("--user", default="root")
+parser.add_argument("--password", default="")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=3306)
+parser.add_argument("--database", default="property_prices_benchmark")
+parser.add_argument("--duckdb", metavar="PATH", help="run against an embedded DuckDB database file instead of a server")
+parser.add_argument("--transactions", type=int, default=100000)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--no-load", action="store_true")
+parser.add_argument("--results", default="benchmark_results.jsonl")
+parser.add_argument("--imports-only", action="store_true", help="only check import times against their budgets, without a database")
+args = parser.parse_args()
+
+# Import times are guarded on every run, and fail it when over budget
+import_results, exceeded = benchmark.benchmark_import()
+for message in exceeded:
+    print(message)
+if args.imports_only:
+    print(import_results)
+    sys.exit(1 if len(exceeded) > 0 else 0)
+
+if args.duckdb:
+    conn = benchmark.connect_benchmark_duckdb(args.duckdb)
+else:
+    conn = benchmark.connect_benchmark_database(args.user, args.password, args.host, args.port, args.database)
+results = benchmark.run(conn, transactions=args.transactions, seed=args.seed, load=not args.no_load)
+results.update(import_results)
+benchmark.record(results, args.results)
+try:
+    benchmark.compare(args.results)
+except ValueError as e:
+    print(e)
+sys.exit(1 if len(exceeded) > 0 else 0)
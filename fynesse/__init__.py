@@ -1,3 +1,16 @@
-from . import access
-from . import assess
-from . import address
+import importlib
+
+# Submodules are imported when first used, so importing fynesse to use one
+# of them does not pay for the dependencies of the others
+__all__ = ["access", "assess", "address"]
+submodules = __all__ + ["benchmark", "config", "lazy", "tracing"]
+
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(submodules))
@@ -1,17 +1,146 @@
 from .config import *
+from . import tracing
 
+import collections
+import hashlib
+import itertools
+import os
 import pymysql
+import pymysql.cursors
+import re
+import urllib.error
 import urllib.request
+import weakref
 from os.path import exists
-import geopandas as gpd
-import pandas as pd
-import osmnx as ox
+from .lazy import lazy_module
 import numpy as np
 
+gpd = lazy_module("geopandas")
+pd = lazy_module("pandas")
+ox = lazy_module("osmnx")
+
 # This file accesses the data
 
 """Place commands in this file to access the data electronically. Don't remove any missing values, or deal with outliers. Make sure you have legalities correct, both intellectual property and personal data privacy rights. Beyond the legal side also think about the ethical issues around this data. """
 
+# ==== Database backends ====
+
+"""
+Queries are written for MariaDB. A DuckDB connection can be used in place of a pymysql connection to run the same workloads on an embedded columnar engine without a database server: each query is translated by the rewrites below, MySQL functions DuckDB lacks are defined as macros by connect_duckdb, and the few statements with no equivalent (LOAD DATA, AUTO_INCREMENT, RENAME TABLE, SHOW) are handled by backend-specific code.
+"""
+duckdb_rewrites = [
+    (r"`", '"'),
+    (r"\s+COLLATE[ =]+utf8_bin", ""),
+    (r"\s*DEFAULT CHARSET=utf8", ""),
+    (r"\s*AUTO_INCREMENT=1", ""),
+    (r"\bbigint\(\d+\) unsigned", "UBIGINT"),
+    (r"\bint(\(\d+\))? unsigned", "UINTEGER"),
+    (r"\btinytext\b", "VARCHAR"),
+    (r"\benum\([^)]*\)", "VARCHAR"),
+    (r"\s+USING HASH", ""),
+    (r"\bstddev\(", "stddev_pop("),
+    (r"\bINSERT IGNORE INTO\b", "INSERT OR IGNORE INTO"),
+    (r"^(\s*)REPLACE INTO\b", r"\1INSERT OR REPLACE INTO"),
+]
+
+duckdb_macros = [
+    # A deterministic value in [0, 1) for each seed, like MariaDB's RAND(seed)
+    "CREATE OR REPLACE MACRO rand(seed) AS (hash(seed) % 1000000007) / 1000000007.0",
+    "CREATE OR REPLACE MACRO crc32(value) AS hash(value) % 4294967296",
+    "CREATE OR REPLACE MACRO database() AS current_schema()",
+]
+
+
+def is_duckdb(conn):
+    """
+    :param conn: database connection
+    :return whether conn is a DuckDB connection rather than a pymysql one
+    """
+    return type(conn).__module__.lstrip("_").startswith("duckdb")
+
+
+def connect_duckdb(path=":memory:"):
+    """
+    Create a connection to an embedded DuckDB database, usable in place of a MariaDB connection
+    :param path: the database file, or ":memory:"
+    :return Connection object
+    """
+    import duckdb
+    conn = duckdb.connect(path)
+    for macro in duckdb_macros:
+        conn.execute(macro)
+    return conn
+
+
+def translate(conn, query, parameterised=False):
+    """
+    Translate a query written for MariaDB to the dialect of a connection
+    :param conn: database connection
+    :param query: the query
+    :param parameterised: whether %s placeholders should be translated
+    :return the query to execute
+    """
+    if not is_duckdb(conn):
+        return query
+    for pattern, replacement in duckdb_rewrites:
+        query = re.sub(pattern, replacement, query, flags=re.IGNORECASE | re.MULTILINE)
+    if parameterised:
+        query = query.replace("%s", "?")
+    return query
+
+
+def hash64_sql(conn, expression):
+    """
+    :param conn: database connection
+    :param expression: an SQL string expression
+    :return an SQL expression for a 64 bit unsigned hash of the expression's value
+    """
+    if is_duckdb(conn):
+        return f"hash({expression})"
+    return f"CAST(CONV(LEFT(MD5({expression}), 16), 16, 10) AS UNSIGNED)"
+
+
+def table_exists(conn, table):
+    """
+    :param conn: database connection
+    :param table: the table name
+    :return whether the table exists in the current database
+    """
+    return execute(conn, f"SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = '{table}'")[0][0] > 0
+
+
+def table_columns(conn, table):
+    """
+    :param conn: database connection
+    :param table: the table name
+    :return a list of the table's column names in order
+    """
+    return [row[0] for row in execute(conn, f"SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = '{table}' ORDER BY ordinal_position")]
+
+
+def create_autoincrement_table(conn, table, create):
+    """
+    Replace a table by one whose db_id column is an autoincrementing primary key
+    :param conn: database connection
+    :param table: the table name
+    :param create: a CREATE TABLE statement for the table with a `db_id` bigint(20) unsigned NOT NULL column
+    """
+    if is_duckdb(conn):
+        return execute(
+            conn,
+            f"DROP TABLE IF EXISTS `{table}`",
+            f"DROP SEQUENCE IF EXISTS `{table}_db_id`",
+            f"CREATE SEQUENCE `{table}_db_id`",
+            create.replace(
+                "`db_id` bigint(20) unsigned NOT NULL",
+                f"`db_id` bigint(20) unsigned NOT NULL DEFAULT nextval('{table}_db_id') PRIMARY KEY"))
+    return execute(
+        conn,
+        f"DROP TABLE IF EXISTS `{table}`",
+        create,
+        f"ALTER TABLE `{table}` ADD PRIMARY KEY (`db_id`), MODIFY `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,AUTO_INCREMENT=1")
+
+
 # ==== Database setup and access ====
 
 
@@ -25,14 +154,154 @@ def execute(conn, *queries, output_queries=False):
     """
     cur = conn.cursor()
     for query in queries:
+        query = translate(conn, query)
         if output_queries:
             print(query)
-        cur.execute(query)
+        with tracing.span("sql", sql=query) as span:
+            cur.execute(query)
+            span.set(rows=cur.rowcount)
+    if is_duckdb(conn):
+        # DuckDB cursors run in autocommit mode and cannot be fetched from
+        # once closed
+        results = cur.fetchall()
+        cur.close()
+        return results
     cur.close()
     conn.commit()
     return cur.fetchall()
 
 
+def execute_many(conn, query, rows, output_queries=False):
+    """
+    Execute a parameterised query once for each row of parameters before committing
+    :param conn: database connection
+    :param query: the query, with %s placeholders
+    :param rows: a sequence of parameter tuples
+    :param output_queries: whether the query should be printed before it is executed
+    """
+    execute_atomically(conn, [(query, rows)], output_queries=output_queries)
+
+
+def execute_atomically(conn, statements, output_queries=False):
+    """
+    Execute statements in a single transaction
+    :param conn: database connection
+    :param statements: a sequence of (query, rows) tuples, where rows is None for a plain query or a sequence of parameter tuples for a query with %s placeholders
+    :param output_queries: whether each query should be printed before it is executed
+    """
+    cur = conn.cursor()
+    if is_duckdb(conn):
+        cur.execute("BEGIN TRANSACTION")
+    for query, rows in statements:
+        query = translate(conn, query, parameterised=rows is not None)
+        if output_queries:
+            print(query)
+        if rows is None:
+            with tracing.span("sql", sql=query) as span:
+                cur.execute(query)
+                span.set(rows=cur.rowcount)
+        elif len(rows) > 0:
+            with tracing.span("sql", sql=query, executions=len(rows)) as span:
+                cur.executemany(query, rows)
+                span.set(rows=cur.rowcount)
+    if is_duckdb(conn):
+        cur.execute("COMMIT")
+        cur.close()
+    else:
+        cur.close()
+        conn.commit()
+
+
+# ===== Prepared statements =====
+
+"""
+Queries whose values are passed as %s parameters rather than interpolated have the same text, or shape, on every call. On MariaDB each shape is prepared once per connection with PREPARE and run with EXECUTE ... USING, so repeated calls such as the probes of address.grow_bounding_box skip parsing and planning. Identifiers cannot be parameters, so they are validated instead.
+"""
+prepared_statements = weakref.WeakKeyDictionary()
+statement_ids = itertools.count()
+max_prepared_statements = 256
+
+
+def identifier(name):
+    """
+    Quote a table or column name for use in a query, rejecting anything that is not a plain identifier
+    :param name: the name
+    :return the backticked name
+    """
+    if not isinstance(name, str) or re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) is None:
+        raise ValueError(f"{name!r} is not a valid identifier")
+    return f"`{name}`"
+
+
+def query_shape(query):
+    """
+    :param query: a parameterised query
+    :return the query with whitespace normalised, so queries built with different formatting share a prepared statement
+    """
+    return " ".join(query.split())
+
+
+def parameter(value):
+    """
+    Convert a value to a type the database driver can bind
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def execute_prepared(conn, query, params=(), output_queries=False):
+    """
+    Execute a parameterised query as a prepared statement, preparing it on the first call with its shape on the connection, before committing
+    :param conn: database connection
+    :param query: the query, with %s placeholders
+    :param params: a sequence of values for the placeholders
+    :param output_queries: whether the query and its parameters should be printed before it is executed
+    :return the result of the query
+    """
+    shape = query_shape(translate(conn, query, parameterised=is_duckdb(conn)))
+    params = [parameter(value) for value in params]
+    if output_queries:
+        print(shape, params)
+    if is_duckdb(conn):
+        # DuckDB binds parameters itself and caches nothing across calls
+        cur = conn.cursor()
+        with tracing.span("sql", sql=shape, prepared=False) as span:
+            cur.execute(shape, params)
+            results = cur.fetchall()
+            span.set(rows=len(results))
+        cur.close()
+        return results
+
+    ER_UNKNOWN_STMT_HANDLER = 1243  # FROM https://mariadb.com/kb/en/mariadb-error-codes/
+    statements = prepared_statements.setdefault(conn, collections.OrderedDict())
+    cur = conn.cursor()
+    for attempt in range(2):
+        name = statements.get(shape)
+        cached = name is not None
+        try:
+            with tracing.span("sql", sql=shape, prepared=cached) as span:
+                if not cached:
+                    if len(statements) >= max_prepared_statements:
+                        _, oldest = statements.popitem(last=False)
+                        cur.execute(f"DEALLOCATE PREPARE {oldest}")
+                    name = f"fynesse_{next(statement_ids)}"
+                    cur.execute(f"PREPARE {name} FROM %s", (shape.replace("%s", "?"),))
+                    statements[shape] = name
+                statements.move_to_end(shape)
+                # MariaDB accepts literals after USING, so a call is a single round trip
+                cur.execute(f"EXECUTE {name}" + (" USING " + ", ".join(["%s"] * len(params)) if len(params) > 0 else ""), params)
+                span.set(rows=cur.rowcount)
+            break
+        except pymysql.MySQLError as e:
+            # Statements are lost if the connection reconnects
+            if attempt > 0 or e.args[0] != ER_UNKNOWN_STMT_HANDLER:
+                raise
+            statements.clear()
+    results = cur.fetchall()
+    cur.close()
+    conn.commit()
+    return results
+
+
 def create_database_ifne(conn):
     """
     Create the property_prices database if it doesn't exist
@@ -99,9 +368,9 @@ def create_pricepaid_table(conn):
     Create the pp_data table according to the schema outlined in the notebook with an autoincrementing db_id primary key
     :param conn: database connection
     """
-    return execute(
+    return create_autoincrement_table(
         conn,
-        "DROP TABLE IF EXISTS `pp_data`",
+        "pp_data",
         """CREATE TABLE IF NOT EXISTS `pp_data` (
     `transaction_unique_identifier` tinytext COLLATE utf8_bin NOT NULL,
     `price` int(10) unsigned NOT NULL,
@@ -119,9 +388,9 @@ def create_pricepaid_table(conn):
     `county` tinytext COLLATE utf8_bin NOT NULL,
     `ppd_category_type` varchar(2) COLLATE utf8_bin NOT NULL,
     `record_status` varchar(2) COLLATE utf8_bin NOT NULL,
+    `postcode_key` bigint(20) unsigned,
     `db_id` bigint(20) unsigned NOT NULL
-    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1""",
-        "ALTER TABLE `pp_data` ADD PRIMARY KEY (`db_id`), MODIFY `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,AUTO_INCREMENT=1")
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1""")
 
 
 def load_pricepaid_data(
@@ -132,7 +401,7 @@ def load_pricepaid_data(
             2023),
         source_base="http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com"):
     """
-    Load whole-of-year HM Land Registry Price Paid Data by downloading annual datafiles unless already present and loading them into the pp_data table.
+    Load whole-of-year HM Land Registry Price Paid Data by downloading annual datafiles unless already present and loading them into the pp_data table. Rerunning skips the years already loaded and resumes interrupted downloads and loads.
     :param conn: database connection
     :param dest_dir: the directory that the datafiles will be looked for in and downloaded into if absent
     :param years: an iterable of the years to load into the database
@@ -143,10 +412,13 @@ def load_pricepaid_data(
         filename = f"pp-{year}.csv"
         source = f"{source_base}/{filename}"
         destination = f"{dest_dir}/{filename}"
-        if not exists(destination):
-            print(f"downloading {source} to {destination}")
-            urllib.request.urlretrieve(source, destination)
-        load_file(
+        # The manifest is checked before the network, so a rerun with every
+        # file present and loaded needs no connection to the source
+        if is_ingested(conn, destination):
+            print(f"{filename} already loaded into `pp_data`")
+            continue
+        download(source, destination)
+        ingest_file(
             conn,
             "pp_data",
             destination,
@@ -156,12 +428,13 @@ def load_pricepaid_data(
 
 def create_pricepaid_indicies(conn):
     """
-    Create pp_data indicies on postcode, date_of_transfer and property_type
+    Create pp_data indicies on postcode, postcode_key, date_of_transfer and property_type
     :param conn: database connection
     """
     return execute(
         conn,
         "CREATE INDEX `pp.postcode` USING HASH ON `pp_data` (postcode)",
+        "CREATE INDEX `pp.postcode_key` ON `pp_data` (postcode_key)",
         "CREATE INDEX `pp.date` USING HASH ON `pp_data` (date_of_transfer)",
         "CREATE INDEX `pp.type` USING HASH ON `pp_data` (property_type)"
     )
@@ -169,12 +442,12 @@ def create_pricepaid_indicies(conn):
 
 def create_postcode_table(conn):
     """
-    Create the postcode_data table according to the schema outlined in the notebook with an autoincrementing db_id primary key and an index on postcode
+    Create the postcode_data table according to the schema outlined in the notebook with an autoincrementing db_id primary key and indicies on postcode and postcode_key
     :param conn: database connection
     """
-    execute(
+    create_autoincrement_table(
         conn,
-        "DROP TABLE IF EXISTS `postcode_data`",
+        "postcode_data",
         """CREATE TABLE IF NOT EXISTS `postcode_data` (
     `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
     `status` enum('live','terminated') NOT NULL,
@@ -193,10 +466,104 @@ def create_postcode_table(conn):
     `postcode_sector` varchar(6) COLLATE utf8_bin NOT NULL,
     `outcode` varchar(4) COLLATE utf8_bin NOT NULL,
     `incode` varchar(3)  COLLATE utf8_bin NOT NULL,
+    `postcode_key` bigint(20) unsigned,
     `db_id` bigint(20) unsigned NOT NULL
-    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
-        "ALTER TABLE `postcode_data` ADD PRIMARY KEY (`db_id`), MODIFY `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,AUTO_INCREMENT=1",
-        "CREATE INDEX `po.postcode` USING HASH ON `postcode_data` (postcode)")
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""")
+    execute(
+        conn,
+        "CREATE INDEX `po.postcode` USING HASH ON `postcode_data` (postcode)",
+        "CREATE INDEX `po.postcode_key` ON `postcode_data` (postcode_key)")
+
+
+# ===== Postcode keys =====
+
+"""
+Postcodes are packed into integers so pp_data and postcode_data are joined by integer comparison rather than by utf8_bin string collation. A postcode is canonicalised to seven characters, its outcode padded with spaces to four followed by its three character incode (the format of postcode_fixed_width_seven), and each character is read as a base 37 digit with space below the digits and the digits below the letters. Key order is then the order of canonical postcodes, so every postcode of an area, district or sector lies in one contiguous range of keys.
+"""
+postcode_alphabet = " 0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+postcode_key_length = 7
+
+
+def postcode_key_sql(column="postcode"):
+    """
+    :param column: the SQL expression of a postcode with a single space between outcode and incode
+    :return an SQL expression for the postcode's key, NULL if the postcode is malformed
+    """
+    space = f"INSTR({column}, ' ')"
+    canonical = f"CONCAT(RPAD(SUBSTRING({column}, 1, {space} - 1), 4, ' '), SUBSTRING({column}, {space} + 1, 3))"
+    digits = " + ".join(
+        f"(NULLIF(INSTR('{postcode_alphabet}', SUBSTRING({canonical}, {i + 1}, 1)), 0) - 1) * {len(postcode_alphabet) ** (postcode_key_length - 1 - i)}"
+        for i in range(postcode_key_length))
+    return f"CASE WHEN {space} BETWEEN 3 AND 5 AND LENGTH({column}) = {space} + 3 THEN {digits} END"
+
+
+def postcode_key(postcode):
+    """
+    :param postcode: a postcode, with or without its space
+    :return the postcode's key, as computed by postcode_key_sql
+    """
+    postcode = postcode.upper().replace(" ", "")
+    canonical = postcode[:-3].ljust(4) + postcode[-3:]
+    assert len(canonical) == postcode_key_length, f"malformed postcode {postcode}"
+    return postcode_key_prefix(canonical)
+
+
+def postcode_key_prefix(prefix):
+    """
+    :return the lowest key of the postcodes whose canonical form starts with prefix
+    """
+    key = 0
+    for character in prefix:
+        key = key * len(postcode_alphabet) + postcode_alphabet.index(character)
+    return key * len(postcode_alphabet) ** (postcode_key_length - len(prefix))
+
+
+def postcode_key_range(prefix):
+    """
+    The range of keys of the postcodes in an area such as "CB", a district such as "CB2" or a sector such as "CB2 1"
+    :param prefix: the area, district or sector
+    :return a tuple of the lowest and highest possible key within it
+    """
+    prefix = prefix.upper().strip()
+    if " " in prefix:
+        outcode, incode = prefix.split()
+        ranges = [outcode.ljust(4) + incode]
+    elif prefix.isalpha():
+        # A one letter area is followed by a district digit, which excludes the
+        # two letter areas sharing its first letter
+        ranges = [prefix] if len(prefix) == 2 else [prefix + "0", prefix + "9"]
+    else:
+        ranges = [prefix.ljust(4)]
+    low = postcode_key_prefix(ranges[0])
+    high = postcode_key_prefix(ranges[-1]) + len(postcode_alphabet) ** (postcode_key_length - len(ranges[-1])) - 1
+    return low, high
+
+
+"""
+The prefix of the index names of each table
+"""
+index_prefixes = {"pp_data": "pp", "postcode_data": "po"}
+
+
+def add_postcode_key(conn, table):
+    """
+    Add and index the postcode_key column of a pp_data or postcode_data table loaded before postcode keys were computed at load time
+    :param conn: database connection
+    :param table: the table
+    """
+    # The index is named as create_pricepaid_indicies and create_postcode_table name it
+    index = f"{index_prefixes.get(table, table)}.postcode_key"
+    return execute(
+        conn,
+        f"ALTER TABLE `{table}` ADD COLUMN IF NOT EXISTS `postcode_key` bigint(20) unsigned",
+        f"UPDATE `{table}` SET postcode_key = {postcode_key_sql()}",
+        f"CREATE INDEX IF NOT EXISTS `{index}` ON `{table}` (postcode_key)")
+
+
+"""
+Columns computed from the other columns of a row as it is loaded by load_file
+"""
+load_derived_columns = {"postcode_key": postcode_key_sql()}
 
 
 def clean_postcode_data(conn, backup_table=None):
@@ -205,17 +572,23 @@ def clean_postcode_data(conn, backup_table=None):
     :param conn: database connection
     :param backup_table: None or str, if str the name of a new table postcode_data will be copied tobefore cleaning
     """
-    inclusion_criteria = "((country = 'England' OR country = 'Wales') AND longitude != 0)"
+    inclusion_criteria = "((country = %s OR country = %s) AND longitude != %s)"
+    params = ("England", "Wales", 0)
     if backup_table is None:
-        execute(
+        execute_prepared(
             conn,
-            f"DELETE FROM postcode_data WHERE NOT {inclusion_criteria}")
+            f"DELETE FROM postcode_data WHERE NOT {inclusion_criteria}", params)
     else:
-        execute(conn, f"RENAME TABLE postcode_data TO `{backup_table}`")
+        backup_table = identifier(backup_table)
+        if is_duckdb(conn):
+            # DuckDB cannot rename a table with an index, so it is copied
+            execute(conn, f"CREATE TABLE {backup_table} AS SELECT * FROM postcode_data")
+        else:
+            execute(conn, f"RENAME TABLE postcode_data TO {backup_table}")
         create_postcode_table(conn)
-        execute(
+        execute_prepared(
             conn,
-            f"INSERT INTO postcode_data SELECT * FROM `{backup_table}` WHERE {inclusion_criteria}")
+            f"INSERT INTO postcode_data SELECT * FROM {backup_table} WHERE {inclusion_criteria}", params)
 
 
 def select_top(conn, table, n):
@@ -225,10 +598,7 @@ def select_top(conn, table, n):
     :param table: the table to query
     :param n: number of rows to select
     """
-    cur = conn.cursor()
-    cur.execute(f'SELECT * FROM `{table}` LIMIT {n}')
-    rows = cur.fetchall()
-    return rows
+    return execute_prepared(conn, f"SELECT * FROM {identifier(table)} LIMIT %s", (int(n),))
 
 
 def head(conn, table, n=5):
@@ -246,85 +616,135 @@ def head(conn, table, n=5):
 def load_file(conn, table, file, display=False,
               enclosed_by_double_quote=False):
     """
-    Lode local data file into table
+    Lode local data file into table. The file's fields are the table's columns in order, except db_id and any load_derived_columns, which are computed
     :param conn: database connection
     :param table: the table to query
     :param file: the local file to load from
     """
     if display:
         print(f"Loading {file} into `{table}`")
+    all_columns = table_columns(conn, table)
+    derived = {column: expression for column, expression in load_derived_columns.items() if column in all_columns}
+    columns = [column for column in all_columns if column != "db_id" and column not in derived]
+    if is_duckdb(conn):
+        # db_id is filled from the table's sequence, as by AUTO_INCREMENT, and
+        # as with LOAD DATA only \N is read as NULL so empty fields stay empty
+        names = ", ".join(f"'{column}'" for column in columns)
+        quote = '"' if enclosed_by_double_quote else ""
+        return execute(
+            conn,
+            f"""INSERT INTO `{table}` ({", ".join(f"`{column}`" for column in columns + list(derived))})
+    SELECT *{"".join(f", {expression}" for expression in derived.values())}
+    FROM read_csv('{file}', header=false, all_varchar=true, delim=',', quote='{quote}', nullstr='\\N', names=[{names}])""")
     enclosed_specifier = "ENCLOSED BY '\"'" if enclosed_by_double_quote else ""
+    set_specifier = "SET " + ", ".join(f"`{column}` = {expression}" for column, expression in derived.items()) if len(derived) > 0 else ""
     command = (
-        f"LOAD DATA LOCAL INFILE '{file}' INTO TABLE `{table}` FIELDS TERMINATED BY ',' {enclosed_specifier} LINES STARTING BY '' TERMINATED BY '\\n'")
+        f"LOAD DATA LOCAL INFILE '{file}' INTO TABLE `{table}` FIELDS TERMINATED BY ',' {enclosed_specifier} LINES STARTING BY '' TERMINATED BY '\\n' ({', '.join(f'`{column}`' for column in columns)}) {set_specifier}")
     return execute(conn, command)
 
 
-def inner_join(
-        conn,
+join_columns = [
+    ("price", "price"),
+    ("date_of_transfer", "date_of_transfer"),
+    ("postcode", "`pp_data`.postcode"),
+    ("property_type", "property_type"),
+    ("new_build_flag", "new_build_flag"),
+    ("tenure_type", "tenure_type"),
+    ("locality", "locality"),
+    ("town_city", "town_city"),
+    ("district", "district"),
+    ("county", "county"),
+    ("country", "country"),
+    ("latitude", "lattitude"),
+    ("longitude", "longitude")]
+
+
+def bind(value, params):
+    """
+    :param value: a value to use in a query
+    :param params: None, or a list of parameters to append value to
+    :return a %s placeholder for value if params is a list, else value as an SQL literal
+    """
+    if params is None:
+        return f"'{value}'" if isinstance(value, str) else str(value)
+    params.append(value)
+    return "%s"
+
+
+def join_conditions(
         bbox=None,
         invert_bbox=False,
         date_bound=None,
-        limit=None,
         one_in=None,
-        output_query=False,
-        property_type=None):
+        property_type=None,
+        postcode_prefix=None,
+        params=None):
     """
-    Perform a join on postcode_data and pp_data on the postcode column
-    :param conn: database connection
+    Build the WHERE conditions used when joining postcode_data and pp_data
     :param bbox: bbox to constrain coordinates
     :param invert_bbox: if False, coordinates must be within bbox, if True, coordinates must be outside
     :param date_bound: a tuple of dates that date_of_transfer must be within
-    :param limit: the maximum number of rows that may be returned
     :param one_in: the reciprocal of the probability that a row is selected
-    :param output_query: whether the SQL query should be printed
     :param property_type: if not None, the specific property to select
+    :param postcode_prefix: if not None, the postcode area, district or sector to select, such as "CB", "CB2" or "CB2 1"
+    :param params: None for conditions with literal values, or a list that the values are appended to, in order, for conditions with %s placeholders
+    :return a list of SQL conditions
     """
     conditions = []
     if one_in is not None:
-        conditions.append(f"RAND(pp_data.db_id)<{1.0/one_in}")
+        conditions.append(f"RAND(pp_data.db_id)<{bind(1.0/one_in, params)}")
     if bbox is not None:
+        south, north, west, east = [bind(float(bound), params) for bound in bbox]
         if invert_bbox:
             conditions.append(
-                f"(lattitude < {bbox[0]} OR {bbox[1]} < lattitude OR longitude < {bbox[2]} OR {bbox[3]} < longitude)")
+                f"(lattitude < {south} OR {north} < lattitude OR longitude < {west} OR {east} < longitude)")
         else:
             conditions.append(
-                f"lattitude between {bbox[0]} AND {bbox[1]} AND longitude between {bbox[2]} and {bbox[3]}")
+                f"lattitude between {south} AND {north} AND longitude between {west} and {east}")
     if date_bound is not None:
         from_date, to_date = date_bound
         conditions.append(
-            f"DATE(date_of_transfer) between '{from_date}' and '{to_date}'")
+            f"DATE(date_of_transfer) between {bind(str(from_date), params)} and {bind(str(to_date), params)}")
     if property_type is not None:
-        conditions.append(f"property_type = '{property_type}'")
-    conditions = " AND ".join(conditions)
+        conditions.append(f"property_type = {bind(property_type, params)}")
+    if postcode_prefix is not None:
+        low, high = postcode_key_range(postcode_prefix)
+        conditions.append(f"`postcode_data`.postcode_key BETWEEN {bind(low, params)} AND {bind(high, params)}")
+    return conditions
 
-    query = f"""
-    SELECT price, date_of_transfer, `pp_data`.postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, lattitude, longitude
+
+def join_query(conditions, extra_columns=(), limit=None, params=None):
+    """
+    Build a query joining postcode_data and pp_data on the postcode_key column
+    :param conditions: a list of SQL conditions, as from join_conditions
+    :param extra_columns: SQL expressions to select after the join_columns
+    :param limit: the maximum number of rows that may be returned
+    :param params: None, or the list of parameters of conditions, which limit is appended to
+    """
+    columns = ", ".join([column if column == name else f"{column} AS {name}" for name, column in join_columns] + list(extra_columns))
+    conditions = " AND ".join(conditions)
+    return f"""
+    SELECT {columns}
     FROM
         `pp_data`
     INNER JOIN
         `postcode_data`
     ON
-        `pp_data`.postcode = `postcode_data`.postcode
+        `pp_data`.postcode_key = `postcode_data`.postcode_key
     {"WHERE "+conditions if len(conditions)>0 else ""}
-    {f"LIMIT {limit}" if limit != None else ""}
+    {f"LIMIT {bind(int(limit), params)}" if limit != None else ""}
+    """
+
+
+def transactions_gdf(results, extra_columns=()):
+    """
+    Convert rows selected by join_query into a GeoDataFrame of transactions
+    :param results: a sequence of rows
+    :param extra_columns: the names of any columns after the join_columns
     """
-    results = execute(conn, query, output_queries=output_query)
     gdf = gpd.GeoDataFrame(
-        results,
-        columns=[
-            "price",
-            "date_of_transfer",
-            "postcode",
-            "property_type",
-            "new_build_flag",
-            "tenure_type",
-            "locality",
-            "town_city",
-            "district",
-            "county",
-            "country",
-            "latitude",
-            "longitude"])
+        list(results),
+        columns=[name for name, _ in join_columns] + list(extra_columns))
     gdf.geometry = gpd.points_from_xy(
         gdf.longitude, gdf.latitude, crs="EPSG:4326")
 
@@ -340,6 +760,510 @@ def inner_join(
     return gdf
 
 
+def inner_join(
+        conn,
+        bbox=None,
+        invert_bbox=False,
+        date_bound=None,
+        limit=None,
+        one_in=None,
+        output_query=False,
+        property_type=None,
+        postcode_prefix=None):
+    """
+    Perform a join on postcode_data and pp_data on the postcode_key column
+    :param conn: database connection
+    :param bbox: bbox to constrain coordinates
+    :param invert_bbox: if False, coordinates must be within bbox, if True, coordinates must be outside
+    :param date_bound: a tuple of dates that date_of_transfer must be within
+    :param limit: the maximum number of rows that may be returned
+    :param one_in: the reciprocal of the probability that a row is selected
+    :param output_query: whether the SQL query should be printed
+    :param property_type: if not None, the specific property to select
+    :param postcode_prefix: if not None, the postcode area, district or sector to select, such as "CB", "CB2" or "CB2 1"
+    """
+    params = []
+    conditions = join_conditions(
+        bbox, invert_bbox, date_bound, one_in, property_type, postcode_prefix, params)
+    query = join_query(conditions, limit=limit, params=params)
+    results = execute_prepared(conn, query, params, output_queries=output_query)
+    return transactions_gdf(results)
+
+
+def count_transactions(
+        conn,
+        bbox=None,
+        date_bound=None,
+        property_type=None,
+        output_query=False,
+        postcode_prefix=None):
+    """
+    Count the rows of the join of postcode_data and pp_data without fetching them
+    :param conn: database connection
+    :param bbox: bbox to constrain coordinates
+    :param date_bound: a tuple of dates that date_of_transfer must be within
+    :param property_type: if not None, the specific property to count
+    :param output_query: whether the SQL query should be printed
+    :param postcode_prefix: if not None, the postcode area, district or sector to count
+    :return the number of rows inner_join would return
+    """
+    params = []
+    conditions = " AND ".join(join_conditions(
+        bbox=bbox, date_bound=date_bound, property_type=property_type, postcode_prefix=postcode_prefix, params=params))
+    query = f"""
+    SELECT COUNT(*)
+    FROM
+        `pp_data`
+    INNER JOIN
+        `postcode_data`
+    ON
+        `pp_data`.postcode_key = `postcode_data`.postcode_key
+    {"WHERE "+conditions if len(conditions)>0 else ""}
+    """
+    return int(execute_prepared(conn, query, params, output_queries=output_query)[0][0])
+
+
+# ===== Resumable ingestion =====
+
+"""
+The load_manifest table records each file loaded into a table with its size, modification time, checksum and row count, and the range of db_ids its rows were given. A file is marked loading before its rows are inserted and loaded after, so rerunning ingestion skips loaded files and first deletes the rows of any file left loading by a crash. Files loaded before the manifest existed are not recorded in it.
+A file whose size and modification time match its manifest row is taken to be unchanged without reading it, so a rerun only costs the unfinished work.
+Downloads are written to a .part file alongside the server's validator (its ETag, or else Last-Modified) in a .part.validator file. A resumed download sends the validator with If-Range, so a file republished since the download began is downloaded again from the start rather than spliced onto the old version.
+"""
+
+
+def create_load_manifest(conn):
+    """
+    Create the load_manifest table if it doesn't exist
+    :param conn: database connection
+    """
+    return execute(conn, """CREATE TABLE IF NOT EXISTS `load_manifest` (
+    `file` varchar(255) COLLATE utf8_bin NOT NULL PRIMARY KEY,
+    `table_name` varchar(64) COLLATE utf8_bin NOT NULL,
+    `size` bigint(20) unsigned NOT NULL,
+    `checksum` varchar(64) COLLATE utf8_bin NOT NULL,
+    `row_count` bigint(20) unsigned,
+    `state` enum('loading', 'loaded') NOT NULL,
+    `first_db_id` bigint(20) unsigned NOT NULL,
+    `last_db_id` bigint(20) unsigned,
+    `mtime` double
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+        # Manifests created before modification times were recorded
+        "ALTER TABLE `load_manifest` ADD COLUMN IF NOT EXISTS `mtime` double")
+
+
+def file_checksum(file, chunk_size=1 << 22):
+    """
+    :param file: a local file
+    :return the hex SHA-256 digest of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_size(source):
+    """
+    :param source: a URL
+    :return the size of the resource in bytes, or None if the server does not say
+    """
+    with urllib.request.urlopen(urllib.request.Request(source, method="HEAD")) as response:
+        length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def manifest_entry(conn, file):
+    """
+    :param conn: database connection
+    :param file: a local data file, recorded in the manifest by its name
+    :return the file's manifest row as a dictionary, or None if it has none
+    """
+    create_load_manifest(conn)
+    columns = ["table_name", "size", "checksum", "state", "first_db_id", "last_db_id", "mtime"]
+    rows = execute_prepared(
+        conn,
+        f"SELECT {', '.join(identifier(column) for column in columns)} FROM `load_manifest` WHERE `file` = %s",
+        (os.path.basename(file),))
+    return dict(zip(columns, rows[0])) if len(rows) > 0 else None
+
+
+def is_ingested(conn, file):
+    """
+    Whether a local file is recorded as loaded and is unchanged by its size and modification time, without reading it
+    :param conn: database connection
+    :param file: a local data file
+    """
+    if not exists(file):
+        return False
+    entry = manifest_entry(conn, file)
+    return entry is not None and entry["state"] == "loaded" and (entry["size"], entry["mtime"]) == (os.path.getsize(file), os.path.getmtime(file))
+
+
+def download(source, destination, chunk_size=1 << 20, display=True):
+    """
+    Download a file unless a complete copy is already present. The download is written to destination.part, resumed from where it stopped by a ranged request if interrupted, and renamed to destination only once complete, so destination is never partial
+    :param source: the URL to download
+    :param destination: the local file to download to
+    :param chunk_size: the number of bytes read at a time
+    :param display: whether progress should be printed
+    """
+    part = destination + ".part"
+    validator_file = part + ".validator"
+    if exists(destination) and not exists(part):
+        try:
+            size = remote_size(source)
+        except (urllib.error.URLError, OSError) as e:
+            if display:
+                print(f"keeping {destination}, as its size could not be checked: {e}")
+            return
+        if size is None or os.path.getsize(destination) == size:
+            return
+        # Left partial by a download from before downloads were resumable
+        os.remove(destination)
+    validator = None
+    if exists(part) and exists(validator_file):
+        with open(validator_file) as file:
+            validator = file.read().strip() or None
+    # A part with no validator cannot be safely resumed
+    offset = os.path.getsize(part) if validator is not None else 0
+    while True:
+        if display:
+            print(f"downloading {source} to {destination}" + (f" from byte {offset}" if offset > 0 else ""))
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset > 0 else {}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(source, headers=headers)) as response:
+                HTTP_PARTIAL_CONTENT = 206
+                if response.status == HTTP_PARTIAL_CONTENT:
+                    size = int(response.headers["Content-Range"].split("/")[-1])
+                    mode = "ab"
+                else:
+                    # The file changed since the part was downloaded, or the
+                    # server ignores ranges, so the whole file is sent
+                    length = response.headers.get("Content-Length")
+                    size = int(length) if length is not None else None
+                    mode = "wb"
+                    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                    with open(validator_file, "w") as file:
+                        file.write(validator or "")
+                with open(part, mode) as file:
+                    for block in iter(lambda: response.read(chunk_size), b""):
+                        file.write(block)
+        except urllib.error.HTTPError as e:
+            HTTP_RANGE_NOT_SATISFIABLE = 416
+            if e.code != HTTP_RANGE_NOT_SATISFIABLE:
+                raise
+            # The validator matched, so the part is at least the whole file
+            content_range = e.headers.get("Content-Range", "")
+            size = int(content_range.split("/")[-1]) if content_range.split("/")[-1].isdigit() else remote_size(source)
+        if size is not None and os.path.getsize(part) > size:
+            if display:
+                print(f"{part} is larger than {source}, restarting the download")
+            os.remove(part)
+            offset = 0
+            continue
+        break
+    if size is not None and os.path.getsize(part) != size:
+        raise IOError(f"downloaded {os.path.getsize(part)} of {size} bytes of {source}, rerun to resume")
+    os.replace(part, destination)
+    if exists(validator_file):
+        os.remove(validator_file)
+
+
+def ingest_file(conn, table, file, display=False, enclosed_by_double_quote=False):
+    """
+    Load a local data file into a table unless the manifest records it as already loaded, recording the load in the manifest. Rows of an earlier partial or outdated load of the file are deleted first
+    :param conn: database connection
+    :param table: the table to load into
+    :param file: the local file to load from, recorded in the manifest by its name
+    :param display: whether progress should be printed
+    :param enclosed_by_double_quote: as for load_file
+    :return whether the file was loaded
+    """
+    name = os.path.basename(file)
+    size = os.path.getsize(file)
+    mtime = os.path.getmtime(file)
+    entry = manifest_entry(conn, file)
+    checksum = None
+    if entry is not None:
+        if entry["state"] == "loaded" and (entry["size"], entry["mtime"]) == (size, mtime):
+            if display:
+                print(f"{name} already loaded into `{entry['table_name']}`")
+            return False
+        # Only a changed size or modification time costs reading the file
+        checksum = file_checksum(file)
+        if entry["state"] == "loaded" and (entry["size"], entry["checksum"]) == (size, checksum):
+            execute_prepared(conn, "UPDATE `load_manifest` SET `mtime` = %s WHERE `file` = %s", (mtime, name))
+            if display:
+                print(f"{name} already loaded into `{entry['table_name']}`")
+            return False
+        if display:
+            print(f"removing the {'partial' if entry['state'] == 'loading' else 'outdated'} load of {name} from `{entry['table_name']}`")
+        last_db_id = entry["last_db_id"]
+        if entry["state"] == "loading":
+            # A file left loading has no last db_id recorded, but files loaded
+            # after it were given db_ids above all of its rows
+            last_db_id = execute_prepared(
+                conn,
+                "SELECT MIN(`first_db_id`) - 1 FROM `load_manifest` WHERE `table_name` = %s AND `first_db_id` > %s",
+                (entry["table_name"], entry["first_db_id"]))[0][0]
+        execute_prepared(
+            conn,
+            f"DELETE FROM {identifier(entry['table_name'])} WHERE db_id >= %s" + (" AND db_id <= %s" if last_db_id is not None else ""),
+            (entry["first_db_id"], last_db_id) if last_db_id is not None else (entry["first_db_id"],))
+    if checksum is None:
+        checksum = file_checksum(file)
+
+    table_id = identifier(table)
+    # Rows will be given db_ids above the current maximum
+    first_db_id = execute(conn, f"SELECT COALESCE(MAX(db_id), 0) + 1 FROM {table_id}")[0][0]
+    execute_prepared(
+        conn,
+        """REPLACE INTO `load_manifest` (`file`, `table_name`, `size`, `checksum`, `row_count`, `state`, `first_db_id`, `last_db_id`, `mtime`)
+    VALUES (%s, %s, %s, %s, NULL, 'loading', %s, NULL, %s)""",
+        (name, table, size, checksum, first_db_id, mtime))
+    load_file(conn, table, file, display=display, enclosed_by_double_quote=enclosed_by_double_quote)
+    row_count, last_db_id = execute_prepared(
+        conn,
+        f"SELECT COUNT(*), MAX(db_id) FROM {table_id} WHERE db_id >= %s",
+        (first_db_id,))[0]
+    execute_prepared(
+        conn,
+        "UPDATE `load_manifest` SET `row_count` = %s, `state` = 'loaded', `last_db_id` = %s WHERE `file` = %s",
+        (row_count, last_db_id, name))
+    if display:
+        print(f"loaded {row_count} rows from {name}")
+    return True
+
+
+# ===== Transaction density grid =====
+
+density_cell_size = 0.01
+
+
+def create_density_grid(conn, cell_size=density_cell_size):
+    """
+    Create the pp_density table counting the transactions of the join of postcode_data and pp_data in each cell of a latitude, longitude grid
+    :param conn: database connection
+    :param cell_size: the size of each cell in degrees
+    """
+    return execute(
+        conn,
+        "DROP TABLE IF EXISTS `pp_density`",
+        """CREATE TABLE `pp_density` (
+    `lat_cell` int NOT NULL,
+    `long_cell` int NOT NULL,
+    `count` bigint(20) unsigned NOT NULL,
+    PRIMARY KEY (`lat_cell`, `long_cell`)
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+        f"""INSERT INTO `pp_density`
+    SELECT FLOOR(lattitude / {cell_size}) AS lat_cell, FLOOR(longitude / {cell_size}) AS long_cell, COUNT(*)
+    FROM
+        `pp_data`
+    INNER JOIN
+        `postcode_data`
+    ON
+        `pp_data`.postcode_key = `postcode_data`.postcode_key
+    GROUP BY lat_cell, long_cell""")
+
+
+def density_cells(conn, bbox, cell_size=density_cell_size):
+    """
+    Fetch the cells of the density grid that intersect a bbox
+    :param conn: database connection
+    :param bbox: the bbox
+    :param cell_size: the size of each cell in degrees, as used by create_density_grid
+    :return an (n,3) array of lat_cell, long_cell, count, or None if there is no density grid
+    """
+    if not table_exists(conn, "pp_density"):
+        return None
+    rows = execute(conn, f"""
+    SELECT lat_cell, long_cell, count FROM `pp_density`
+    WHERE lat_cell BETWEEN {int(np.floor(bbox[0] / cell_size))} AND {int(np.floor(bbox[1] / cell_size))}
+    AND long_cell BETWEEN {int(np.floor(bbox[2] / cell_size))} AND {int(np.floor(bbox[3] / cell_size))}""")
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
+
+
+def estimate_count(cells, bbox, cell_size=density_cell_size):
+    """
+    Estimate the number of transactions in a bbox from density grid cells, assuming transactions are spread uniformly within each cell
+    :param cells: an array of cells as from density_cells
+    :param bbox: the bbox
+    :param cell_size: the size of each cell in degrees
+    """
+    lat_overlap = np.clip(np.minimum((cells[:, 0] + 1) * cell_size, bbox[1]) - np.maximum(cells[:, 0] * cell_size, bbox[0]), 0, None)
+    long_overlap = np.clip(np.minimum((cells[:, 1] + 1) * cell_size, bbox[3]) - np.maximum(cells[:, 1] * cell_size, bbox[2]), 0, None)
+    return float(np.sum(cells[:, 2] * lat_overlap * long_overlap) / cell_size ** 2)
+
+
+def stream(conn, query, chunk_size=100000, output_query=False):
+    """
+    Execute a query and stream its results from the server in chunks, without buffering the whole result
+    :param conn: database connection
+    :param query: the query to be executed
+    :param chunk_size: the number of rows fetched at a time
+    :param output_query: whether the query should be printed before it is executed
+    :return a generator of lists of rows
+    """
+    query = translate(conn, query)
+    if output_query:
+        print(query)
+    # DuckDB cursors already stream results in chunks
+    cur = conn.cursor() if is_duckdb(conn) else conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        with tracing.span("sql", sql=query):
+            cur.execute(query)
+        while True:
+            with tracing.span("sql.fetch", sql=query) as span:
+                rows = cur.fetchmany(chunk_size)
+                span.set(rows=len(rows))
+            if len(rows) == 0:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+# ===== Sampling =====
+
+"""
+Strata that samples can be balanced over, as SQL expressions on the join of pp_data and postcode_data
+"""
+strata = {
+    "property_type": "property_type",
+    "year": "YEAR(date_of_transfer)",
+    "region": "postcode_area",
+}
+
+
+def stratum_expression(by):
+    """
+    :param by: a key of strata, or a tuple of keys to stratify by their combination
+    :return a SQL expression for the stratum of each row
+    """
+    if isinstance(by, str):
+        by = (by,)
+    return ", ".join(strata[b] for b in by)
+
+
+def stratified_sample(
+        conn,
+        n,
+        by="property_type",
+        bbox=None,
+        date_bound=None,
+        seed=0,
+        output_query=False):
+    """
+    Sample a fixed number of transactions balanced across strata in a single query, so rare strata (such as property type "O") are as well represented as common ones.
+    Rows are ranked in a random order within each stratum and the n lowest ranks are taken, so every stratum contributes equally unless it runs out of rows.
+    :param conn: database connection
+    :param n: the number of transactions to sample
+    :param by: a key of strata, or a tuple of keys
+    :param bbox: bbox to constrain coordinates
+    :param date_bound: a tuple of dates that date_of_transfer must be within
+    :param seed: the seed of the random order
+    :param output_query: whether the SQL query should be printed
+    :return a GeoDataFrame of transactions as from inner_join, with a sample_weight column giving the number of transactions each sampled transaction represents
+    """
+    partition = stratum_expression(by)
+    inner = join_query(
+        join_conditions(bbox=bbox, date_bound=date_bound),
+        extra_columns=[
+            f"ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY CRC32(CONCAT(pp_data.db_id, ':', {int(seed)}))) AS sample_rank",
+            f"COUNT(*) OVER (PARTITION BY {partition}) AS stratum_size",
+            f"CONCAT_WS(':', {partition}) AS stratum"])
+    names = [name for name, _ in join_columns]
+    query = f"""
+    SELECT {", ".join(names)}, stratum, stratum_size
+    FROM ({inner}) AS ranked
+    ORDER BY sample_rank, stratum
+    LIMIT {int(n)}
+    """
+    results = execute(conn, query, output_queries=output_query)
+    gdf = transactions_gdf(results, extra_columns=["stratum", "stratum_size"])
+    return weight_sample(gdf)
+
+
+def weight_sample(gdf):
+    """
+    Replace the stratum_size column of a stratified sample by a sample_weight column
+    :param gdf: a sample with stratum and stratum_size columns
+    """
+    taken = gdf.groupby("stratum").stratum.transform("count")
+    gdf["sample_weight"] = gdf.stratum_size.astype(float) / taken
+    return gdf.drop(columns="stratum_size")
+
+
+def reservoir_sample(rows, n, stratum=None, seed=0):
+    """
+    Sample a fixed number of rows from a stream in a single pass, balanced across strata. A uniform reservoir of up to n rows is kept for each stratum, and the sample is then drawn from the reservoirs in turn.
+    :param rows: an iterable of rows
+    :param n: the number of rows to sample
+    :param stratum: a function giving the stratum of a row, if None the sample is not stratified
+    :param seed: the random seed
+    :return a list of (row, stratum, stratum_size) tuples
+    """
+    rng = np.random.default_rng(seed)
+    reservoirs = {}
+    seen = {}
+    for row in rows:
+        s = None if stratum is None else stratum(row)
+        count = seen.get(s, 0)
+        seen[s] = count + 1
+        reservoir = reservoirs.setdefault(s, [])
+        if count < n:
+            reservoir.append(row)
+        else:
+            j = rng.integers(0, count + 1)
+            if j < n:
+                reservoir[j] = row
+
+    for reservoir in reservoirs.values():
+        rng.shuffle(reservoir)
+    sample = []
+    for rank in range(n):
+        for s in sorted(reservoirs, key=str):
+            if len(sample) == n:
+                return sample
+            if rank < len(reservoirs[s]):
+                sample.append((reservoirs[s][rank], s, seen[s]))
+    return sample
+
+
+def reservoir_stratified_sample(
+        conn,
+        n,
+        by="property_type",
+        bbox=None,
+        date_bound=None,
+        seed=0,
+        chunk_size=100000,
+        output_query=False):
+    """
+    Sample a fixed number of transactions balanced across strata by reservoir sampling over a streaming cursor, for servers without window functions. The sample follows the same allocation as stratified_sample.
+    :param conn: database connection
+    :param n: the number of transactions to sample
+    :param by: a key of strata, or a tuple of keys
+    :param bbox: bbox to constrain coordinates
+    :param date_bound: a tuple of dates that date_of_transfer must be within
+    :param seed: the random seed
+    :param chunk_size: the number of rows fetched at a time
+    :param output_query: whether the SQL query should be printed
+    :return a GeoDataFrame of transactions as from inner_join, with a sample_weight column
+    """
+    query = join_query(
+        join_conditions(bbox=bbox, date_bound=date_bound),
+        extra_columns=[f"CONCAT_WS(':', {stratum_expression(by)})"])
+    rows = (row for chunk in stream(conn, query, chunk_size, output_query) for row in chunk)
+    sample = reservoir_sample(rows, n, stratum=lambda row: row[-1], seed=seed)
+    gdf = transactions_gdf(
+        [row[:-1] + (s, size) for row, s, size in sample],
+        extra_columns=["stratum", "stratum_size"])
+    return weight_sample(gdf)
+
+
 # ===== Bounding boxes and example coordinates =====
 """
 The sane bounding box (bbox) format is
@@ -415,4 +1339,39 @@ def collect_pois(bbox, tagset):
     collect all pois in a bounding for a tagset
     :param bbox: the bbox
     :param tagset: the open street maps tagset"""
-    return ox.geometries_from_bbox(* toggle_format(bbox), tagset)
+    with tracing.span("osm.collect_pois", bbox=bbox, tagset=tagset) as span:
+        pois = ox.geometries_from_bbox(* toggle_format(bbox), tagset)
+        span.set(rows=len(pois))
+    return pois
+
+
+street_graphs = {}
+
+
+def collect_street_graph(bbox, network_type="walk", cache_dir=None):
+    """
+    collect the simplified street graph of a bounding box, cached in memory and optionally as GraphML files so each graph is downloaded once
+    :param bbox: the bbox
+    :param network_type: the open street maps network type, such as "walk" or "drive"
+    :param cache_dir: the directory graphs are cached in as GraphML files. If None, the street_graph_dir configuration value is used if it is set, and otherwise graphs are only cached in memory
+    :return a networkx MultiDiGraph whose edges have a length in meters"""
+    key = (tuple(round(float(bound), 6) for bound in bbox), network_type)
+    if key in street_graphs:
+        return street_graphs[key]
+    if cache_dir is None:
+        cache_dir = config.get("street_graph_dir")
+    file = None
+    if cache_dir is not None:
+        name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        file = os.path.join(cache_dir, f"{network_type}-{name}.graphml")
+    with tracing.span("osm.collect_street_graph", bbox=bbox, network_type=network_type, cached=file is not None and exists(file)) as span:
+        if file is not None and exists(file):
+            graph = ox.load_graphml(file)
+        else:
+            graph = ox.graph_from_bbox(* toggle_format(bbox), network_type=network_type, simplify=True)
+            if file is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                ox.save_graphml(graph, file)
+        span.set(nodes=len(graph.nodes), edges=len(graph.edges))
+    street_graphs[key] = graph
+    return graph
@@ -4,35 +4,170 @@
 
 from .config import *
 
-from . import access, assess
+from . import access, assess, tracing
+from .lazy import lazy_module
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import geopandas as gpd
-import statsmodels.api as sm
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import time
+import urllib.parse
 import numpy as np
-from shapely.geometry import Point
-import pandas as pd
-from sklearn import model_selection
-from sklearn import metrics
+
+gpd = lazy_module("geopandas")
+sm = lazy_module("statsmodels.api")
+geometry = lazy_module("shapely.geometry")
+pd = lazy_module("pandas")
+model_selection = lazy_module("sklearn.model_selection")
+metrics = lazy_module("sklearn.metrics")
+stats = lazy_module("scipy.stats")
+spatial = lazy_module("scipy.spatial")
 
 def train_model(y,X):
-    model = sm.OLS(y,X)
-    return model.fit()
+    with tracing.span("model.fit", rows=len(X), columns=np.shape(X)[1]):
+        model = sm.OLS(y,X)
+        return model.fit()
+
+def fold_errors(y_test, y_pred):
+    return (metrics.mean_absolute_error(y_test,y_pred), metrics.mean_squared_error(y_test,y_pred))
+
+def fit_and_score_fold(args):
+    train, y_train, X_train, y_test, X_test = args
+    return fold_errors(y_test, train(y_train, X_train).predict(X_test))
+
+@tracing.traced("model.cross_validate")
+def cross_validate(y, X, n_splits=5, train=None, processes=None, random_state=0):
+    """
+    K-fold cross validation of a model predicting y from X, holding out each fold from training.
+    For the default OLS model, XᵀX and Xᵀy are accumulated once and each fold's least squares solution is found by subtracting the fold's contribution, so the cost is close to a single fit. Other models are fitted on each fold across a process pool.
+    :param y: an array of targets
+    :param X: a 2D array of features
+    :param n_splits: the number of folds
+    :param train: None for OLS, or a picklable function like train_model taking (y, X) and returning a fitted model with a predict method
+    :param processes: the number of processes to fit folds of a train function with, if None os.cpu_count() is used
+    :param random_state: the seed of the fold shuffle
+    :return a tuple of a list of the held out mean absolute error and a list of the held out mean squared error of each fold
+    """
+    y = np.asarray(y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    folds = list(model_selection.KFold(n_splits=n_splits,shuffle=True,random_state=random_state).split(X))
 
-def grow_bounding_box(conn, target, initial_width=2, initial_height=2, max_growth=5, transaction_requirement=1000):
+    if train is None:
+        gram = X.T @ X
+        moment = X.T @ y
+        errors = []
+        for train_index, test_index in folds:
+            X_test, y_test = X[test_index], y[test_index]
+            # pinv matches the minimum norm solution statsmodels' OLS finds
+            # for rank deficient designs
+            params = np.linalg.pinv(gram - X_test.T @ X_test, hermitian=True) @ (moment - X_test.T @ y_test)
+            errors.append(fold_errors(y_test, X_test @ params))
+    else:
+        tasks = [(train, y[train_index], X[train_index], y[test_index], X[test_index]) for train_index, test_index in folds]
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            errors = [tracing.merge(output) for output in executor.map(tracing.Remote(fit_and_score_fold), tasks)]
+
+    cross_MAE = [mae for mae, _ in errors]
+    cross_MSE = [mse for _, mse in errors]
+    return cross_MAE, cross_MSE
+
+@tracing.traced("address.grow_bounding_box")
+def grow_bounding_box(conn, target, initial_width=2, initial_height=2, max_growth=5, transaction_requirement=1000, property_type=None):
+    """
+    Find the smallest of a sequence of growing bounding boxes around a target containing enough transactions, and fetch its transactions.
+    Box sizes are chosen using the pp_density grid if it exists, and confirmed with COUNT queries, so transactions are fetched exactly once.
+    :param conn: a database connection
+    :param target: the (latitude, longitude) centre
+    :param initial_width: the width of the smallest box in km
+    :param initial_height: the height of the smallest box in km
+    :param max_growth: the largest multiple of the initial size to try
+    :param transaction_requirement: the number of transactions required
+    :param property_type: if not None, only transactions of this property type are counted and fetched
+    :return a tuple of the bbox, its (width, height) in km and its transactions. If no box meets the requirement, the largest box is used
+    """
+    growths = []
     growth = 1
-    transactions = None
     while growth <= max_growth:
-        bbox = access.km_bbox(target, initial_width*growth, initial_height*growth)
-        transactions = access.inner_join(conn, bbox)
-        if len(transactions) >= transaction_requirement:
-            print(f"grew bounding box to {initial_width * growth} km wide and {initial_height * growth} km high.\n Found {len(transactions)} transactions")
-            return (bbox, (initial_width * growth, initial_height * growth), transactions)
-        else:
-            growth = (growth * 1.5) // 0.5 * 0.5
-    print(f"WARNING: grew bounding box to {initial_width * growth} km wide and {initial_height * growth} km high.\n Only found {len(transactions)} transactions, less than requirement of {transaciton_requirement}")
+        growths.append(growth)
+        growth = (growth * 1.5) // 0.5 * 0.5
+    bboxes = [access.km_bbox(target, initial_width*growth, initial_height*growth) for growth in growths]
+
+    counts = {}
+    def count(i):
+        if i not in counts:
+            counts[i] = access.count_transactions(conn, bboxes[i], property_type=property_type)
+        return counts[i]
+
+    # Start from the density estimate if there is one, otherwise binary search
+    # as counts only grow with the bbox. The grid counts every property type
+    cells = access.density_cells(conn, bboxes[-1]) if property_type is None else None
+    if cells is not None:
+        estimates = [access.estimate_count(cells, bbox) for bbox in bboxes]
+        i = next((i for i, estimate in enumerate(estimates) if estimate >= transaction_requirement), len(bboxes) - 1)
+        while i < len(bboxes) - 1 and count(i) < transaction_requirement:
+            i += 1
+        while i > 0 and count(i - 1) >= transaction_requirement:
+            i -= 1
+    else:
+        low, high = 0, len(bboxes) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if count(middle) >= transaction_requirement:
+                high = middle
+            else:
+                low = middle + 1
+        i = low
+
+    bbox, growth = bboxes[i], growths[i]
+    transactions = access.inner_join(conn, bbox, property_type=property_type)
+    if len(transactions) >= transaction_requirement:
+        print(f"grew bounding box to {initial_width * growth} km wide and {initial_height * growth} km high.\n Found {len(transactions)} transactions")
+    else:
+        print(f"WARNING: grew bounding box to {initial_width * growth} km wide and {initial_height * growth} km high.\n Only found {len(transactions)} transactions, less than requirement of {transaction_requirement}")
+    return (bbox, (initial_width * growth, initial_height * growth), transactions)
+
+transaction_columns = ["price","date_of_transfer","postcode","property_type","latitude","longitude","geometry"]
+
+def query_transactions(targets, start_index):
+    """
+    Create transactions with dummy prices for prediction targets
+    :param targets: a DataFrame with latitude, longitude, date and property_type columns
+    :param start_index: the index of the first query transaction, following the data transactions
+    :return a GeoDataFrame with transaction_columns, keyed by coordinates in place of postcode
+    """
+    rows = [[-1,date,f"{latitude},{longitude}",property_type,latitude,longitude,geometry.Point(longitude,latitude)]
+            for latitude,longitude,date,property_type in zip(targets.latitude,targets.longitude,targets.date,targets.property_type)]
+    return gpd.GeoDataFrame(rows,columns=transaction_columns,index=range(start_index,start_index+len(rows)),crs="EPSG:4326")
+
+@tracing.traced("address.make_features")
+def make_features(transactions, queries, centre, width, height, make_poi_features, tagsets, monthly_average_price_for_type, store=None, snapshot=None, pois=None):
+    """
+    Make the model features of transactions and query transactions together, so pois are downloaded and distances computed once for both
+    :param transactions: a GeoDataFrame of transactions with transaction_columns
+    :param queries: a GeoDataFrame of query transactions, as from query_transactions
+    :param centre: the (latitude, longitude) centre of the transactions' bbox
+    :param width: the width of the transactions' bbox in km
+    :param height: the height of the transactions' bbox in km
+    :param pois: if not None, a dictionary of collected pois passed to assess.make_poi_features
+    :return a tuple of the features of transactions and the features of queries
+    """
+    combined_transactions = pd.concat((transactions, queries))
+    combined_transactions.date_of_transfer = pd.to_datetime(combined_transactions.date_of_transfer)
+    
+    poi_bbox = access.km_bbox(centre, width*2, height*2)
+    features = assess.make_poi_features(poi_bbox, combined_transactions, tagsets, make_poi_features, max_dist=min(width,height)*1000, store=store, snapshot=snapshot, pois=pois)
+    features["log-MAP"] = np.log(monthly_average_price_for_type(combined_transactions))
+    features["const"] = np.ones(len(features))
+    return features.iloc[:len(transactions)], features.iloc[len(transactions):]
 
-def predict_price_with_features(conn, latitude, longitude, date, property_type, make_poi_features, tagsets, monthly_average_price_for_type, to_return = "pred", output=0):
+@tracing.traced("address.predict_price_with_features")
+def predict_price_with_features(conn, latitude, longitude, date, property_type, make_poi_features, tagsets, monthly_average_price_for_type, to_return = "pred", output=0, store=None, snapshot=None, national=None, transaction_requirement=1000, pois=None):
     """
     predict price for a property by constructing a certain set of poi_features, perform 5-fold cross validation to understand reliability.
     :param conn: a database connection
@@ -43,46 +178,32 @@ def predict_price_with_features(conn, latitude, longitude, date, property_type,
     :param monthly_average_price_for_type: a function which gives a GeoDataFrame of transactions returns a series indicating the monthly average price for each traction's date and property type
     :to_return either "pred" indicating that the prediction should be returned or "cross_MSE" indicating the cross validation average Mean Squared Error should be returned.
     :output an integer between 0 and 2 indicating the verbosity of intermediate output
+    :param store: if not None, an assess.FeatureStore used to reuse poi features of previously seen postcodes
+    :param snapshot: the POI snapshot version passed to assess.make_poi_features, required if store is not None
+    :param national: if not None, national coefficients from fit_national_model used to predict when too few transactions are found nearby
+    :param transaction_requirement: the number of nearby transactions required for a local model
+    :param pois: if not None, a dictionary of already collected pois for some tagsets, passed to assess.make_poi_features
     """
     target = (latitude,longitude)
     
     assert(access.in_bbox(target,access.mainland_bbox))
     assert(property_type in access.property_types)
     
-    bbox, (width,height), transactions = grow_bounding_box(conn, target)
-    transactions = transactions[["price","date_of_transfer","property_type","latitude","longitude","geometry"]]
-    
-    # Create transaction with dummy price for the query
-    geometry = Point(latitude,longitude)
-    query_transaction = gpd.GeoDataFrame([[-1,date,property_type,latitude,longitude,geometry]],columns=transactions.columns,index=[len(transactions)],crs="EPSG:4326")
-    combined_transactions = pd.concat((transactions, query_transaction))
-    combined_transactions.date_of_transfer = pd.to_datetime(combined_transactions.date_of_transfer)
-    
-    poi_bbox = access.km_bbox(target, width*2, height*2)
-    features = assess.make_poi_features(poi_bbox, combined_transactions, tagsets, make_poi_features, max_dist=min(width,height)*1000)
-    features["log-MAP"] = np.log(monthly_average_price_for_type(combined_transactions))
-    features["const"] = np.ones(len(features))
+    bbox, (width,height), transactions = grow_bounding_box(conn, target, transaction_requirement=transaction_requirement)
+    if national is not None and to_return == "pred" and len(transactions) < transaction_requirement:
+        print(f"falling back to the national model with only {len(transactions)} transactions nearby")
+        return pd.Series(national_predict(national, latitude, longitude, date, property_type))
+    transactions = transactions[transaction_columns]
     
-    data_features = features.iloc[:-1]
-    query_features = features.iloc[-1]
+    queries = query_transactions(pd.DataFrame([[latitude,longitude,date,property_type]],columns=["latitude","longitude","date","property_type"]), len(transactions))
+    data_features, query_features = make_features(transactions, queries, target, width, height, make_poi_features, tagsets, monthly_average_price_for_type, store=store, snapshot=snapshot, pois=pois)
         
     y = np.log(transactions.price)
     X = data_features.to_numpy()
-    query_X = query_features.to_numpy()
+    query_X = query_features.iloc[0].to_numpy()
 
     n_splits = 5
-    kf = model_selection.KFold(n_splits=n_splits,shuffle=True,random_state=0)
-    
-    cross_MAE = []
-    cross_MSE = []
-    
-    for train_index, test_index in kf.split(X):
-        X_train, X_test = X[train_index], X[test_index]
-        y_train, y_test = y[train_index], y[test_index]
-        m_results = train_model(y, X)
-        y_pred = m_results.predict(X_test)
-        cross_MAE.append(metrics.mean_absolute_error(y_test,y_pred))
-        cross_MSE.append(metrics.mean_squared_error(y_test,y_pred))
+    cross_MAE, cross_MSE = cross_validate(y, X, n_splits=n_splits)
     if output > 0:
         print(f"{n_splits}-fold cross validation:\n model MAE {np.mean(cross_MAE):.4f}±{np.std(cross_MAE,ddof=1):.4f}\n model MSE {np.mean(cross_MSE):.4f}±{np.std(cross_MSE,ddof=1):.4f}")
     
@@ -101,3 +222,843 @@ def predict_price_with_features(conn, latitude, longitude, date, property_type,
         return y_pred
     else:
         raise ValueError("to_return should be 'cross_MSE' or 'pred'")
+
+
+# ===== Batch prediction =====
+
+km_per_degree = 111.32
+
+def tile_of(latitude, longitude, tile_km=2):
+    """
+    The square spatial tile containing a point
+    :param latitude: a latitude or array of latitudes
+    :param longitude: a longitude or array of longitudes
+    :param tile_km: the approximate width of each tile in km
+    :return a tuple of the latitude and longitude cell indices
+    """
+    lat_cell = np.floor(np.asarray(latitude, dtype=float) * km_per_degree / tile_km)
+    lat_centre = (lat_cell + 0.5) * tile_km / km_per_degree
+    long_cell = np.floor(np.asarray(longitude, dtype=float) * np.cos(np.radians(lat_centre)) * km_per_degree / tile_km)
+    return lat_cell.astype(int), long_cell.astype(int)
+
+def tile_centre(tile, tile_km=2):
+    """
+    :param tile: a tuple of cell indices as from tile_of
+    :param tile_km: the approximate width of each tile in km
+    :return the (latitude, longitude) centre of the tile
+    """
+    lat_centre = (tile[0] + 0.5) * tile_km / km_per_degree
+    return (lat_centre, (tile[1] + 0.5) * tile_km / (km_per_degree * np.cos(np.radians(lat_centre))))
+
+def cluster_targets(targets, cluster_km=2):
+    """
+    Group prediction targets into square spatial tiles, so that targets a few hundred meters apart can share data fetches
+    :param targets: a DataFrame with latitude and longitude columns
+    :param cluster_km: the approximate width of each tile in km
+    :return a list of arrays of target positions, one for each non-empty tile
+    """
+    if len(targets) == 0:
+        return []
+    lat_cells, long_cells = tile_of(targets.latitude, targets.longitude, cluster_km)
+    _, labels = np.unique(np.column_stack((lat_cells, long_cells)), axis=0, return_inverse=True)
+    labels = labels.reshape(-1)
+    return [np.flatnonzero(labels == label) for label in range(labels.max() + 1)]
+
+@tracing.traced("address.predict_cluster")
+def predict_cluster(conn, targets, make_poi_features, tagsets, monthly_average_price_for_type, transaction_requirement=1000, store=None, snapshot=None, output=0):
+    """
+    Predict prices for a cluster of nearby targets with one transaction fetch, one poi download for each tagset and one model fit
+    :param conn: a database connection
+    :param targets: a DataFrame with latitude, longitude, date and property_type columns
+    :param transaction_requirement: the number of transactions required around the cluster
+    :return a DataFrame with the same index as targets and the columns of the statsmodels prediction summary frame, as prices
+    """
+    for target in zip(targets.latitude, targets.longitude):
+        assert(access.in_bbox(target,access.mainland_bbox))
+    assert(targets.property_type.isin(access.property_types).all())
+
+    centre = (float(targets.latitude.astype(float).mean()), float(targets.longitude.astype(float).mean()))
+    # The initial bbox must reach the furthest target from the centre
+    two_km = access.km_bbox(centre, 2, 2)
+    half_height = np.max(np.abs(targets.latitude.astype(float) - centre[0])) / (two_km[1] - two_km[0]) * 2
+    half_width = np.max(np.abs(targets.longitude.astype(float) - centre[1])) / (two_km[3] - two_km[2]) * 2
+    bbox, (width,height), transactions = grow_bounding_box(conn, centre, initial_width=max(2, 2*half_width), initial_height=max(2, 2*half_height), transaction_requirement=transaction_requirement)
+    transactions = transactions[transaction_columns]
+
+    queries = query_transactions(targets, len(transactions))
+    data_features, query_features = make_features(transactions, queries, centre, width, height, make_poi_features, tagsets, monthly_average_price_for_type, store=store, snapshot=snapshot)
+
+    m_results = train_model(np.log(transactions.price), data_features.to_numpy())
+    if output > 1:
+        print(m_results.summary())
+    pred = m_results.get_prediction(query_features.to_numpy())
+    y_pred = np.exp(pred.summary_frame(alpha=0.05))
+    y_pred.index = targets.index
+    return y_pred
+
+worker_conn = None
+
+def predict_cluster_worker_init(connection_args):
+    global worker_conn
+    worker_conn = access.create_connection_and_maybe_create_database_if_missing(**connection_args, create_database_if_missing=False)
+
+def predict_cluster_worker(args):
+    targets, kwargs = args
+    return predict_cluster(worker_conn, targets, **kwargs)
+
+def predict_prices(targets, make_poi_features, tagsets, monthly_average_price_for_type, conn=None, connection_args=None, processes=1, cluster_km=2, transaction_requirement=1000, store=None, snapshot=None, output=0):
+    """
+    Predict prices for many targets. Targets are clustered spatially, and transactions and pois are fetched, features made and a model fitted once for each cluster. Clusters are predicted in parallel across processes.
+    :param targets: a DataFrame with latitude, longitude, date and property_type columns
+    :param make_poi_features: the features to make, as for predict_price_with_features
+    :param tagsets: a dictionary of tagsets
+    :param monthly_average_price_for_type: as for predict_price_with_features, it must be picklable (a module level function) if processes > 1
+    :param conn: a database connection, used when processes is 1
+    :param connection_args: a dictionary of arguments for access.create_connection_and_maybe_create_database_if_missing, used to open a connection in each process when processes > 1. It is required when processes > 1, since a live connection cannot be pickled to the workers, and when processes is 1 if conn is None
+    :param processes: the number of processes to predict clusters with
+    :param cluster_km: the approximate width of each cluster in km
+    :param transaction_requirement: the number of transactions required around each cluster
+    :param store: if not None, an assess.FeatureStore. Only supported when processes is 1
+    :param snapshot: the POI snapshot version passed to assess.make_poi_features, required if store is not None
+    :output an integer between 0 and 2 indicating the verbosity of intermediate output
+    :return a DataFrame with the same index as targets and the columns of the statsmodels prediction summary frame, as prices. Its attrs record the predictions per second
+    """
+    if processes > 1 and store is not None:
+        raise ValueError("a FeatureStore cannot be shared between processes")
+    if processes > 1 and connection_args is None:
+        raise ValueError("connection_args is required when processes > 1, as conn cannot be passed to other processes")
+    if conn is None and connection_args is None:
+        raise ValueError("one of conn and connection_args is required")
+    start = time.perf_counter()
+    clusters = cluster_targets(targets, cluster_km)
+    kwargs = {"make_poi_features": make_poi_features, "tagsets": tagsets, "monthly_average_price_for_type": monthly_average_price_for_type, "transaction_requirement": transaction_requirement, "store": store, "snapshot": snapshot, "output": output}
+    tasks = [(targets.iloc[cluster], kwargs) for cluster in clusters]
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=predict_cluster_worker_init, initargs=(connection_args,)) as pool:
+            predictions = [tracing.merge(output) for output in pool.map(tracing.Remote(predict_cluster_worker), tasks)]
+    else:
+        if conn is None:
+            conn = access.create_connection_and_maybe_create_database_if_missing(**connection_args, create_database_if_missing=False)
+        predictions = [predict_cluster(conn, task_targets, **task_kwargs) for task_targets, task_kwargs in tasks]
+
+    predictions = pd.concat(predictions).loc[targets.index] if len(predictions) > 0 else pd.DataFrame()
+    elapsed = time.perf_counter() - start
+    predictions.attrs["predictions_per_second"] = len(targets) / elapsed
+    print(f"predicted {len(targets)} prices in {len(clusters)} clusters in {elapsed:.1f}s ({len(targets) / elapsed:.2f} predictions per second)")
+    return predictions
+
+
+# ===== Prediction server =====
+
+class LRUCache:
+    """
+    A dictionary holding at most maxsize items, evicting the least recently used
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+def data_version(conn):
+    """
+    A cheap version of the transaction and postcode data, which changes whenever rows are loaded, deleted or replaced
+    :param conn: a database connection
+    :return a tuple of the largest db_id and row count of pp_data and of postcode_data, followed by a checksum of the load manifest's files and states, which changes when a load is replaced at the same ids
+    """
+    version = access.execute(conn, """SELECT
+    (SELECT COALESCE(MAX(db_id), 0) FROM `pp_data`), (SELECT COUNT(*) FROM `pp_data`),
+    (SELECT COALESCE(MAX(db_id), 0) FROM `postcode_data`), (SELECT COUNT(*) FROM `postcode_data`)""")[0]
+    manifest = 0
+    if access.table_exists(conn, "load_manifest"):
+        manifest = access.execute(conn, "SELECT COALESCE(SUM(CRC32(CONCAT(file, checksum, state))), 0) FROM `load_manifest`")[0][0]
+    return tuple(int(v) for v in version) + (int(manifest),)
+
+class PredictionService:
+    """
+    Predicts prices from models fitted per spatial tile and property type, kept warm in LRU caches along with the transactions and pois they were fitted on, so repeated queries in an area only compute the target's features.
+    Caches are cleared when the data version changes.
+    """
+    def __init__(self, conn, make_poi_features, tagsets, monthly_average_price_for_type, tile_km=2, transaction_requirement=1000, cache_size=256, version_check_seconds=60):
+        """
+        :param conn: a database connection
+        :param make_poi_features: the features to make, as for predict_price_with_features
+        :param tagsets: a dictionary of tagsets
+        :param monthly_average_price_for_type: as for predict_price_with_features
+        :param tile_km: the approximate width of each tile in km
+        :param transaction_requirement: the number of transactions of a property type each model is fitted on
+        :param cache_size: the number of tiles and property types each cache holds
+        :param version_check_seconds: the minimum time between checks of the data version
+        """
+        self.conn = conn
+        self.make_poi_features = make_poi_features
+        self.tagsets = tagsets
+        self.monthly_average_price_for_type = monthly_average_price_for_type
+        self.tile_km = tile_km
+        self.transaction_requirement = transaction_requirement
+        self.models = LRUCache(cache_size)
+        self.transactions = LRUCache(cache_size)
+        self.pois = LRUCache(cache_size)
+        self.version_check_seconds = version_check_seconds
+        self.version = data_version(conn)
+        self.version_checked = time.monotonic()
+
+    def check_version(self):
+        if time.monotonic() - self.version_checked < self.version_check_seconds:
+            return
+        self.version_checked = time.monotonic()
+        version = data_version(self.conn)
+        if version != self.version:
+            print(f"data version changed from {self.version} to {version}, clearing caches")
+            self.version = version
+            self.models.clear()
+            self.transactions.clear()
+            self.pois.clear()
+
+    def tile_transactions(self, tile, property_type):
+        key = (tile, property_type)
+        entry = self.transactions.get(key)
+        if entry is None:
+            size = max(2, self.tile_km)
+            bbox, (width, height), transactions = grow_bounding_box(self.conn, tile_centre(tile, self.tile_km), initial_width=size, initial_height=size, transaction_requirement=self.transaction_requirement, property_type=property_type)
+            entry = (width, height, transactions[transaction_columns])
+            self.transactions.put(key, entry)
+        return entry
+
+    def model(self, tile, property_type):
+        key = (tile, property_type)
+        entry = self.models.get(key)
+        if entry is None:
+            width, height, transactions = self.tile_transactions(tile, property_type)
+            pois_key = (tile, width, height)
+            pois = self.pois.get(pois_key)
+            if pois is None:
+                pois = {}
+                self.pois.put(pois_key, pois)
+            centre = tile_centre(tile, self.tile_km)
+            data_features, _ = make_features(transactions, query_transactions(pd.DataFrame(columns=["latitude","longitude","date","property_type"]), len(transactions)), centre, width, height, self.make_poi_features, self.tagsets, self.monthly_average_price_for_type, pois=pois)
+            entry = {"model": train_model(np.log(transactions.price), data_features.to_numpy()), "centre": centre, "width": width, "height": height, "pois": pois, "transactions": transactions.iloc[:0]}
+            self.models.put(key, entry)
+        return entry
+
+    def predict(self, latitude, longitude, date, property_type):
+        """
+        Predict the price of a property
+        :param latitude: the latitude coordinate
+        :param longitude: the longitude coordinate
+        :param date: the date to predict
+        :param property_type: the property type that is being predicted
+        :return a dictionary of the prediction summary frame as prices, whether the model was cached and the time taken in ms
+        """
+        start = time.perf_counter()
+        assert(access.in_bbox((latitude,longitude),access.mainland_bbox))
+        assert(property_type in access.property_types)
+        self.check_version()
+        tile = tuple(int(cell) for cell in tile_of(latitude, longitude, self.tile_km))
+        cached = self.models.get((tile, property_type)) is not None
+        with contextlib.redirect_stdout(io.StringIO()):
+            entry = self.model(tile, property_type)
+            queries = query_transactions(pd.DataFrame([[latitude,longitude,pd.Timestamp(date),property_type]],columns=["latitude","longitude","date","property_type"]), 0)
+            _, query_features = make_features(entry["transactions"], queries, entry["centre"], entry["width"], entry["height"], self.make_poi_features, self.tagsets, self.monthly_average_price_for_type, pois=entry["pois"])
+        pred = entry["model"].get_prediction(query_features.to_numpy())
+        result = {name: float(value) for name, value in np.exp(pred.summary_frame(alpha=0.05).iloc[0]).items()}
+        result["cached"] = cached
+        result["ms"] = (time.perf_counter() - start) * 1000
+        return result
+
+def serve(service, host="127.0.0.1", port=8000):
+    """
+    Serve predictions over HTTP until interrupted, as JSON responses to GET /predict?latitude=..&longitude=..&date=..&property_type=..
+    :param service: a PredictionService
+    :param host: the address to listen on
+    :param port: the port to listen on
+    """
+    class PredictionHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/predict":
+                self.send_error(404)
+                return
+            params = {name: values[0] for name, values in urllib.parse.parse_qs(url.query).items()}
+            try:
+                result = service.predict(float(params["latitude"]), float(params["longitude"]), params["date"], params["property_type"])
+                status = 200
+            except (KeyError, ValueError, AssertionError) as e:
+                result = {"error": repr(e)}
+                status = 400
+            body = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    # A single threaded server, as the service's connection and caches are not thread safe
+    server = http.server.HTTPServer((host, port), PredictionHandler)
+    print(f"serving predictions on http://{host}:{port}/predict")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# ===== National model =====
+
+"""
+The national model predicts log price from columns shared by every region (national_columns) and a block of columns for the region (a coarse tile) of each transaction (regional_columns), whose interactions let the intercept, trend and property type effects vary by region.
+As each transaction only touches its own region's block, the sufficient statistics XᵀX and Xᵀy are accumulated block by block and the design matrix is never held.
+The design uses only transaction and property columns, not the POI features of the local models: those come from OSM queries or a FeatureStore around targets, which hold them for a few areas rather than for every transaction in the country.
+"""
+national_columns = ["new_build", "leasehold", "trend_squared"]
+regional_columns = ["intercept", "trend", "S", "T", "F", "O"]
+
+def years_since_1995(dates):
+    return ((pd.to_datetime(pd.Series(dates)) - pd.Timestamp("1995-01-01")).dt.days / 365.25).to_numpy()
+
+def national_design(property_types, new_build_flags, tenure_types, dates):
+    """
+    The national and regional columns of the national model's design
+    :return a tuple of an (n,len(national_columns)) array and an (n,len(regional_columns)) array
+    """
+    property_types = np.asarray(property_types)
+    trend = years_since_1995(dates)
+    national = np.column_stack((
+        np.asarray(new_build_flags) == "Y",
+        np.asarray(tenure_types) == "L",
+        trend ** 2)).astype(np.float64)
+    regional = np.column_stack(
+        [np.ones(len(trend)), trend] + [property_types == property_type for property_type in regional_columns[2:]]).astype(np.float64)
+    return national, regional
+
+@tracing.traced("address.fit_national_model")
+def fit_national_model(conn, region_km=40, chunk_size=100000, output=0):
+    """
+    Fit the national model by streaming every transaction joined to its postcode in chunks and accumulating OLS sufficient statistics
+    The fit leaves out POI features, so it is a baseline from the national_columns and regional_columns only
+    :param conn: a database connection
+    :param region_km: the approximate width of each region tile in km
+    :param chunk_size: the number of rows fetched at a time
+    :output an integer between 0 and 1 indicating the verbosity of intermediate output
+    :return a DataFrame of coefficients indexed by region tile, with one row per region holding the national and regional coefficients, the region's transaction count, the residual standard deviation and region_km
+    """
+    a, r = len(national_columns), len(regional_columns)
+    regions = {}
+    national_gram = np.zeros((a, a))
+    national_moment = np.zeros(a)
+    cross_gram = np.zeros((0, a, r))
+    regional_gram = np.zeros((0, r, r))
+    regional_moment = np.zeros((0, r))
+    counts = np.zeros(0, dtype=np.int64)
+    y_squared = 0.0
+
+    query = """
+    SELECT price, date_of_transfer, property_type, new_build_flag, tenure_type, lattitude, longitude
+    FROM
+        `pp_data`
+    INNER JOIN
+        `postcode_data`
+    ON
+        `pp_data`.postcode_key = `postcode_data`.postcode_key
+    WHERE price > 0
+    """
+    rows_seen = 0
+    for rows in access.stream(conn, query, chunk_size):
+        chunk = pd.DataFrame(rows, columns=["price", "date_of_transfer", "property_type", "new_build_flag", "tenure_type", "latitude", "longitude"])
+        y = np.log(chunk.price.to_numpy(dtype=np.float64))
+        national, regional = national_design(chunk.property_type, chunk.new_build_flag, chunk.tenure_type, chunk.date_of_transfer)
+
+        lat_cells, long_cells = tile_of(chunk.latitude.to_numpy(dtype=float), chunk.longitude.to_numpy(dtype=float), region_km)
+        for tile in set(zip(lat_cells.tolist(), long_cells.tolist())) - set(regions):
+            regions[tile] = len(regions)
+        region = np.fromiter((regions[tile] for tile in zip(lat_cells.tolist(), long_cells.tolist())), dtype=np.int64, count=len(chunk))
+        if len(regions) > len(counts):
+            grow = len(regions) - len(counts)
+            cross_gram = np.concatenate((cross_gram, np.zeros((grow, a, r))))
+            regional_gram = np.concatenate((regional_gram, np.zeros((grow, r, r))))
+            regional_moment = np.concatenate((regional_moment, np.zeros((grow, r))))
+            counts = np.concatenate((counts, np.zeros(grow, dtype=np.int64)))
+
+        national_gram += national.T @ national
+        national_moment += national.T @ y
+        np.add.at(cross_gram, region, np.einsum("ni,nj->nij", national, regional))
+        np.add.at(regional_gram, region, np.einsum("ni,nj->nij", regional, regional))
+        np.add.at(regional_moment, region, regional * y[:, None])
+        counts += np.bincount(region, minlength=len(counts))
+        y_squared += y @ y
+        rows_seen += len(chunk)
+        if output > 0:
+            print(f"accumulated {rows_seen} transactions in {len(regions)} regions")
+
+    # The normal equations are block diagonal in the regions, so each region's
+    # block is eliminated by its Schur complement and only a×a and r×r systems
+    # are solved, however many regions there are. A column a region never
+    # uses is also absent from its cross terms, so pseudo-inverses of the
+    # blocks give a least squares solution and the blocks' ranks add up
+    regional_inverse = np.linalg.pinv(regional_gram, hermitian=True)
+    reduced = cross_gram @ regional_inverse
+    schur = national_gram - np.einsum("kar,kbr->ab", reduced, cross_gram)
+    national_params = np.linalg.pinv(schur, hermitian=True) @ (national_moment - np.einsum("kar,kr->a", reduced, regional_moment))
+    regional_params = np.einsum("krs,ks->kr", regional_inverse, regional_moment - np.einsum("kar,a->kr", cross_gram, national_params))
+    rank = np.linalg.matrix_rank(schur, hermitian=True) + int(np.sum(np.linalg.matrix_rank(regional_gram, hermitian=True))) if len(regions) > 0 else 0
+    # Parameters solving the normal equations leave yᵀy - paramsᵀmoment
+    residual = max(y_squared - national_params @ national_moment - np.sum(regional_params * regional_moment), 0)
+    sigma = np.sqrt(residual / max(rows_seen - rank, 1))
+    rows = []
+    for tile, i in regions.items():
+        rows.append(list(tile) + list(national_params) + list(regional_params[i]) + [counts[i], sigma, region_km])
+    coefficients = pd.DataFrame(rows, columns=["lat_cell", "long_cell"] + national_columns + regional_columns + ["n", "sigma", "region_km"])
+    return coefficients.set_index(["lat_cell", "long_cell"]).sort_index()
+
+def write_national_coefficients(conn, coefficients, table="national_coefficients"):
+    """
+    Write the national model's coefficients to a table, replacing any already there
+    :param conn: a database connection
+    :param coefficients: the result of fit_national_model
+    :param table: the table to write to
+    """
+    df = coefficients.reset_index()
+    columns = ", ".join(f"`{column}` {'int' if column in ('lat_cell', 'long_cell') else 'double'} NOT NULL" for column in df.columns)
+    access.execute(conn, f"DROP TABLE IF EXISTS `{table}`", f"CREATE TABLE `{table}` ({columns}, PRIMARY KEY (`lat_cell`, `long_cell`))")
+    access.execute_many(conn, f"INSERT INTO `{table}` VALUES ({', '.join(['%s'] * len(df.columns))})", [tuple(map(float, row)) for row in df.itertuples(index=False)])
+
+def read_national_coefficients(conn, table="national_coefficients"):
+    """
+    Read the national model's coefficients written by write_national_coefficients
+    :param conn: a database connection
+    :param table: the table to read from
+    :return a DataFrame as from fit_national_model
+    """
+    columns = ["lat_cell", "long_cell"] + national_columns + regional_columns + ["n", "sigma", "region_km"]
+    df = pd.DataFrame(list(access.execute(conn, f"SELECT {', '.join(f'`{column}`' for column in columns)} FROM `{table}`")), columns=columns)
+    df[["lat_cell", "long_cell"]] = df[["lat_cell", "long_cell"]].astype(int)
+    return df.set_index(["lat_cell", "long_cell"]).sort_index()
+
+def national_predict(coefficients, latitude, longitude, date, property_type, new_build_flag="N", tenure_type=None, alpha=0.05):
+    """
+    Predict a price from the national model's coefficients in constant time. A location outside every fitted region uses the nearest region.
+    :param coefficients: the result of fit_national_model or read_national_coefficients
+    :param latitude: the latitude coordinate
+    :param longitude: the longitude coordinate
+    :param date: the date to predict
+    :param property_type: the property type that is being predicted
+    :param new_build_flag: "Y" or "N"
+    :param tenure_type: "F" or "L", if None flats are taken to be leasehold and other types freehold
+    :param alpha: the significance level of the interval
+    :return a dictionary with the same keys as a statsmodels prediction summary frame, as prices. Parameter uncertainty is not known, so the mean interval is NaN
+    """
+    if tenure_type is None:
+        tenure_type = "L" if property_type == "F" else "F"
+    region_km = coefficients.region_km.iloc[0]
+    tile = tuple(int(cell) for cell in tile_of(latitude, longitude, region_km))
+    if tile in coefficients.index:
+        row = coefficients.loc[tile]
+    else:
+        cells = np.array(coefficients.index.tolist())
+        row = coefficients.iloc[int(np.argmin(np.sum((cells - np.array(tile)) ** 2, axis=1)))]
+    national, regional = national_design([property_type], [new_build_flag], [tenure_type], [date])
+    mean = national[0] @ row[national_columns].to_numpy(dtype=float) + regional[0] @ row[regional_columns].to_numpy(dtype=float)
+    z = stats.norm.ppf(1 - alpha / 2)
+    return {
+        "mean": np.exp(mean),
+        "mean_se": np.nan,
+        "mean_ci_lower": np.nan,
+        "mean_ci_upper": np.nan,
+        "obs_ci_lower": np.exp(mean - z * row.sigma),
+        "obs_ci_upper": np.exp(mean + z * row.sigma)}
+
+# ===== Repeat sales index =====
+
+"""
+The repeat sales index measures price change from properties sold more than once, so unlike an average price it is not moved by changes in the mix of properties sold. Each pair of consecutive sales of a property gives log(p₂/p₁) = βₜ₂ - βₜ₁ + ε, where βₜ is the log index of month t (Bailey, Muth and Nourse).
+Properties are identified by a hash of their normalised address, and the database pairs consecutive sales by sorting on it, so pairs are streamed without being held. Each pair touches two months of its region, so the normal equations are accumulated as a count of pairs for each pair of months per region. A national index is fitted from their sum and each region's index is fitted as a deviation from it, shrunk towards zero so regions with few pairs follow the national index. A random walk penalty smooths months with few pairs.
+"""
+repeat_sales_address_columns = ["postcode", "primary_addressable_object_name", "secondary_addressable_object_name", "street"]
+
+def address_key_sql(conn):
+    """
+    :return an SQL expression for a 64 bit hash of a pp_data row's normalised address
+    """
+    address = ", ".join(f"UPPER(TRIM({column}))" for column in repeat_sales_address_columns)
+    return access.hash64_sql(conn, f"CONCAT_WS('|', {address})")
+
+def months_since_1995(dates):
+    dates = pd.to_datetime(pd.Series(dates))
+    return ((dates.dt.year - 1995) * 12 + dates.dt.month - 1).to_numpy()
+
+def region_label(lat_cell, long_cell):
+    return f"{int(lat_cell)},{int(long_cell)}"
+
+def random_walk_penalty(months):
+    """
+    :return the (months,months) matrix P with βᵀPβ the sum of squared changes between consecutive months
+    """
+    penalty = np.zeros((months, months))
+    steps = np.arange(months - 1)
+    np.add.at(penalty, (steps, steps), 1)
+    np.add.at(penalty, (steps + 1, steps + 1), 1)
+    penalty[steps, steps + 1] = penalty[steps + 1, steps] = -1
+    return penalty
+
+def pair_gram(pair_counts):
+    """
+    :param pair_counts: a (months,months) array counting pairs sold first in the row month and again in the column month
+    :return the Gram matrix XᵀX of the pairs' design, with +1 in the second month's column and -1 in the first's
+    """
+    symmetric = pair_counts + pair_counts.T
+    return np.diag(symmetric.sum(axis=0)) - symmetric
+
+@tracing.traced("address.fit_repeat_sales_index")
+def fit_repeat_sales_index(conn, region_km=40, smoothing=10.0, shrinkage=10.0, max_log_return=np.log(10), chunk_size=100000, output=0):
+    """
+    Fit a monthly repeat sales index nationally and for each region by streaming pairs of consecutive sales of the same property
+    Only standard price paid entries (ppd_category_type A) are used, and pairs whose property type changed or whose price changed by more than a factor of exp(max_log_return) are dropped as likely different properties or errors.
+    :param conn: a database connection
+    :param region_km: the approximate width of each region tile in km, as for fit_national_model
+    :param smoothing: the weight of the random walk penalty on month to month changes of the index
+    :param shrinkage: the weight of the penalty on regional deviations from the national index
+    :param max_log_return: the largest absolute log price change kept
+    :param chunk_size: the number of rows fetched at a time
+    :output an integer between 0 and 1 indicating the verbosity of intermediate output
+    :return a DataFrame of log index values with a row for "national" and each region, labelled by region_label, and a column per month, 0 in January 1995. attrs["pairs"] counts the pairs in each region
+    """
+    months = months_since_1995([pd.Timestamp.now()])[0] + 1
+    regions = {}
+    # Pair counts are kept sparse as sorted unique codes of (region, first month, second month) with their counts,
+    # since a dense array over every region and pair of months would not fit in memory nationally
+    pair_codes, pair_counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    moments = np.zeros((0, months))
+    last_month = 0
+
+    window = f"OVER (PARTITION BY {address_key_sql(conn)} ORDER BY date_of_transfer, db_id)"
+    query = f"""
+    SELECT lattitude, longitude, previous_date, date_of_transfer, LN(price) - LN(previous_price)
+    FROM (
+        SELECT postcode_key, price, date_of_transfer, property_type,
+            LAG(price) {window} AS previous_price,
+            LAG(date_of_transfer) {window} AS previous_date,
+            LAG(property_type) {window} AS previous_property_type
+        FROM `pp_data`
+        WHERE price > 0 AND ppd_category_type = 'A'
+    ) AS sales
+    INNER JOIN
+        `postcode_data`
+    ON
+        sales.postcode_key = `postcode_data`.postcode_key
+    WHERE previous_price IS NOT NULL AND property_type = previous_property_type
+        AND ABS(LN(price) - LN(previous_price)) <= {max_log_return}
+    """
+    pairs_seen = 0
+    for rows in access.stream(conn, query, chunk_size):
+        chunk = pd.DataFrame(rows, columns=["latitude", "longitude", "previous_date", "date_of_transfer", "log_return"])
+        first = months_since_1995(chunk.previous_date)
+        second = months_since_1995(chunk.date_of_transfer)
+        # Pairs within a month say nothing about change between months
+        kept = (first < second) & (second < months)
+        first, second, y = first[kept], second[kept], chunk.log_return.to_numpy(dtype=np.float64)[kept]
+
+        lat_cells, long_cells = tile_of(chunk.latitude.to_numpy(dtype=float)[kept], chunk.longitude.to_numpy(dtype=float)[kept], region_km)
+        for tile in set(zip(lat_cells.tolist(), long_cells.tolist())) - set(regions):
+            regions[tile] = len(regions)
+        region = np.fromiter((regions[tile] for tile in zip(lat_cells.tolist(), long_cells.tolist())), dtype=np.int64, count=len(y))
+        if len(regions) > len(moments):
+            moments = np.concatenate((moments, np.zeros((len(regions) - len(moments), months))))
+
+        pair_codes, inverse = np.unique(np.concatenate((pair_codes, (region * months + first) * months + second)), return_inverse=True)
+        pair_counts = np.bincount(inverse, weights=np.concatenate((pair_counts, np.ones(len(y), dtype=np.int64))), minlength=len(pair_codes)).astype(np.int64)
+        np.add.at(moments, (region, second), y)
+        np.add.at(moments, (region, first), -y)
+        last_month = max(last_month, int(second.max(initial=0)))
+        pairs_seen += len(y)
+        if output > 0:
+            print(f"accumulated {pairs_seen} repeat sales pairs in {len(regions)} regions")
+
+    pair_region, pair_first, pair_second = pair_codes // (months * months), pair_codes // months % months, pair_codes % months
+    # Codes are sorted by region first, so each region's pairs are a contiguous run
+    region_bounds = np.searchsorted(pair_region, np.arange(len(regions) + 1))
+    months = last_month + 1
+    moments = moments[:, :months]
+    penalty = smoothing * random_walk_penalty(months)
+
+    def region_pair_matrix(entries):
+        matrix = np.zeros((months, months))
+        np.add.at(matrix, (pair_first[entries], pair_second[entries]), pair_counts[entries])
+        return matrix
+
+    # The index is 0 in the first month, so that month's column is dropped
+    national_gram = pair_gram(region_pair_matrix(slice(None)))
+    national = np.zeros(months)
+    national[1:] = np.linalg.solve((national_gram + penalty)[1:, 1:], moments.sum(axis=0)[1:])
+
+    labels = ["national"]
+    indices = [national]
+    pairs = [pairs_seen]
+    for tile, i in regions.items():
+        entries = slice(region_bounds[i], region_bounds[i + 1])
+        gram = pair_gram(region_pair_matrix(entries))
+        deviation = np.linalg.solve(gram + penalty + shrinkage * np.eye(months), moments[i] - gram @ national)
+        labels.append(region_label(*tile))
+        indices.append(national + deviation - deviation[0])
+        pairs.append(int(pair_counts[entries].sum()))
+    index = pd.DataFrame(indices, index=pd.Index(labels, name="region"), columns=pd.period_range("1995-01", periods=months, freq="M"))
+    index.attrs["region_km"] = region_km
+    index.attrs["pairs"] = pd.Series(pairs, index=index.index)
+    return index
+
+def write_repeat_sales_index(conn, index, table="repeat_sales_index"):
+    """
+    Write a repeat sales index to a table, replacing any already there
+    :param conn: a database connection
+    :param index: the result of fit_repeat_sales_index
+    :param table: the table to write to
+    """
+    access.execute(conn, f"DROP TABLE IF EXISTS `{table}`", f"""CREATE TABLE `{table}` (
+    `region` varchar(16) NOT NULL,
+    `month` char(7) NOT NULL,
+    `log_index` double NOT NULL,
+    `pairs` bigint(20) unsigned NOT NULL,
+    `region_km` double NOT NULL,
+    PRIMARY KEY (`region`, `month`))""")
+    access.execute_many(conn, f"INSERT INTO `{table}` VALUES (%s, %s, %s, %s, %s)", [
+        (region, str(month), float(index.loc[region, month]), int(index.attrs["pairs"][region]), float(index.attrs["region_km"]))
+        for region in index.index for month in index.columns])
+
+def read_repeat_sales_index(conn, table="repeat_sales_index"):
+    """
+    Read a repeat sales index written by write_repeat_sales_index
+    :param conn: a database connection
+    :param table: the table to read from
+    :return a DataFrame as from fit_repeat_sales_index
+    """
+    df = pd.DataFrame(list(access.execute(conn, f"SELECT `region`, `month`, `log_index`, `pairs`, `region_km` FROM `{table}`")), columns=["region", "month", "log_index", "pairs", "region_km"])
+    index = df.pivot(index="region", columns="month", values="log_index")
+    index.columns = pd.PeriodIndex(index.columns, freq="M")
+    index.attrs["region_km"] = float(df.region_km.iloc[0])
+    index.attrs["pairs"] = df.groupby("region").pairs.first().astype(int)
+    return index
+
+def log_index_at(index, latitudes, longitudes, dates):
+    """
+    Look up the log index of each location's region in each date's month. Locations outside every fitted region use the national index, and dates outside the fitted months use the nearest month
+    :param index: the result of fit_repeat_sales_index or read_repeat_sales_index
+    :return an array of log index values
+    """
+    lat_cells, long_cells = tile_of(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float), index.attrs["region_km"])
+    rows = index.index.get_indexer([region_label(*tile) for tile in zip(lat_cells, long_cells)])
+    rows[rows < 0] = index.index.get_loc("national")
+    columns = np.clip(months_since_1995(dates) - months_since_1995([index.columns[0].start_time])[0], 0, len(index.columns) - 1)
+    return index.to_numpy()[rows, columns]
+
+def time_adjust(index, prices, latitudes, longitudes, from_dates, to_dates):
+    """
+    Adjust prices paid on some dates to the prices they would have been on others, by the repeat sales index of their region
+    :param index: the result of fit_repeat_sales_index or read_repeat_sales_index
+    :return an array of adjusted prices
+    """
+    return np.asarray(prices, dtype=float) * np.exp(
+        log_index_at(index, latitudes, longitudes, to_dates) - log_index_at(index, latitudes, longitudes, from_dates))
+
+class RepeatSalesLevel:
+    """
+    A price level for transactions from a repeat sales index, usable as the monthly_average_price_for_type of predict_price_with_features and predict_prices (it is picklable)
+    """
+
+    def __init__(self, index, type_levels=None):
+        """
+        :param index: the result of fit_repeat_sales_index or read_repeat_sales_index
+        :param type_levels: None or a dictionary of each property type's price relative to the others, since the index is shared by all types
+        """
+        self.index = index
+        self.type_levels = type_levels
+
+    def __call__(self, transactions):
+        level = np.exp(log_index_at(self.index, transactions.latitude, transactions.longitude, transactions.date_of_transfer))
+        if self.type_levels is not None:
+            level = level * transactions.property_type.map(self.type_levels).to_numpy(dtype=float)
+        return pd.Series(level, index=transactions.index)
+
+# ===== Comparable sales =====
+
+"""
+Comparable sales are found from a snapshot of every transaction joined to its postcode, written as .npy arrays per property type sorted by date and memory-mapped when loaded, so opening a snapshot reads no data. Each property type's sales are partitioned into buckets of bucket_months, and a KD-tree over a bucket's points on the unit sphere is built the first time a query needs it. A query searches only the buckets overlapping its time window.
+"""
+comparables_columns = {"db_id": np.int64, "days": np.int32, "price": np.int64, "latitude": np.float64, "longitude": np.float64}
+earth_radius_km = 6371.0
+
+def days_since_1995(dates):
+    return ((pd.to_datetime(pd.Series(dates)) - pd.Timestamp("1995-01-01")).dt.days).to_numpy()
+
+def unit_sphere(latitudes, longitudes):
+    """
+    :return an (n,3) array of points on the unit sphere, whose chord distances increase with great circle distance
+    """
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    return np.column_stack((np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)))
+
+@tracing.traced("address.create_comparables_snapshot")
+def create_comparables_snapshot(conn, path, bucket_months=3, chunk_size=100000, output=0):
+    """
+    Write a snapshot of every transaction for a ComparablesIndex, streaming them in chunks straight into memory-mapped arrays
+    :param conn: a database connection
+    :param path: the directory to write the snapshot into
+    :param bucket_months: the number of months in each time bucket
+    :param chunk_size: the number of rows fetched at a time
+    :output an integer between 0 and 1 indicating the verbosity of intermediate output
+    """
+    os.makedirs(path, exist_ok=True)
+    version = data_version(conn)
+    join = """
+    FROM
+        `pp_data`
+    INNER JOIN
+        `postcode_data`
+    ON
+        `pp_data`.postcode_key = `postcode_data`.postcode_key
+    WHERE price > 0
+    """
+    counts = dict(access.execute(conn, f"SELECT property_type, COUNT(*) {join} GROUP BY property_type"))
+    arrays = {
+        property_type: {column: np.lib.format.open_memmap(os.path.join(path, f"{property_type}.{column}.npy"), mode="w+", dtype=dtype, shape=(int(count),))
+                        for column, dtype in comparables_columns.items()}
+        for property_type, count in counts.items()}
+    written = dict.fromkeys(counts, 0)
+    query = f"SELECT property_type, pp_data.db_id, date_of_transfer, price, lattitude, longitude {join} ORDER BY property_type, date_of_transfer"
+    for rows in access.stream(conn, query, chunk_size):
+        chunk = pd.DataFrame(rows, columns=["property_type", "db_id", "date_of_transfer", "price", "latitude", "longitude"])
+        chunk["days"] = days_since_1995(chunk.date_of_transfer)
+        for property_type, sales in chunk.groupby("property_type"):
+            block = slice(written[property_type], written[property_type] + len(sales))
+            for column, dtype in comparables_columns.items():
+                arrays[property_type][column][block] = sales[column].to_numpy(dtype=dtype)
+            written[property_type] += len(sales)
+        if output > 0:
+            print(f"wrote {sum(written.values())} of {sum(counts.values())} transactions")
+    for columns in arrays.values():
+        for array in columns.values():
+            array.flush()
+    with open(os.path.join(path, "snapshot.json"), "w") as file:
+        json.dump({"bucket_months": bucket_months, "counts": {key: int(count) for key, count in counts.items()}, "data_version": [int(v) for v in version]}, file)
+
+class ComparablesIndex:
+    """
+    Finds the k nearest sales of a property type to a location within a time window, from a snapshot written by create_comparables_snapshot
+    """
+
+    def __init__(self, path, price_index=None):
+        """
+        Open a snapshot, memory-mapping its arrays
+        :param path: the directory of the snapshot
+        :param price_index: None or a repeat sales index, as from fit_repeat_sales_index, that comparables' prices are adjusted to the target date by
+        """
+        with open(os.path.join(path, "snapshot.json")) as file:
+            snapshot = json.load(file)
+        self.data_version = tuple(snapshot["data_version"])
+        self.price_index = price_index
+        self.arrays = {
+            property_type: {column: np.load(os.path.join(path, f"{property_type}.{column}.npy"), mmap_mode="r") for column in comparables_columns}
+            for property_type in snapshot["counts"]}
+        # Buckets start on the first day of every bucket_months months from 1995
+        starts = pd.date_range("1995-01-01", pd.Timestamp.now() + pd.DateOffset(years=1), freq=pd.DateOffset(months=snapshot["bucket_months"]))
+        self.bucket_starts = days_since_1995(starts)
+        self.bucket_offsets = {
+            property_type: np.searchsorted(columns["days"], self.bucket_starts)
+            for property_type, columns in self.arrays.items()}
+        self.trees = {}
+
+    def tree(self, property_type, bucket):
+        """
+        The KD-tree of a bucket's sales, built on first use
+        """
+        key = (property_type, bucket)
+        if key not in self.trees:
+            offsets = self.bucket_offsets[property_type]
+            rows = slice(offsets[bucket], offsets[bucket + 1])
+            with tracing.span("comparables.build_tree", rows=rows.stop - rows.start):
+                self.trees[key] = spatial.cKDTree(unit_sphere(self.arrays[property_type]["latitude"][rows], self.arrays[property_type]["longitude"][rows]))
+        return self.trees[key]
+
+    def warm(self):
+        """
+        Build every tree, so no query pays for building one
+        """
+        for property_type in self.arrays:
+            for bucket in range(len(self.bucket_starts) - 1):
+                self.tree(property_type, bucket)
+
+    def comparables(self, latitude, longitude, date, property_type, k=10, window_days=365, max_km=None):
+        """
+        Find the nearest sales to a target sold within a time window before it
+        :param latitude: the latitude coordinate of the target
+        :param longitude: the longitude coordinate of the target
+        :param date: the date of the target
+        :param property_type: the property type of the target, only sales of which are returned
+        :param k: the number of sales to return
+        :param window_days: how many days before date sales may be from
+        :param max_km: if not None, the furthest a sale may be
+        :return a DataFrame of up to k sales, nearest first, with their distance in km and, if the index has a price_index, their price adjusted to date
+        """
+        with tracing.span("comparables.query", property_type=property_type, k=k):
+            if property_type not in self.arrays:
+                raise ValueError(f"no sales of property type {property_type!r} in the snapshot")
+            columns = self.arrays[property_type]
+            offsets = self.bucket_offsets[property_type]
+            last = int(days_since_1995([date])[0])
+            first = last - window_days
+            target = unit_sphere([latitude], [longitude])[0]
+            bound = np.inf if max_km is None else 2 * np.sin(max_km / earth_radius_km / 2)
+
+            distances, rows = [], []
+            buckets = range(
+                max(np.searchsorted(self.bucket_starts, first, side="right") - 1, 0),
+                min(np.searchsorted(self.bucket_starts, last, side="right"), len(self.bucket_starts) - 1))
+            for bucket in buckets:
+                size = offsets[bucket + 1] - offsets[bucket]
+                if size == 0:
+                    continue
+                tree = self.tree(property_type, bucket)
+                # A bucket overlapping the ends of the window may have nearer
+                # sales outside it, so more are fetched until k are inside
+                fetch = min(k, size)
+                while True:
+                    d, i = tree.query(target, k=fetch, distance_upper_bound=bound)
+                    d, i = np.atleast_1d(d), np.atleast_1d(i)
+                    found = i < size
+                    d, i = d[found], i[found] + offsets[bucket]
+                    days = columns["days"][i]
+                    inside = (first <= days) & (days <= last)
+                    if inside.sum() >= k or fetch == size or found.sum() < fetch:
+                        break
+                    fetch = min(fetch * 4, size)
+                distances.append(d[inside])
+                rows.append(i[inside])
+
+            distances = np.concatenate(distances) if len(distances) > 0 else np.zeros(0)
+            rows = np.concatenate(rows).astype(np.int64) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+            nearest = np.argsort(distances, kind="stable")[:k]
+            rows = rows[nearest]
+            sales = pd.DataFrame({
+                "db_id": columns["db_id"][rows],
+                "date_of_transfer": pd.Timestamp("1995-01-01") + pd.to_timedelta(columns["days"][rows], unit="D"),
+                "price": columns["price"][rows],
+                "latitude": columns["latitude"][rows],
+                "longitude": columns["longitude"][rows],
+                "distance_km": 2 * earth_radius_km * np.arcsin(np.minimum(distances[nearest] / 2, 1))})
+            if self.price_index is not None:
+                sales["adjusted_price"] = time_adjust(
+                    self.price_index, sales.price, sales.latitude, sales.longitude, sales.date_of_transfer, [date] * len(sales))
+            return sales
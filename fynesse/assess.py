@@ -1,34 +1,63 @@
 from .config import *
 
-from . import access
+from . import access, tracing
+from .lazy import lazy_module
 
-import osmnx as ox
-import geopandas as gpd
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-import seaborn as sns
-from scipy import stats
-from scipy import spatial
 from collections import Counter
+import hashlib
+import json
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+ox = lazy_module("osmnx")
+gpd = lazy_module("geopandas")
+pd = lazy_module("pandas")
+plt = lazy_module("matplotlib.pyplot")
+colors = lazy_module("matplotlib.colors")
+sns = lazy_module("seaborn")
+stats = lazy_module("scipy.stats")
+spatial = lazy_module("scipy.spatial")
+sparse = lazy_module("scipy.sparse")
+csgraph = lazy_module("scipy.sparse.csgraph")
+geometry = lazy_module("shapely.geometry")
 
 """Place commands in this file to assess the data you have downloaded. How are missing values encoded, how are outliers encoded? What do columns represent, makes rure they are correctly labeled. How is the data indexed. Crete visualisation routines to assess the data (e.g. in bokeh). Ensure that date formats are correct and correctly timezoned."""
 
 # ===== Inspecting database tables and calculating summary stats =====
 
+"""
+Expressions that can be summarised or grouped by besides plain columns, named by a key or written out in full. Anything else is quoted as a column name, so arbitrary SQL cannot be injected
+"""
+summary_expressions = dict(access.strata, month="MONTH(date_of_transfer)", log_price="LN(price)")
+
+
+def summary_expression(expression):
+    """
+    :param expression: a column name, a key of summary_expressions or one of its expressions such as "YEAR(date_of_transfer)"
+    :return the SQL expression
+    """
+    expression = expression.strip()
+    if expression in summary_expressions:
+        return summary_expressions[expression]
+    if expression in summary_expressions.values():
+        return expression
+    return access.identifier(expression)
+
 
 def numcol_summary(conn, table, col):
     """
     Compute summary statics for a numerical column in a table
     :param conn: the database connection
     :param table: the table
-    :param col: the column
+    :param col: the column, or an expression of summary_expressions
     :return a dictionary with four keys - "min", "max", "avg", "stddev" and 3 float values
     """
-    results = access.execute(
+    col = summary_expression(col)
+    results = access.execute_prepared(
         conn,
-        f"SELECT min({col}), max({col}), avg({col}), stddev({col}) FROM `{table}`")[0]
+        f"SELECT min({col}), max({col}), avg({col}), stddev({col}) FROM {access.identifier(table)}")[0]
     return {
         "min": results[0],
         "max": results[1],
@@ -37,8 +66,17 @@ def numcol_summary(conn, table, col):
 
 
 def group_count(conn, table, group_by):
-    return access.execute(
-        conn, f"SELECT {group_by}, COUNT(*) FROM `{table}` GROUP BY {group_by}")
+    """
+    Count the rows of a table in each group
+    :param conn: the database connection
+    :param table: the table
+    :param group_by: a column or expression of summary_expressions, or a sequence or comma separated string of them such as "YEAR(date_of_transfer), property_type"
+    :return a sequence of rows of each group's values and its count
+    """
+    columns = group_by.split(",") if isinstance(group_by, str) else group_by
+    group_by = ", ".join(summary_expression(column) for column in columns)
+    return access.execute_prepared(
+        conn, f"SELECT {group_by}, COUNT(*) FROM {access.identifier(table)} GROUP BY {group_by}")
 
 
 def summarise_table(conn, table, numerical_cols, groupings, display=True):
@@ -66,6 +104,77 @@ def summarise_table(conn, table, numerical_cols, groupings, display=True):
         "numerical_cols": numerical_cols_results,
         "groupings": grouped_results}
 
+
+def logprice_source(bbox=None, date_bound=None, property_type=None, postcode_prefix=None, params=None):
+    """
+    The FROM and WHERE clauses of log-price queries over pp_data, joined to postcode_data only when a filter needs it
+    :param bbox, date_bound, property_type, postcode_prefix: filters, as for access.join_conditions
+    :param params: the list the filters' values are appended to
+    :return the clauses
+    """
+    conditions = ["price > 0"] + access.join_conditions(
+        bbox=bbox, date_bound=date_bound, property_type=property_type, postcode_prefix=postcode_prefix, params=params)
+    source = "`pp_data`"
+    if bbox is not None or postcode_prefix is not None:
+        source += " INNER JOIN `postcode_data` ON `pp_data`.postcode_key = `postcode_data`.postcode_key"
+    return f"FROM {source} WHERE {' AND '.join(conditions)}"
+
+
+def logprice_edges_sql(conn, bins=120, output_query=False, **filters):
+    """
+    Create log-price bin edges spanning every price selected by filters, from their minimum and maximum found in the database
+    :param conn: the database connection
+    :param bins: the number of bins
+    :param output_query: whether the SQL query should be printed
+    :param **filters: bbox, date_bound, property_type or postcode_prefix, as for access.join_conditions
+    :return an array of bins + 1 edges, or the default logprice_edges if no prices are selected
+    """
+    params = []
+    low, high = access.execute_prepared(
+        conn, f"SELECT MIN(LN(price)), MAX(LN(price)) {logprice_source(params=params, **filters)}", params, output_queries=output_query)[0]
+    if low is None:
+        return logprice_edges(bins=bins)
+    low, high = float(low), float(high)
+    return logprice_edges(low, high if high > low else low + 1, bins)
+
+
+def logprice_histograms_sql(conn, edges=None, output_query=False, **filters):
+    """
+    Compute log-price histograms overall and for each property type inside the database, in a single grouped pass over pp_data
+    :param conn: the database connection
+    :param edges: uniformly spaced bin edges for log-price, as returned by logprice_edges. Prices outside the edges are not counted. If None, edges spanning every selected price are found by logprice_edges_sql
+    :param output_query: whether the SQL query should be printed
+    :param **filters: bbox, date_bound, property_type or postcode_prefix, as for access.join_conditions, so the histograms can stand in for those of a filtered frame of transactions
+    :return a dictionary mapping "all" and each of access.property_types to an array of counts per bin, and "edges" to the edges
+    """
+    if edges is None:
+        edges = logprice_edges_sql(conn, output_query=output_query, **filters)
+    low, high, width, bins = float(edges[0]), float(edges[-1]), float(edges[1] - edges[0]), len(edges) - 1
+    # The last bin is closed, so a price on the upper edge is counted
+    params = [low, width, bins - 1]
+    source = logprice_source(params=params, **filters)
+    params += [low, high]
+    results = access.execute_prepared(
+        conn,
+        f"""
+    SELECT property_type, LEAST(FLOOR((LN(price) - %s) / %s), %s) AS bin, COUNT(*)
+    {source} AND LN(price) BETWEEN %s AND %s
+    GROUP BY property_type, bin""",
+        params,
+        output_queries=output_query)
+    histograms = {
+        name: np.zeros(bins, dtype=np.int64) for name in [
+            "all"] + access.property_types}
+    for property_type, b, count in results:
+        b = int(b)
+        if 0 <= b < bins:
+            histograms["all"][b] += count
+            if property_type in histograms:
+                histograms[property_type][b] += count
+    histograms["edges"] = edges
+    return histograms
+
+
 # ===== Open street maps =====
 
 
@@ -95,8 +204,14 @@ def periodic_average(df, period, valcol, datecol):
     :param valcol: the name of the column containing the values to be averaged
     :param datecol: the name of the column containing the dates
     TODO: Maybe make this no longer DataFrame specific if possible
+    If df has a sample_weight column, as from a stratified sample, the average is weighted by it
     """
 
+    if "sample_weight" in df.columns:
+        return df.groupby(
+            df[datecol].dt.to_period(period)).apply(
+            lambda df2: np.average(
+                df2[valcol], weights=df2.sample_weight))
     return df.groupby(
         df[datecol].dt.to_period(period)).apply(
         lambda df2: np.mean(
@@ -168,12 +283,81 @@ def plot_price_trends(transactions, period="Y", axs=None, title=""):
         plt.tight_layout()
 
 
-def plot_logprice_frequency(transactions, axs=None, title=""):
+def logprice_edges(low=np.log(1000), high=np.log(10000000), bins=120):
+    """
+    Create uniformly spaced log-price bin edges, shared between all histograms so they can be computed in one pass
+    :param low: the lower edge (natural log of price)
+    :param high: the upper edge (natural log of price)
+    :param bins: the number of bins
+    :return an array of bins + 1 edges
+    """
+    return np.linspace(low, high, bins + 1)
+
+
+def grouped_histograms(values, groups, group_names, edges):
+    """
+    Compute a histogram of values overall and for each group in a single pass, using shared uniformly spaced bins. Bins are half-open [edge, next edge) except the last, which includes the upper edge, and values outside the edges are dropped.
+    :param values: an array of values
+    :param groups: an array of the group of each value
+    :param group_names: the groups to compute histograms for
+    :param edges: uniformly spaced bin edges
+    :return a dictionary mapping "all" and each of group_names to an array of counts per bin
+    """
+    values = np.asarray(values, dtype=np.float64)
+    low, width, bins = edges[0], edges[1] - edges[0], len(edges) - 1
+    bin_index = np.minimum(np.floor((values - low) / width), bins - 1)
+    in_range = (values >= low) & (values <= edges[-1])
+    bin_index = bin_index[in_range].astype(np.int64)
+
+    # Unknown groups get code -1 and are counted in "all" only
+    codes = pd.Categorical(np.asarray(groups)[in_range], categories=group_names).codes.astype(np.int64)
+    counts = np.bincount((codes + 1) * bins + bin_index,
+                         minlength=(len(group_names) + 1) * bins).reshape(len(group_names) + 1, bins)
+
+    histograms = {"all": counts.sum(axis=0)}
+    for i, name in enumerate(group_names):
+        histograms[name] = counts[i + 1]
+    return histograms
+
+
+def binned_kde(counts, edges, bandwidth=None):
+    """
+    Estimate a Gaussian kernel density from histogram counts by FFT convolution of the counts with a sampled kernel, so the cost depends on the number of bins rather than the number of values
+    :param counts: an array of counts per bin
+    :param edges: uniformly spaced bin edges
+    :param bandwidth: the kernel standard deviation, if None Scott's rule is used as in scipy.stats.gaussian_kde
+    :return an array of density estimates at each bin centre
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum()
+    if n == 0:
+        return np.zeros(len(counts))
+    width = edges[1] - edges[0]
+    centres = (edges[:-1] + edges[1:]) / 2
+    if bandwidth is None:
+        mean = np.sum(counts * centres) / n
+        std = np.sqrt(np.sum(counts * (centres - mean) ** 2) / n)
+        bandwidth = max(std * n ** (-1 / 5), width)
+
+    half = int(np.ceil(4 * bandwidth / width))
+    offsets = np.arange(-half, half + 1) * width
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel /= kernel.sum()
+
+    size = len(counts) + len(kernel) - 1
+    convolved = np.fft.irfft(
+        np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    return np.clip(convolved[half:half + len(counts)], 0, None) / (n * width)
+
+
+def plot_logprice_frequency(transactions, axs=None, title="", edges=None, histograms=None):
     """
     Visualise the frequency of log-prices via a histogram, overall and by property type
-    :param transactions: a GeoDataFrame of transactions
+    :param transactions: a GeoDataFrame of transactions, unused if histograms is given
     :param axs: a sequence of 6 axes that each histogram should be plotted on. If None, a 2x3 plot of figsize (16,16) will be created
     :param title_name: a string to be included at the stand of each plot's title
+    :param edges: the shared log-price bin edges. If None, the edges of histograms are used if it has them, else edges spanning every transaction's price
+    :param histograms: precomputed histograms using edges, such as from logprice_histograms_sql. If None they are computed from transactions
     """
     axs_is_none = axs is None
     if axs_is_none:
@@ -181,15 +365,27 @@ def plot_logprice_frequency(transactions, axs=None, title=""):
         axs = axs.flatten()
     assert (len(axs) == 6)
 
-    sns.histplot(
-        np.log(
-            transactions.price),
-        kde=True,
-        ax=axs[0]).set(
-            title=f"{title} log price: all transactions")
-    for i, property_type in enumerate(access.property_types):
-        sns.histplot(np.log(transactions[transactions.property_type == property_type].price),
-                     kde=True, ax=axs[i + 1]).set(title=f"{title} log price: type {property_type}")
+    if edges is None and histograms is not None:
+        edges = histograms.get("edges")
+    if edges is None:
+        low, high = np.log(transactions.price.min()), np.log(transactions.price.max())
+        edges = logprice_edges(low, high if high > low else low + 1)
+    if histograms is None:
+        histograms = grouped_histograms(
+            np.log(transactions.price),
+            transactions.property_type,
+            access.property_types,
+            edges)
+
+    width = edges[1] - edges[0]
+    centres = (edges[:-1] + edges[1:]) / 2
+    for ax, name in zip(axs, ["all"] + access.property_types):
+        counts = histograms[name]
+        ax.hist(centres, bins=edges, weights=counts, alpha=0.6)
+        ax.plot(centres, binned_kde(counts, edges) * counts.sum() * width)
+        ax.set(title=f"{title} log price: " + (
+            "all transactions" if name == "all" else f"type {name}"),
+            xlabel="log price", ylabel="Count")
     if axs_is_none:
         plt.tight_layout()
 
@@ -201,7 +397,7 @@ def plot_average_price_geographically(transactions, bins_across=20, **kwargs):
     :param bins_across: the number of bins in each dimension
     :param **kwargs: arguments for sns.heatmap
     """
-    options = {"norm": LogNorm()}
+    options = {"norm": colors.LogNorm()}
     options.update(kwargs)
 
     average_prices = stats.binned_statistic_2d(
@@ -238,7 +434,7 @@ def plot_purchase_volume_geographically(
 
 
 def plot_transactions(transactions, **kwargs):
-    options = {"hue_norm": LogNorm(), "alpha": 0.1}
+    options = {"hue_norm": colors.LogNorm(), "alpha": 0.1}
     options.update(kwargs)
     sns.scatterplot(
         x=transactions.longitude,
@@ -333,7 +529,7 @@ def get_smallest_distances_2D(gdf1, gdf2, k=3):
     :param gdf2: a GeoDataFrame
     :return a series of float64 series, containing k smallest distances (or less depending on length of gdf2)
     """
-    # TODO-someday: use ox.distance.shortest path as alternative weighting
+    # Distances along the street graph are in network_closest_distances and network_k_smallest_distances
     ys = gdf2.geometry.to_crs(epsg=3310)
     return gdf1.geometry.to_crs(epsg=3310).map(
         lambda x: ys.distance(x).nsmallest(k))
@@ -363,22 +559,275 @@ def display_every_amenity(bbox, transactions, ax=None, **kwargs):
         plt.tight_layout()
 
 
+def projected_centroids(gdf):
+    """
+    The centroid of each geometry in a GeoDataFrame as projected coordinates in meters, assuming geometry is latitude,longitude
+    :param gdf: a GeoDataFrame
+    :return an (n,2) array of x,y coordinates
+    """
+    centroids = gdf.geometry.to_crs(epsg=3310).centroid
+    return np.column_stack((centroids.x.to_numpy(), centroids.y.to_numpy()))
+
+
+def bbox_edge_distances(bbox, points, samples=64):
+    """
+    The distance from each point to the edge of a bbox, in the projected coordinates of projected_centroids
+    :param bbox: the bbox
+    :param points: an (n,2) array of projected coordinates
+    :param samples: the number of segments each edge is divided into, as edges are curved once projected
+    :return an array of length n, 0 for points outside the bbox
+    """
+    south, north, west, east = bbox
+    steps = np.linspace(0, 1, samples, endpoint=False)
+    longs = np.concatenate((west + (east - west) * steps, np.full(samples, east), east - (east - west) * steps, np.full(samples, west)))
+    lats = np.concatenate((np.full(samples, south), south + (north - south) * steps, np.full(samples, north), north - (north - south) * steps))
+    outline = geometry.Polygon(projected_centroids(gpd.GeoDataFrame(geometry=gpd.points_from_xy(longs, lats, crs="EPSG:4326"))))
+    points = gpd.GeoSeries(gpd.points_from_xy(points[:, 0], points[:, 1]))
+    return np.where(points.within(outline), points.distance(outline.exterior), 0).astype(np.float64)
+
+
+def unique_points(points):
+    """
+    Group identical points, such as transactions sharing a postcode, so work can be done once per group
+    :param points: an (n,2) array of coordinates
+    :return a tuple of the (u,2) array of unique points and an array of length n giving the group of each point
+    """
+    unique, inverse = np.unique(points, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+def k_smallest_distances(xs, ys, k=50):
+    """
+    Calculates an ordered list of the k smallest distances from each point in xs to the points in ys
+    :param xs: an (n,2) array of coordinates
+    :param ys: an (m,2) array of coordinates
+    :param k: the maximium number of distances to be included in each list
+    :return an (n,min(k,m)) array
+    """
+    matrix = spatial.distance.cdist(xs, ys)
+    return np.sort(matrix, axis=1)[:, :k]
+
+
+@tracing.traced("features.get_distances_2D")
 def get_distances_2D(gdf1, gdf2, k=50):
     """
-    Calculates an ordered list of the k closest centroid distances from gdf2 geometry to each point in gdf1 geometry, assuming geometry is latitude,longitude
+    Calculates an ordered list of the k closest centroid distances from gdf2 geometry to each point in gdf1 geometry, assuming geometry is latitude,longitude.
+    Distances are computed once for each unique point of gdf1 and broadcast back to every entry.
     :param gdf1: a GeoDataFrame
     :param gdf2: a GeoDataFrame
     :param k: the maximium number of distances to be included in each list
     """
-    def convert_point_array(arr):
-        return np.array(list(map(lambda point: [point.x, point.y], arr)))
-    xs = convert_point_array(gdf1.geometry.to_crs(epsg=3310).centroid)
-    ys = convert_point_array(gdf2.geometry.to_crs(epsg=3310).centroid)
-    matrix = spatial.distance.cdist(xs, ys)
-    return np.sort(matrix, axis=1)[:, :k]
+    xs, inverse = unique_points(projected_centroids(gdf1))
+    ys = projected_centroids(gdf2)
+    return k_smallest_distances(xs, ys, k)[inverse]
+
+
+# ===== Network distances =====
+
+"""
+Network distances are distances along the street graph. Points are snapped to their nearest graph node and the straight line distance to it is added to the distance along the graph, so a point's distance to a poi is its offset to its node, the shortest path between the nodes and the poi's offset from its node.
+Distances to the closest poi of a tagset come from a single Dijkstra run from a virtual source joined to every poi's node by an edge as long as the poi's offset. Counts within a radius need distances to each poi, so Dijkstra is run from the pois' nodes in chunks, limited to the largest radius.
+"""
+
+
+def network_arrays(graph):
+    """
+    The arrays network distances are computed from, converted from a street graph once and kept in its graph attributes
+    :param graph: a networkx street graph whose edges have a length in meters, as from access.collect_street_graph
+    :return a dictionary with "adjacency", a csr matrix of the shortest edge length between each pair of nodes, "coordinates", an (n,2) array of projected node coordinates, and "tree", a KD-tree of them
+    """
+    if "fynesse_network_arrays" in graph.graph:
+        return graph.graph["fynesse_network_arrays"]
+    nodes = list(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(index[u], index[v], data["length"]) for u, v, data in graph.edges(data=True)], dtype=np.float64).reshape(-1, 3)
+    # Of parallel edges only the shortest is kept
+    edges = edges[np.lexsort((edges[:, 2], edges[:, 1], edges[:, 0]))]
+    _, first = np.unique(edges[:, :2], axis=0, return_index=True)
+    edges = edges[first]
+    adjacency = sparse.csr_matrix((edges[:, 2], (edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64))), shape=(len(nodes), len(nodes)))
+    coordinates = projected_centroids(gpd.GeoDataFrame(geometry=gpd.points_from_xy(
+        [graph.nodes[node]["x"] for node in nodes], [graph.nodes[node]["y"] for node in nodes], crs=graph.graph.get("crs", "EPSG:4326"))))
+    arrays = {"adjacency": adjacency, "coordinates": coordinates, "tree": spatial.cKDTree(coordinates)}
+    graph.graph["fynesse_network_arrays"] = arrays
+    return arrays
+
+
+def nearest_nodes(arrays, points):
+    """
+    Snap points to their nearest graph nodes in one vectorised lookup
+    :param arrays: the result of network_arrays
+    :param points: an (n,2) array of projected coordinates
+    :return a tuple of the distance from each point to its node and the node's index
+    """
+    offsets, nodes = arrays["tree"].query(points)
+    return offsets, nodes
+
+
+def network_closest_distances(arrays, points, poi_points):
+    """
+    Calculates the network distance from each point to its closest poi, in one traversal of the graph
+    :param arrays: the result of network_arrays
+    :param points: an (n,2) array of projected coordinates
+    :param poi_points: an (m,2) array of projected coordinates of pois
+    :return an array of length n, infinite for points not connected to any poi
+    """
+    adjacency = arrays["adjacency"].tocoo()
+    n = adjacency.shape[0]
+    poi_offsets, poi_nodes = nearest_nodes(arrays, poi_points)
+    # Of pois sharing a node only the nearest is joined to the source
+    order = np.lexsort((poi_offsets, poi_nodes))
+    poi_nodes, first = np.unique(poi_nodes[order], return_index=True)
+    poi_offsets = poi_offsets[order][first]
+    # Built in one go rather than by adding matrices, which would drop the
+    # explicit zero edges of pois lying on their nodes
+    graph = sparse.csr_matrix((
+        np.concatenate((adjacency.data, poi_offsets)),
+        (np.concatenate((adjacency.row, np.full(len(poi_nodes), n))), np.concatenate((adjacency.col, poi_nodes)))),
+        shape=(n + 1, n + 1))
+    distances = csgraph.dijkstra(graph, directed=False, indices=n)
+    offsets, nodes = nearest_nodes(arrays, points)
+    return distances[nodes] + offsets
+
+
+def network_k_smallest_distances(arrays, points, poi_points, k=50, limit=np.inf, chunk_size=32):
+    """
+    Calculates an ordered list of the k smallest network distances from each point to the pois, running Dijkstra from the pois in chunks
+    Counts within a radius need the distance to every poi, not just the closest, so a single multi-source Dijkstra, which only yields each node's nearest source, cannot give them. Instead this runs one Dijkstra per poi, chunk_size at a time, each stopped at limit, so the cost is about m limited traversals of the neighbourhood within limit of a poi rather than m full traversals of the graph
+    :param arrays: the result of network_arrays
+    :param points: an (n,2) array of projected coordinates
+    :param poi_points: an (m,2) array of projected coordinates of pois
+    :param k: the maximium number of distances to be included in each list
+    :param limit: distances beyond which are not needed, and are infinite in the result
+    :param chunk_size: the number of pois run at a time, each needs a distance to every graph node in memory
+    :return an (n,min(k,m)) array
+    """
+    poi_offsets, poi_nodes = nearest_nodes(arrays, poi_points)
+    offsets, nodes = nearest_nodes(arrays, points)
+    targets, inverse = np.unique(nodes, return_inverse=True)
+    k = min(k, len(poi_nodes))
+    smallest = np.full((len(targets), k), np.inf)
+    for start in range(0, len(poi_nodes), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        distances = csgraph.dijkstra(arrays["adjacency"], directed=False, indices=poi_nodes[chunk], limit=limit)
+        distances = distances[:, targets].T + poi_offsets[chunk]
+        smallest = np.sort(np.concatenate((smallest, distances), axis=1), axis=1)[:, :k]
+    distances = smallest[inverse.reshape(-1)] + offsets[:, None]
+    distances[distances > limit] = np.inf
+    return np.sort(distances, axis=1)
+
+
+def network_distances(arrays, points, poi_points, limit=None, k=50):
+    """
+    The network counterpart of k_smallest_distances for make_poi_features
+    :param limit: None if only the closest distance is needed, else the largest radius pois are counted within
+    :return an (n,1) array of closest distances if limit is None, else an (n,min(k,m)) array of the k smallest distances, infinite beyond limit except for the closest
+    """
+    closest = network_closest_distances(arrays, points, poi_points)
+    if limit is None:
+        return closest[:, None]
+    distances = network_k_smallest_distances(arrays, points, poi_points, k=k, limit=limit)
+    distances[:, 0] = closest
+    return distances
+
+
+# ===== Sharded features =====
+
+"""
+Large feature builds are sharded into square spatial tiles computed across a process pool. Point and poi coordinates are placed in shared memory once rather than pickled into each task, and each tile only considers the pois within a halo of it.
+A poi closer to a point than the halo always lies within it, so distances within the halo, and any closest distance within it, are exactly those of the serial path. Points with no poi within the halo fall back to every poi, so their closest distances are exact too.
+"""
+
+
+def tile_groups(points, tile_m):
+    """
+    Partition points into square spatial tiles
+    :param points: an (n,2) array of projected coordinates
+    :param tile_m: the width of each tile in meters
+    :return a list of arrays of the indices of the points in each non-empty tile
+    """
+    cells = np.floor((points - points.min(axis=0)) / tile_m).astype(np.int64)
+    _, tile, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    order = np.argsort(tile.reshape(-1), kind="stable")
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+def shard_worker_init(names, shapes):
+    """
+    Attach a pool worker to the shared memory holding point and poi coordinates
+    :param names: the names of the shared memory blocks of the points and of the pois
+    :param shapes: the shapes of the points and pois arrays
+    """
+    global shard_memory, shard_arrays
+    shard_memory = [shared_memory.SharedMemory(name=name) for name in names]
+    shard_arrays = [np.ndarray(shape, dtype=np.float64, buffer=memory.buf) for memory, shape in zip(shard_memory, shapes)]
 
 
-def make_poi_features(bbox, transactions, tagsets, to_make, max_dist=5000):
+def shard_worker(args):
+    """
+    The k smallest distances from the points of one tile to the pois of one tagset within the tile's halo
+    :param args: a tuple of the tagset name, the indices of the tile's points, the start and end of the tagset's pois in the pois array, the halo and k
+    :return a tuple of the tagset name, the indices, the tile's distances, the positions in the tile of points with no poi within the halo and their distances to every poi, or None if there are none
+    """
+    tagset, indices, start, end, halo, k = args
+    points, pois = shard_arrays
+    with tracing.span("features.shard", tagset=tagset, points=len(indices)):
+        xs = points[indices]
+        ys = pois[start:end]
+        near = ys[np.all((ys >= xs.min(axis=0) - halo) & (ys <= xs.max(axis=0) + halo), axis=1)]
+        distances = k_smallest_distances(xs, near, k)
+        far = np.flatnonzero(distances[:, 0] > halo) if len(near) > 0 else np.arange(len(xs))
+        exact = k_smallest_distances(xs[far], ys, k) if len(far) > 0 else None
+    return tagset, indices, distances, far, exact
+
+
+def sharded_k_smallest_distances(points, tagsets, halo, processes, tile_m=5000, k=50):
+    """
+    k_smallest_distances from points to the pois of several tagsets, computed tile by tile across a process pool
+    :param points: an (n,2) array of projected coordinates
+    :param tagsets: a dictionary mapping each tagset name to a tuple of a boolean array of the points needed and an (m,2) array of poi coordinates
+    :param halo: the distance around each tile pois are considered within, at least the largest radius distances are compared to
+    :param processes: the number of processes
+    :param tile_m: the width of each tile in meters
+    :param k: the maximium number of distances to be included in each list
+    :return a dictionary mapping each tagset name to a (needed,min(k,m)) array. Its closest distances and distances within halo equal those of k_smallest_distances, and distances beyond the halo may be infinite
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    pois = np.concatenate([ys for _, ys in tagsets.values()]).astype(np.float64)
+    offsets = np.cumsum([0] + [len(ys) for _, ys in tagsets.values()])
+    tiles = tile_groups(points, tile_m)
+    tasks = []
+    for i, (tagset, (needed, _)) in enumerate(tagsets.items()):
+        for tile in tiles:
+            indices = tile[needed[tile]]
+            if len(indices) > 0:
+                tasks.append((tagset, indices, offsets[i], offsets[i + 1], halo, k))
+    # The largest tiles are started first so no process is left with one at the end
+    tasks.sort(key=lambda task: -len(task[1]))
+    distances = {tagset: np.full((np.sum(needed), min(k, len(ys))), np.inf) for tagset, (needed, ys) in tagsets.items()}
+    rows = {tagset: np.cumsum(needed) - 1 for tagset, (needed, _) in tagsets.items()}
+
+    memory = []
+    try:
+        for array in (points, pois):
+            memory.append(shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)))
+            np.ndarray(array.shape, dtype=np.float64, buffer=memory[-1].buf)[:] = array
+        with multiprocessing.Pool(processes, initializer=shard_worker_init, initargs=([m.name for m in memory], [points.shape, pois.shape])) as pool:
+            for output in pool.imap_unordered(tracing.Remote(shard_worker), tasks):
+                tagset, indices, tile_distances, far, exact = tracing.merge(output)
+                tile_rows = rows[tagset][indices]
+                distances[tagset][tile_rows, :tile_distances.shape[1]] = tile_distances
+                if exact is not None:
+                    distances[tagset][tile_rows[far]] = exact
+    finally:
+        for m in memory:
+            m.close()
+            m.unlink()
+    return distances
+
+
+@tracing.traced("features.make_poi_features")
+def make_poi_features(bbox, transactions, tagsets, to_make, max_dist=5000, store=None, keys=None, snapshot=None, pois=None, distance="euclidean", graph=None, processes=1, tile_km=5):
     """
     Gather all pois in a certain bounding box belonging to tagsets and make features for each transactions based on pois in their vicint
     :param bbox: the bbox in which to gather pois
@@ -386,38 +835,271 @@ def make_poi_features(bbox, transactions, tagsets, to_make, max_dist=5000):
     :param tagsets: a dictionary of tagsets
     :param to_make: a sequence of tuples specifiying the features to create where the first argument is either "closest" or ("count",radius) and the second argument is a tagset. A 'closest' feature is the distance to the nearest poi of the tagset from each transaction. A 'count' feature is the log (number of pois of the tagset within radius meters of each transaction + 1).
     :param max_dist: the maximum distance in meters to clip 'closest' features to
+    :param store: if not None, a FeatureStore that features are looked up in before being computed, and that computed features are added to. A feature is only added if the disk of its closest distance or count radius lies inside bbox, so it does not depend on where pois were collected
+    :param keys: the store key of each transaction, such as postcode or transaction id. If None, the postcode column is used
+    :param snapshot: the version of the POI data, such as the date pois were collected, required if store is not None. Features computed against a different snapshot are not reused
+    :param pois: if not None, a dictionary of already collected pois for some tagsets, which are not downloaded again. Downloaded pois are added to it
+    :param distance: "euclidean" for straight line distances or "network" for distances along the walking street graph
+    :param graph: if not None and distance is "network", the street graph to use rather than collecting the bbox's
+    :param processes: the number of processes to compute euclidean distances with. When greater than 1, transactions are sharded into spatial tiles with identical results
+    :param tile_km: the width in km of each tile when processes is greater than 1
     :return a dataframe with the same index as transactions, and a column for each tuple. a closest
     """
+    if processes > 1 and distance != "euclidean":
+        raise ValueError("only euclidean distances can be sharded across processes, as shortest paths can leave a tile's halo")
+    if store is not None and snapshot is None:
+        raise ValueError("a POI snapshot version is required with a store, so features of re-collected pois are not reused")
+    stored = {}
+    missing = {tagset: np.ones(len(transactions), dtype=bool)
+               for tagset in tagsets}
+    if store is not None:
+        if keys is None:
+            keys = transactions.postcode
+        keys = np.asarray(keys)
+        for tagset in tagsets:
+            missing[tagset][:] = False
+        for (metric, tagset) in to_make:
+            if tagset not in tagsets:
+                continue
+            values = store.get(keys, tagsets[tagset], metric, snapshot, distance)
+            stored[(metric, tagset)] = values
+            missing[tagset] |= np.isnan(values)
+        print(
+            f"found {sum(np.sum(~np.isnan(v)) for v in stored.values())} of {len(stored) * len(transactions)} features in store")
+
+    collected = {} if pois is None else pois
     pois = {}
     print("downloading all tagsets")
     for tagset in tagsets:
-        pois[tagset] = access.collect_pois(bbox, tagsets[tagset])
+        if missing[tagset].any():
+            if tagset not in collected:
+                collected[tagset] = access.collect_pois(bbox, tagsets[tagset])
+            pois[tagset] = collected[tagset]
 
     print("computing distances to transactions")
+    # Transactions sharing a postcode share coordinates, so distances are
+    # computed once per unique point and broadcast back to transactions
+    with tracing.span("features.unique_points", rows=len(transactions)):
+        points, inverse = unique_points(projected_centroids(transactions)) if len(pois) > 0 else (None, None)
+    if distance == "network" and len(pois) > 0:
+        arrays = network_arrays(graph if graph is not None else access.collect_street_graph(bbox))
+    elif distance != "euclidean":
+        raise ValueError("distance should be 'euclidean' or 'network'")
     distances = {}
-    for tagset in tagsets:
+    groups = {}
+    needed = {}
+    for tagset in pois:
         if len(pois[tagset]) == 0:
             print(f"no POIs for {tagset}")
             continue
-        distances[tagset] = get_distances_2D(transactions, pois[tagset])
+        needed[tagset] = np.zeros(len(points), dtype=bool)
+        needed[tagset][inverse[missing[tagset]]] = True
+        print(f"{tagset}: {np.sum(missing[tagset])} transactions at {np.sum(needed[tagset])} unique points")
+        groups[tagset] = (np.cumsum(needed[tagset]) - 1)[inverse[missing[tagset]]]
+    if processes > 1 and len(needed) > 0:
+        halo = max([max_dist] + [metric[1] for metric, _ in to_make if type(metric) == tuple and metric[0] == "count"])
+        with tracing.span("features.sharded_distances", tagsets=len(needed), processes=processes, halo=halo):
+            distances = sharded_k_smallest_distances(
+                points, {tagset: (needed[tagset], projected_centroids(pois[tagset])) for tagset in needed}, halo, processes, tile_m=tile_km * 1000)
+    for tagset in needed:
+        if tagset in distances:
+            continue
+        with tracing.span("features.distances", tagset=tagset, points=int(np.sum(needed[tagset])), pois=len(pois[tagset]), distance=distance):
+            if distance == "network":
+                radii = [metric[1] for metric, t in to_make if t == tagset and type(metric) == tuple and metric[0] == "count"]
+                distances[tagset] = network_distances(
+                    arrays, points[needed[tagset]], projected_centroids(pois[tagset]), limit=max(radii) if len(radii) > 0 else None)
+            else:
+                distances[tagset] = k_smallest_distances(
+                    points[needed[tagset]], projected_centroids(pois[tagset]))
 
     print("calculating features")
+    if store is not None and len(distances) > 0:
+        edges = bbox_edge_distances(bbox, points)
     result = gpd.GeoDataFrame(index=transactions.index)
     for (metric, tagset) in to_make:
         name = f"{metric}-{tagset}"
-        if tagset not in distances:
+        if tagset in distances:
+            computed = None
+            if metric == "closest":
+                computed = distances[tagset][:, 0]
+            if type(metric) == tuple and metric[0] == "count":
+                radius = metric[1]
+                computed = np.sum(distances[tagset] < radius, axis=1)
+            if computed is None:
+                continue
+            computed = computed[groups[tagset]]
+            values = stored.get((metric, tagset), np.full(len(transactions), np.nan))
+            values[missing[tagset]] = computed
+            if store is not None:
+                # Pois are only collected within bbox, so a value is only
+                # stored if the disk it depends on lies inside bbox, where any
+                # other bbox containing the disk would give the same value
+                reach = computed if metric == "closest" else metric[1]
+                inside = reach <= edges[inverse[missing[tagset]]]
+                store.put(keys[missing[tagset]][inside], tagsets[tagset], metric, snapshot, computed[inside], distance)
+        elif (metric, tagset) in stored and not missing[tagset].any():
+            values = stored[(metric, tagset)]
+        else:
             print(f"no distances for {tagset}")
             continue
-        feature = None
         if metric == "closest":
-            feature = np.clip(distances[tagset][:, 0], 50, max_dist)
-        if type(metric) == tuple and metric[0] == "count":
-            radius = metric[1]
-            feature = np.sum(distances[tagset] < radius, axis=1)
-        if feature is not None:
-            result[name] = np.array(feature)
+            values = np.clip(values, 50, max_dist)
+        result[name] = np.array(values)
+    if store is not None:
+        store.flush()
     return result
 
+
+# ===== Feature store =====
+
+def tagset_hash(tagset):
+    """
+    A stable hash of an open street maps tagset, independent of key order
+    :param tagset: the tagset
+    :return a hex digest string
+    """
+    return hashlib.sha1(json.dumps(tagset, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def metric_name(metric):
+    """
+    The name of a make_poi_features metric, either "closest" or ("count",radius)
+    :param metric: the metric
+    :return a string such as "closest" or "count-500"
+    """
+    if type(metric) == tuple:
+        return "-".join(map(str, metric))
+    return str(metric)
+
+
+class FeatureStore:
+    """
+    A persistent store of poi features keyed by (postcode or transaction id, tagset hash, metric, POI snapshot version, distance).
+    Keys are assigned rows in an append-only key file, and each (tagset hash, metric, snapshot) is a memory-mapped float64 column over those rows where NaN marks a feature that has not been computed.
+    Raw 'closest' distances are stored unclipped, so the same features serve any max_dist.
+    """
+
+    def __init__(self, path):
+        """
+        Open or create a feature store
+        :param path: the directory the store is kept in
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows = {}
+        self.keys_file = os.path.join(path, "keys.txt")
+        if os.path.exists(self.keys_file):
+            with open(self.keys_file) as file:
+                for line in file:
+                    self.rows[line.rstrip("\n")] = len(self.rows)
+        self.columns_file = os.path.join(path, "columns.json")
+        self.columns = {}
+        if os.path.exists(self.columns_file):
+            with open(self.columns_file) as file:
+                self.columns = json.load(file)
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column_id(self, tagset, metric, snapshot, distance="euclidean"):
+        column = f"{tagset_hash(tagset)}-{metric_name(metric)}-{snapshot}"
+        # Euclidean columns keep the ids they had before network distances
+        return column if distance == "euclidean" else f"{column}-{distance}"
+
+    def lookup(self, keys, add=False):
+        """
+        Find the row of each key
+        :param keys: a sequence of keys
+        :param add: whether keys not in the store should be assigned new rows
+        :return an array of rows, with -1 for keys not in the store
+        """
+        keys = [str(key) for key in keys]
+        if add:
+            new_keys = [key for key in dict.fromkeys(keys) if key not in self.rows]
+            if len(new_keys) > 0:
+                with open(self.keys_file, "a") as file:
+                    for key in new_keys:
+                        if "\n" in key:
+                            raise ValueError(f"feature store keys cannot contain newlines: {key!r}")
+                        self.rows[key] = len(self.rows)
+                        file.write(key + "\n")
+        return np.fromiter((self.rows.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+
+    def array(self, column):
+        """
+        The memory-mapped array of a column, extended with NaN to cover every key
+        :param column: the column id
+        :return a np.memmap, or None if the column has never been written
+        """
+        if column not in self.columns:
+            return None
+        array = self.arrays.get(column)
+        if array is None or len(array) < len(self.rows):
+            filename = os.path.join(self.path, self.columns[column]["file"])
+            size = os.path.getsize(filename) // 8 if os.path.exists(filename) else 0
+            if size < len(self.rows):
+                if array is not None:
+                    array.flush()
+                with open(filename, "ab") as file:
+                    file.write(np.full(len(self.rows) - size, np.nan).tobytes())
+                size = len(self.rows)
+            array = np.memmap(filename, dtype=np.float64, mode="r+", shape=(size,)) if size > 0 else np.empty(0)
+            self.arrays[column] = array
+        return array
+
+    def get(self, keys, tagset, metric, snapshot, distance="euclidean"):
+        """
+        Gather stored feature values
+        :param keys: a sequence of keys
+        :param tagset: the open street maps tagset
+        :param metric: the make_poi_features metric
+        :param snapshot: the POI snapshot version
+        :param distance: the make_poi_features distance, "euclidean" or "network"
+        :return an array of values, NaN where the feature is not stored
+        """
+        values = np.full(len(keys), np.nan)
+        array = self.array(self.column_id(tagset, metric, snapshot, distance))
+        if array is None:
+            return values
+        rows = self.lookup(keys)
+        found = rows >= 0
+        values[found] = array[rows[found]]
+        return values
+
+    def put(self, keys, tagset, metric, snapshot, values, distance="euclidean"):
+        """
+        Store feature values
+        :param keys: a sequence of keys
+        :param tagset: the open street maps tagset
+        :param metric: the make_poi_features metric
+        :param snapshot: the POI snapshot version
+        :param values: the feature value for each key
+        :param distance: the make_poi_features distance, "euclidean" or "network"
+        """
+        rows = self.lookup(keys, add=True)
+        column = self.column_id(tagset, metric, snapshot, distance)
+        if column not in self.columns:
+            self.columns[column] = {
+                "file": hashlib.sha1(column.encode()).hexdigest()[:16] + ".f64",
+                "tagset": tagset,
+                "metric": metric_name(metric),
+                "snapshot": snapshot,
+                "distance": distance}
+            with open(self.columns_file, "w") as file:
+                json.dump(self.columns, file, default=str)
+        self.array(column)[rows] = np.asarray(values, dtype=np.float64)
+
+    def flush(self):
+        """
+        Write all modified columns to disk
+        """
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+
 def heatmap_correlation(df, title="",find_corrs_for="log_price"):
     cols = len(df.columns)
     corrs = df.corr(numeric_only=True)
@@ -426,22 +1108,294 @@ def heatmap_correlation(df, title="",find_corrs_for="log_price"):
     plt.show()
     return list(absolute_corrs)
 
-def data():
-    """Load the data from access and ensure missing values are correctly encoded as well as indices correct, column names informative, date and times correctly formatted. Return a structured data structure such as a data frame."""
-    df = access.data()
-    raise NotImplementedError
+# ===== Data quality =====
+
+quality_tables = {
+    "dq_progress": """CREATE TABLE IF NOT EXISTS `dq_progress` (
+    `name` varchar(32) COLLATE utf8_bin NOT NULL PRIMARY KEY,
+    `last_db_id` bigint(20) unsigned NOT NULL,
+    `rows_seen` bigint(20) unsigned NOT NULL,
+    `finished` boolean NOT NULL
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+    "dq_district_histogram": """CREATE TABLE IF NOT EXISTS `dq_district_histogram` (
+    `district` varchar(64) COLLATE utf8_bin NOT NULL,
+    `bin` int NOT NULL,
+    `count` bigint(20) unsigned NOT NULL,
+    PRIMARY KEY (`district`, `bin`)
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+    "dq_district_stats": """CREATE TABLE IF NOT EXISTS `dq_district_stats` (
+    `district` varchar(64) COLLATE utf8_bin NOT NULL PRIMARY KEY,
+    `n` bigint(20) unsigned NOT NULL,
+    `median_log_price` double NOT NULL,
+    `mad_log_price` double NOT NULL
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+    "dq_issues": """CREATE TABLE IF NOT EXISTS `dq_issues` (
+    `db_id` bigint(20) unsigned NOT NULL,
+    `issue` varchar(32) COLLATE utf8_bin NOT NULL,
+    `detail` tinytext COLLATE utf8_bin,
+    PRIMARY KEY (`db_id`, `issue`)
+    ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+}
+
+"""
+The edges used for per-district log-price histograms, wide enough that almost every price lands in a bin
+"""
+quality_edges = logprice_edges(low=0, high=np.log(1e9), bins=400)
+
+
+def create_quality_tables(conn, restart=False):
+    """
+    Create the data quality summary tables if they don't exist
+    :param conn: database connection
+    :param restart: if True, existing summary tables are dropped first
+    """
+    if restart:
+        access.execute(conn, *[f"DROP TABLE IF EXISTS `{table}`" for table in quality_tables])
+    access.execute(conn, *quality_tables.values())
+
 
+def binned_median_and_mad(counts, edges):
+    """
+    The median and median absolute deviation of values summarised by a histogram, to the resolution of its bins
+    :param counts: an array of counts per bin
+    :param edges: the bin edges
+    :return a tuple of the median and mad
+    """
+    centres = (edges[:-1] + edges[1:]) / 2
 
-def query(data):
-    """Request user input for some aspect of the data."""
-    raise NotImplementedError
+    def weighted_median(values, weights):
+        order = np.argsort(values)
+        cumulative = np.cumsum(weights[order])
+        return values[order][np.searchsorted(cumulative, cumulative[-1] / 2)]
+
+    median = weighted_median(centres, counts)
+    mad = weighted_median(np.abs(centres - median), counts)
+    return median, max(mad, edges[1] - edges[0])
+
+
+class QualitySpill:
+    """
+    Hashes of transaction_unique_identifier and the db_id they were seen in, spilled to disk in partitions by hash so duplicates can be found one partition at a time in bounded memory
+    """
+    dtype = np.dtype([("hash", np.uint64), ("db_id", np.uint64)])
+
+    def __init__(self, path, partitions=64):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.partitions = partitions
+
+    def filename(self, partition):
+        return os.path.join(self.path, f"ids-{partition:03d}.bin")
+
+    def clear(self):
+        for partition in range(self.partitions):
+            if os.path.exists(self.filename(partition)):
+                os.remove(self.filename(partition))
+
+    def add(self, hashes, db_ids):
+        records = np.empty(len(hashes), dtype=self.dtype)
+        records["hash"] = hashes
+        records["db_id"] = db_ids
+        partition_of = records["hash"] % self.partitions
+        for partition in np.unique(partition_of):
+            with open(self.filename(partition), "ab") as file:
+                file.write(records[partition_of == partition].tobytes())
+
+    def duplicates(self):
+        """
+        :return a generator of arrays of db_ids whose identifier was seen more than once
+        """
+        for partition in range(self.partitions):
+            if not os.path.exists(self.filename(partition)):
+                continue
+            # Rows streamed again after resuming from a checkpoint are
+            # dropped by taking unique (hash, db_id) records
+            records = np.unique(np.fromfile(self.filename(partition), dtype=self.dtype))
+            hashes, counts = np.unique(records["hash"], return_counts=True)
+            duplicated = np.isin(records["hash"], hashes[counts > 1])
+            if duplicated.any():
+                yield records["db_id"][duplicated]
+
+
+@tracing.traced("assess.profile_quality")
+def profile_quality(conn, work_dir="dq_work", chunk_size=100000, checkpoint_every=10, outlier_threshold=5, restart=False, display=True):
+    """
+    Stream every pp_data row with whether its postcode is in postcode_data, in db_id order, and check its quality in a single pass with bounded memory. Invalid dates, non-positive prices and postcodes missing from postcode_data (which inner_join silently drops) are recorded in dq_issues as they are seen. Per-district log-price histograms and hashes of transaction_unique_identifier are accumulated; at the end duplicate identifiers are found one spilled partition at a time, and robust per-district median and MAD give price outliers, flagged by the database.
+    Progress and histograms are checkpointed into the summary tables every checkpoint_every chunks, so an interrupted profile resumes from the last checkpoint.
+    :param conn: database connection
+    :param work_dir: the directory identifier hashes are spilled into
+    :param chunk_size: the number of rows fetched at a time
+    :param checkpoint_every: the number of chunks between checkpoints
+    :param outlier_threshold: the number of scaled MADs from the district median at which a log price is an outlier
+    :param restart: if True, any previous profile is discarded
+    :param display: whether progress should be printed
+    """
+    create_quality_tables(conn, restart=restart)
+    spill = QualitySpill(work_dir)
+
+    progress = access.execute(conn, "SELECT last_db_id, rows_seen, finished FROM `dq_progress` WHERE name = 'pp_data'")
+    last_db_id, rows_seen, finished = progress[0] if len(progress) > 0 else (0, 0, False)
+    if finished:
+        if display:
+            print(f"quality profile already finished after {rows_seen} rows")
+        return
+    if last_db_id == 0:
+        spill.clear()
+
+    districts = []
+    histograms = np.zeros((0, len(quality_edges) - 1), dtype=np.int64)
+    saved = access.execute(conn, "SELECT district, bin, count FROM `dq_district_histogram`")
+    if len(saved) > 0:
+        districts = sorted(set(row[0] for row in saved))
+        histograms = np.zeros((len(districts), len(quality_edges) - 1), dtype=np.int64)
+        index = {district: i for i, district in enumerate(districts)}
+        for district, b, count in saved:
+            histograms[index[district], b] = count
+    if display and last_db_id > 0:
+        print(f"resuming quality profile after db_id {last_db_id} ({rows_seen} rows)")
+
+    def checkpoint(finished=False):
+        # Histograms and progress are committed together so they always agree
+        rows = [(district, int(b), int(histograms[i, b]))
+                for i, district in enumerate(districts) for b in np.flatnonzero(histograms[i])]
+        access.execute_atomically(conn, [
+            ("DELETE FROM `dq_district_histogram`", None),
+            ("INSERT INTO `dq_district_histogram` VALUES (%s, %s, %s)", rows),
+            (f"REPLACE INTO `dq_progress` VALUES ('pp_data', {last_db_id}, {rows_seen}, {finished})", None)])
+
+    chunks = 0
+    while True:
+        rows = access.execute(conn, f"""
+    SELECT db_id, transaction_unique_identifier, price, date_of_transfer, postcode, district,
+        NOT EXISTS (SELECT 1 FROM `postcode_data` WHERE `postcode_data`.postcode_key = `pp_data`.postcode_key) AS unmatched
+    FROM `pp_data`
+    WHERE db_id > {last_db_id}
+    ORDER BY db_id
+    LIMIT {chunk_size}""")
+        if len(rows) == 0:
+            break
+        chunk = pd.DataFrame(list(rows), columns=[
+            "db_id", "identifier", "price", "date_of_transfer", "postcode", "district", "unmatched"])
+
+        issues = []
+        dates = pd.to_datetime(chunk.date_of_transfer, errors="coerce")
+        invalid_dates = dates.isna() | (dates < pd.Timestamp("1995-01-01")) | (dates > pd.Timestamp.now())
+        for db_id, date in zip(chunk.db_id[invalid_dates], chunk.date_of_transfer[invalid_dates]):
+            issues.append((int(db_id), "invalid_date", str(date)))
+        for db_id, postcode in zip(chunk.db_id[chunk.unmatched == 1], chunk.postcode[chunk.unmatched == 1]):
+            issues.append((int(db_id), "unmatched_postcode", postcode))
+        for db_id, price in zip(chunk.db_id[chunk.price <= 0], chunk.price[chunk.price <= 0]):
+            issues.append((int(db_id), "invalid_price", str(price)))
+        access.execute_many(conn, "INSERT IGNORE INTO `dq_issues` VALUES (%s, %s, %s)", issues)
+
+        new_districts = sorted(set(chunk.district) - set(districts))
+        if len(new_districts) > 0:
+            districts = districts + new_districts
+            histograms = np.vstack((histograms, np.zeros((len(new_districts), histograms.shape[1]), dtype=np.int64)))
+        positive = chunk.price > 0
+        chunk_histograms = grouped_histograms(
+            np.log(chunk.price[positive].to_numpy(dtype=np.float64)),
+            chunk.district[positive], districts, quality_edges)
+        histograms += np.array([chunk_histograms[district] for district in districts])
+
+        spill.add(pd.util.hash_array(chunk.identifier.to_numpy(dtype=object)), chunk.db_id.to_numpy(dtype=np.uint64))
+
+        last_db_id = int(chunk.db_id.iloc[-1])
+        rows_seen += len(chunk)
+        chunks += 1
+        if chunks % checkpoint_every == 0:
+            checkpoint()
+            if display:
+                print(f"checked {rows_seen} rows")
+    checkpoint()
+
+    for db_ids in spill.duplicates():
+        access.execute_many(
+            conn,
+            "INSERT IGNORE INTO `dq_issues` VALUES (%s, 'duplicate_identifier', NULL)",
+            [(int(db_id),) for db_id in db_ids])
+
+    stats = []
+    for i, district in enumerate(districts):
+        if histograms[i].sum() > 0:
+            median, mad = binned_median_and_mad(histograms[i], quality_edges)
+            stats.append((district, int(histograms[i].sum()), float(median), float(mad)))
+    access.execute(conn, "DELETE FROM `dq_district_stats`")
+    access.execute_many(conn, "INSERT INTO `dq_district_stats` VALUES (%s, %s, %s, %s)", stats)
+    # 1.4826 scales the MAD to a standard deviation for normal data
+    access.execute(conn, f"""
+    INSERT IGNORE INTO `dq_issues`
+    SELECT db_id, 'price_outlier', CONCAT('log price ', ROUND(LN(price), 3), ', district median ', ROUND(median_log_price, 3))
+    FROM `pp_data` INNER JOIN `dq_district_stats` ON `pp_data`.district = `dq_district_stats`.district
+    WHERE price > 0 AND ABS(LN(price) - median_log_price) > {outlier_threshold} * 1.4826 * mad_log_price""")
+    checkpoint(finished=True)
+    if display:
+        print(f"quality profile finished after {rows_seen} rows")
+
+
+def data(conn, **kwargs):
+    """Load the data from access and ensure missing values are correctly encoded as well as indices correct, column names informative, date and times correctly formatted. Return a structured data structure such as a data frame.
+    Runs (or resumes) the data quality profile of pp_data and postcode_data, and returns its summary.
+    :param conn: database connection
+    :param **kwargs: arguments for profile_quality
+    :return a dictionary with the connection, the number of rows profiled, a DataFrame of issue counts and a DataFrame of district statistics
+    """
+    profile_quality(conn, **kwargs)
+    rows_seen = access.execute(conn, "SELECT rows_seen FROM `dq_progress` WHERE name = 'pp_data'")[0][0]
+    issue_counts = pd.DataFrame(
+        list(access.execute(conn, "SELECT issue, COUNT(*) FROM `dq_issues` GROUP BY issue")),
+        columns=["issue", "count"]).set_index("issue")
+    district_stats = pd.DataFrame(
+        list(access.execute(conn, "SELECT district, n, median_log_price, mad_log_price FROM `dq_district_stats`")),
+        columns=["district", "n", "median_log_price", "mad_log_price"]).set_index("district")
+    return {
+        "conn": conn,
+        "rows": rows_seen,
+        "issue_counts": issue_counts,
+        "district_stats": district_stats}
+
+
+def query(data, issue=None, limit=1000):
+    """Request user input for some aspect of the data.
+    Fetch the pp_data rows flagged with an issue by the quality profile
+    :param data: the result of data
+    :param issue: the issue to fetch, one of the index of data["issue_counts"], if None the user is asked
+    :param limit: the maximum number of rows to fetch
+    :return a DataFrame of flagged rows with the issue detail
+    """
+    if issue is None:
+        issue = input(f"Which issue? {', '.join(data['issue_counts'].index)}").strip()
+    if issue not in data["issue_counts"].index:
+        raise ValueError(f"{issue!r} is not an issue found by the quality profile")
+    rows = access.execute_prepared(data["conn"], """
+    SELECT `pp_data`.*, detail
+    FROM `dq_issues` INNER JOIN `pp_data` ON `dq_issues`.db_id = `pp_data`.db_id
+    WHERE issue = %s
+    LIMIT %s""", (issue, int(limit)))
+    columns = access.table_columns(data["conn"], "pp_data") + ["detail"]
+    return pd.DataFrame(list(rows), columns=columns)
 
 
 def view(data):
-    """Provide a view of the data that allows the user to verify some aspect of its quality."""
-    raise NotImplementedError
+    """Provide a view of the data that allows the user to verify some aspect of its quality.
+    Prints the issue counts of the quality profile and plots the robust log-price statistics of each district
+    :param data: the result of data
+    """
+    print(f"{data['rows']} rows profiled")
+    print(data["issue_counts"].assign(fraction=data["issue_counts"]["count"] / max(data["rows"], 1)))
+    stats = data["district_stats"].sort_values("median_log_price")
+    fig, ax = plt.subplots(figsize=(16, 6))
+    ax.errorbar(
+        np.arange(len(stats)), stats.median_log_price, yerr=1.4826 * stats.mad_log_price, fmt=".")
+    ax.set(title="district median log price ± scaled MAD", xlabel="district (by median)", ylabel="log price")
+    plt.tight_layout()
 
 
 def labelled(data):
-    """Provide a labelled set of data ready for supervised learning."""
-    raise NotImplementedError
+    """Provide a labelled set of data ready for supervised learning.
+    :param data: the result of data
+    :return a DataFrame indexed by pp_data db_id with a boolean column for each issue found by the quality profile
+    """
+    rows = access.execute(data["conn"], "SELECT db_id, issue FROM `dq_issues`")
+    issues = pd.DataFrame(list(rows), columns=["db_id", "issue"])
+    return pd.crosstab(issues.db_id, issues.issue).astype(bool)
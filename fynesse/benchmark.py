@@ -0,0 +1,390 @@
+# This file contains an offline benchmark suite for the access, assess and address pipeline
+
+"""Generate synthetic price paid and postcode data at a configurable scale, load it into a local benchmark database and time the main stages of the pipeline, recording results against the current git commit so regressions can be compared between commits."""
+
+from . import access, assess, address
+
+import csv
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pymysql
+
+# ===== Synthetic data =====
+
+"""
+Postcode areas with an approximate centre, relative price level and relative number of postcodes, used to place synthetic postcodes and price their sales
+"""
+synthetic_areas = {
+    "E": ((51.52, -0.05), 1.6, 3.0),
+    "SW": ((51.47, -0.17), 2.2, 3.0),
+    "N": ((51.57, -0.11), 1.7, 2.5),
+    "CB": ((52.20, 0.12), 1.4, 1.5),
+    "OX": ((51.75, -1.25), 1.4, 1.5),
+    "B": ((52.48, -1.90), 0.8, 3.0),
+    "M": ((53.48, -2.24), 0.8, 3.0),
+    "LS": ((53.80, -1.55), 0.8, 2.0),
+    "BS": ((51.45, -2.59), 1.1, 2.0),
+    "NE": ((54.97, -1.61), 0.6, 2.0),
+    "CF": ((51.48, -3.18), 0.7, 1.5),
+    "EX": ((50.72, -3.53), 1.0, 1.0),
+    "YO": ((53.96, -1.08), 0.9, 1.0),
+    "LN": ((53.23, -0.54), 0.6, 0.7),
+    "TR": ((50.26, -5.05), 1.0, 0.5),
+}
+incode_letters = np.array(list("ABDEFGHJLNPQRSTUWXYZ"))
+type_levels = {"D": 1.6, "S": 1.0, "T": 0.85, "F": 0.75, "O": 1.2}
+type_shares = {"D": 0.23, "S": 0.27, "T": 0.29, "F": 0.19, "O": 0.02}
+
+
+def synthetic_postcodes(n, seed=0):
+    """
+    Generate synthetic postcodes clustered around the synthetic areas
+    :param n: the number of postcodes
+    :param seed: the random seed
+    :return a DataFrame with the columns of postcode_data, excluding db_id
+    """
+    rng = np.random.default_rng(seed)
+    areas = list(synthetic_areas)
+    weights = np.array([synthetic_areas[area][2] for area in areas])
+    area = np.array(areas)[rng.choice(len(areas), n, p=weights / weights.sum())]
+    centres = np.array([synthetic_areas[a][0] for a in area])
+    district = rng.integers(1, 20, n)
+    # Districts are offset from the area centre and postcodes spread around them
+    district_angle = district * 2.399
+    district_radius = 0.02 * np.sqrt(district)
+    latitude = centres[:, 0] + district_radius * np.sin(district_angle) + rng.normal(0, 0.01, n)
+    longitude = centres[:, 1] + district_radius * np.cos(district_angle) * 1.6 + rng.normal(0, 0.016, n)
+
+    outcode = np.char.add(area.astype(str), district.astype(str))
+    sector = rng.integers(0, 10, n).astype(str)
+    unit = np.char.add(rng.choice(incode_letters, n), rng.choice(incode_letters, n))
+    incode = np.char.add(sector, unit)
+    postcode = np.char.add(np.char.add(outcode, " "), incode)
+    df = pd.DataFrame({
+        "postcode": postcode,
+        "status": "live",
+        "usertype": "small",
+        "easting": 0,
+        "northing": 0,
+        "positional_quality_indicator": 1,
+        "country": np.where(area == "CF", "Wales", "England"),
+        "lattitude": np.round(latitude, 8),
+        "longitude": np.round(longitude, 8),
+        "postcode_no_space": np.char.add(outcode, incode),
+        "postcode_fixed_width_seven": np.char.add(np.char.ljust(outcode, 4), incode),
+        "postcode_fixed_width_eight": np.char.add(np.char.add(np.char.ljust(outcode, 4), " "), incode),
+        "postcode_area": area,
+        "postcode_district": outcode,
+        "postcode_sector": np.char.add(np.char.add(outcode, " "), sector),
+        "outcode": outcode,
+        "incode": incode})
+    return df.drop_duplicates("postcode").reset_index(drop=True)
+
+
+def synthetic_transactions(postcodes, n, seed=0, first_year=1995, last_year=2022):
+    """
+    Generate synthetic price paid transactions for postcodes. Sales per postcode are heavy tailed, as in the real data, and prices depend on the area, property type and year
+    :param postcodes: a DataFrame as from synthetic_postcodes
+    :param n: the number of transactions
+    :param seed: the random seed
+    :return a DataFrame with the columns of pp_data, excluding db_id
+    """
+    rng = np.random.default_rng(seed)
+    popularity = rng.lognormal(0, 1.2, len(postcodes))
+    chosen = rng.choice(len(postcodes), n, p=popularity / popularity.sum())
+    types = np.array(list(type_shares))
+    property_type = rng.choice(types, n, p=np.array(list(type_shares.values())))
+    start = np.datetime64(f"{first_year}-01-01")
+    days = (np.datetime64(f"{last_year + 1}-01-01") - start).astype(int)
+    date = start + rng.integers(0, days, n).astype("timedelta64[D]")
+    years = (date - start).astype(int) / 365.25
+
+    area = postcodes.postcode_area.to_numpy()[chosen]
+    area_level = np.array([synthetic_areas[a][1] for a in area])
+    type_level = np.array([type_levels[t] for t in property_type])
+    price = 60000 * area_level * type_level * np.exp(0.055 * years + rng.normal(0, 0.35, n))
+
+    return pd.DataFrame({
+        "transaction_unique_identifier": [f"{{{i:08X}-0000-0000-0000-{seed:012X}}}" for i in range(n)],
+        "price": price.astype(np.int64),
+        "date_of_transfer": pd.to_datetime(date).strftime("%Y-%m-%d 00:00"),
+        "postcode": postcodes.postcode.to_numpy()[chosen],
+        "property_type": property_type,
+        "new_build_flag": np.where(rng.random(n) < 0.1, "Y", "N"),
+        "tenure_type": np.where(property_type == "F", "L", "F"),
+        "primary_addressable_object_name": rng.integers(1, 200, n).astype(str),
+        "secondary_addressable_object_name": "",
+        "street": np.char.add("STREET ", rng.integers(0, 50, n).astype(str)),
+        "locality": "",
+        "town_city": area,
+        "district": postcodes.postcode_district.to_numpy()[chosen],
+        "county": area,
+        "ppd_category_type": "A",
+        "record_status": "A"})
+
+
+def write_synthetic_files(directory, transactions, postcodes=None, seed=0, chunk_size=1000000):
+    """
+    Write synthetic pp_data and postcode_data CSV files in the formats load_file expects, in chunks so large scales fit in memory
+    :param directory: the directory to write into
+    :param transactions: the number of transactions, from 1000 to tens of millions
+    :param postcodes: the number of postcodes, if None one for every 15 transactions
+    :param seed: the random seed
+    :param chunk_size: the number of transactions generated at a time
+    :return a tuple of the pp_data file and the postcode_data file
+    """
+    os.makedirs(directory, exist_ok=True)
+    if postcodes is None:
+        postcodes = max(transactions // 15, 100)
+    postcode_df = synthetic_postcodes(postcodes, seed)
+    postcode_file = os.path.join(directory, f"synthetic-postcodes-{postcodes}-{seed}.csv")
+    postcode_df.to_csv(postcode_file, header=False, index=False)
+
+    pp_file = os.path.join(directory, f"synthetic-pp-{transactions}-{seed}.csv")
+    with open(pp_file, "w") as file:
+        for i, start in enumerate(range(0, transactions, chunk_size)):
+            chunk = synthetic_transactions(postcode_df, min(chunk_size, transactions - start), seed=seed * 1000003 + i)
+            chunk.transaction_unique_identifier = [f"{{{start + j:08X}-0000-0000-0000-{seed:012X}}}" for j in range(len(chunk))]
+            chunk.to_csv(file, header=False, index=False, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    return pp_file, postcode_file
+
+
+def synthetic_pois(bbox, n, seed=0):
+    """
+    Generate uniformly placed synthetic pois
+    :param bbox: the bbox to place them in
+    :param n: the number of pois
+    :param seed: the random seed
+    :return a GeoDataFrame of points
+    """
+    rng = np.random.default_rng(seed)
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(
+        rng.uniform(bbox[2], bbox[3], n), rng.uniform(bbox[0], bbox[1], n), crs="EPSG:4326"))
+
+
+# ===== Timing =====
+
+def timed(function, *args, **kwargs):
+    """
+    :return a tuple of the seconds function took and its result
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def connect_benchmark_database(user, password, host, port=3306, database="property_prices_benchmark"):
+    """
+    Connect to a dedicated benchmark database, creating it if needed. Benchmarks replace its pp_data and postcode_data tables
+    """
+    conn = pymysql.connect(user=user, passwd=password, host=host, port=port, local_infile=1)
+    access.execute(conn, f"CREATE DATABASE IF NOT EXISTS `{database}` DEFAULT CHARACTER SET utf8 COLLATE utf8_bin")
+    conn.select_db(database)
+    return conn
+
+
+def connect_benchmark_duckdb(path="benchmark_data/benchmark.duckdb"):
+    """
+    Connect to an embedded DuckDB benchmark database, so the benchmarks can run without a database server
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return access.connect_duckdb(path)
+
+
+def benchmark_load(conn, pp_file, postcode_file):
+    """
+    Time creating the tables, loading the synthetic files and indexing them
+    """
+    results = {}
+    access.create_pricepaid_table(conn)
+    access.create_postcode_table(conn)
+    results["load_file.pp_data"], _ = timed(access.load_file, conn, "pp_data", pp_file, enclosed_by_double_quote=True)
+    results["load_file.postcode_data"], _ = timed(access.load_file, conn, "postcode_data", postcode_file)
+    results["create_pricepaid_indicies"], _ = timed(access.create_pricepaid_indicies, conn)
+    return results
+
+
+def benchmark_inner_join(conn, centre, sizes_km=(1, 2, 5, 10, 20)):
+    """
+    Time inner_join over square bboxes of increasing size around a centre
+    """
+    results = {}
+    for size in sizes_km:
+        seconds, transactions = timed(access.inner_join, conn, access.km_bbox(centre, size, size))
+        results[f"inner_join.{size}km"] = seconds
+        results[f"inner_join.{size}km.rows"] = len(transactions)
+    return results
+
+
+benchmark_tagsets = {"school": {"amenity": "school"}, "shop": {"shop": True}}
+benchmark_features = [("closest", "school"), (("count", 1000), "school"), ("closest", "shop"), (("count", 500), "shop")]
+
+
+def benchmark_pois(bbox, seed=0):
+    return {"school": synthetic_pois(bbox, 200, seed), "shop": synthetic_pois(bbox, 2000, seed + 1)}
+
+
+def benchmark_make_poi_features(conn, centre, size_km=10, seed=0, processes=None):
+    """
+    Time make_poi_features for the transactions of a bbox against synthetic pois, serially and sharded across processes
+    :param processes: the number of processes to time the sharded path with, if None os.cpu_count() is used
+    """
+    bbox = access.km_bbox(centre, size_km, size_km)
+    transactions = access.inner_join(conn, bbox)
+    pois = benchmark_pois(bbox, seed)
+    seconds, _ = timed(assess.make_poi_features, bbox, transactions, benchmark_tagsets, benchmark_features, pois=pois)
+    results = {f"make_poi_features.{size_km}km": seconds, f"make_poi_features.{size_km}km.rows": len(transactions)}
+    processes = processes or os.cpu_count()
+    if processes > 1:
+        seconds, _ = timed(assess.make_poi_features, bbox, transactions, benchmark_tagsets, benchmark_features, pois=pois, processes=processes, tile_km=2)
+        results[f"make_poi_features.{size_km}km.processes{processes}"] = seconds
+    return results
+
+
+def type_average_price(transactions):
+    """
+    A stand in for monthly_average_price_for_type using the synthetic data's price model
+    """
+    years = (transactions.date_of_transfer - pd.Timestamp("1995-01-01")).dt.days / 365.25
+    return 60000 * transactions.property_type.map(type_levels).astype(float) * np.exp(0.055 * years)
+
+
+def benchmark_prediction(conn, centre, date="2022-06-01", property_type="S", seed=0):
+    """
+    Time an end to end prediction against synthetic pois
+    """
+    pois = benchmark_pois(access.km_bbox(centre, 40, 40), seed)
+    seconds, _ = timed(
+        address.predict_price_with_features, conn, centre[0], centre[1], pd.Timestamp(date), property_type,
+        benchmark_features, benchmark_tagsets, type_average_price, pois=pois)
+    return {"predict_price_with_features": seconds}
+
+
+# ===== Import time =====
+
+"""
+The most each module may take to import in a fresh interpreter, in seconds. None of them may import a heavy_module, which should load only when a function that needs it is called
+"""
+import_budgets = {
+    "fynesse": 0.05,
+    "fynesse.access": 0.5,
+    "fynesse.assess": 0.5,
+    "fynesse.address": 0.5}
+heavy_modules = ["geopandas", "matplotlib", "osmnx", "pandas", "scipy", "seaborn", "shapely", "sklearn", "statsmodels"]
+
+
+def import_time(module, repeats=5):
+    """
+    Time importing a module in fresh interpreters
+    :param module: the module
+    :param repeats: the number of interpreters, the fastest of which is taken
+    :return a tuple of the seconds the import took and the heavy_modules it loaded
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {heavy_modules!r} if m in sys.modules))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout.split("\n")
+            for _ in range(repeats)]
+    return min(float(run[0]) for run in runs), [m for m in runs[0][1].split(",") if m != ""]
+
+
+def benchmark_import(budgets=import_budgets, repeats=5):
+    """
+    Time importing each module with a budget
+    :return a tuple of a dictionary of results and a list of the budgets exceeded
+    """
+    results = {}
+    exceeded = []
+    for module, budget in budgets.items():
+        seconds, loaded = import_time(module, repeats)
+        results[f"import.{module}"] = seconds
+        if seconds > budget:
+            exceeded.append(f"importing {module} took {seconds:.3f}s, over its budget of {budget}s")
+        if len(loaded) > 0:
+            exceeded.append(f"importing {module} loaded {', '.join(loaded)}")
+    return results, exceeded
+
+
+def run(conn, transactions=100000, directory="benchmark_data", seed=0, load=True):
+    """
+    Generate synthetic data, load it and run every benchmark
+    :param conn: a connection to a benchmark database, as from connect_benchmark_database
+    :param transactions: the number of synthetic transactions
+    :param directory: the directory synthetic files are written into
+    :param seed: the random seed
+    :param load: whether to generate and load the data, or reuse what is already loaded
+    :return a dictionary of results
+    """
+    centre = synthetic_areas["CB"][0]
+    results = {"transactions": transactions, "seed": seed}
+    if load:
+        seconds, (pp_file, postcode_file) = timed(write_synthetic_files, directory, transactions, seed=seed)
+        results["generate"] = seconds
+        results.update(benchmark_load(conn, pp_file, postcode_file))
+    results.update(benchmark_inner_join(conn, centre))
+    results.update(benchmark_make_poi_features(conn, centre))
+    results.update(benchmark_prediction(conn, centre, seed=seed))
+    return results
+
+
+# ===== Recording and comparing results =====
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def record(results, path="benchmark_results.jsonl"):
+    """
+    Append results to a JSON lines file, with the current commit and time
+    :param results: a dictionary of results
+    :param path: the file to append to
+    """
+    entry = {"commit": current_commit(), "time": datetime.datetime.now().isoformat(timespec="seconds")}
+    entry.update(results)
+    with open(path, "a") as file:
+        file.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def compare(path="benchmark_results.jsonl", base=None, head=None, display=True):
+    """
+    Compare the latest recorded results of two commits at the same scale
+    :param path: the results file
+    :param base: the base commit, if None the commit before head in the file
+    :param head: the head commit, if None the latest in the file
+    :param display: whether the comparison should be printed
+    :return a DataFrame of base and head timings and their ratio
+    """
+    with open(path) as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    commits = list(dict.fromkeys(entry["commit"] for entry in entries))
+    head = head or commits[-1]
+    if base is None:
+        earlier = commits[:commits.index(head)]
+        if len(earlier) == 0:
+            raise ValueError(f"no results recorded before {head}")
+        base = earlier[-1]
+    head_entry = [entry for entry in entries if entry["commit"] == head][-1]
+    base_entry = [entry for entry in entries if entry["commit"] == base and entry["transactions"] == head_entry["transactions"]][-1]
+    keys = [key for key in head_entry if key in base_entry and isinstance(head_entry[key], float)]
+    df = pd.DataFrame({
+        base: [base_entry[key] for key in keys],
+        head: [head_entry[key] for key in keys]}, index=keys)
+    df["ratio"] = df[head] / df[base]
+    if display:
+        print(df.to_string(float_format=lambda x: f"{x:.4f}"))
+    return df
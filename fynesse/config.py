@@ -1,3 +1,4 @@
+import collections
 import os
 import yaml
 
@@ -5,31 +6,60 @@ default_file = os.path.join(os.path.dirname(__file__), "defaults.yml")
 local_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "machine.yml"))
 user_file = '_config.yml'
 
-config = {}
-
-if os.path.exists(default_file):
-    with open(default_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(local_file):
-    with open(local_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(user_file):
-    with open(user_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if config=={}:
-    raise ValueError(
-        "No configuration file found at either "
-        + user_file
-        + " or "
-        + local_file
-        + " or "
-        + default_file
-        + "."
-    )
-
-for key, item in config.items():
-    if item is str:
-        config[key] = os.path.expandvars(item)
+
+def load_config():
+    """
+    Read the configuration files, later files overriding earlier ones
+    :return a dictionary of configuration values
+    """
+    config = {}
+
+    if os.path.exists(default_file):
+        with open(default_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(local_file):
+        with open(local_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(user_file):
+        with open(user_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if config=={}:
+        raise ValueError(
+            "No configuration file found at either "
+            + user_file
+            + " or "
+            + local_file
+            + " or "
+            + default_file
+            + "."
+        )
+
+    for key, item in config.items():
+        if isinstance(item, str):
+            config[key] = os.path.expandvars(item)
+    return config
+
+
+class Config(collections.UserDict):
+    """
+    The configuration, read from the configuration files when it is first used rather than at import
+    """
+
+    def __init__(self):
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = load_config()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+
+config = Config()
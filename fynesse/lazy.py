@@ -0,0 +1,32 @@
+# This file defers importing heavy dependencies until they are used
+
+"""Plotting, geospatial and modelling libraries take seconds to import between them. Modules bind them with lazy_module instead of import, so a script or worker that only queries the database never loads them."""
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    A stand in for a module that imports it on first attribute access
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # Later lookups find the module's attributes directly, falling back
+        # here only for submodules imported since
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_module(name):
+    """
+    :param name: the full name of a module, such as "matplotlib.pyplot"
+    :return the module if it has already been imported, else a LazyModule that imports it when first used
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
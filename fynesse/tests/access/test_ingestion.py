@@ -0,0 +1,212 @@
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import urllib.error
+
+import pytest
+
+from fynesse import access
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the server's content with an ETag, honouring Range only when If-Range matches
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def headers_for(self, content):
+        self.send_header("ETag", '"' + hashlib.md5(content).hexdigest() + '"')
+        self.send_header("Accept-Ranges", "bytes")
+
+    def do_HEAD(self):
+        content = self.server.content
+        self.send_response(200)
+        self.headers_for(content)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        content = self.server.content
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        requested = self.headers.get("Range")
+        if requested is not None and self.headers.get("If-Range") in (None, etag):
+            start = int(requested[len("bytes="):].split("-")[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.headers_for(content)
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+            self.send_header("Content-Length", str(len(content) - start))
+            self.end_headers()
+            self.wfile.write(content[start:])
+            return
+        self.send_response(200)
+        self.headers_for(content)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    httpd.content = b"version one " * 1000
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/pp-2020.csv"
+
+
+def test_download_resumes_from_part(server):
+    destination = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    access.download(url(server), destination, display=False)
+    with open(destination, "rb") as file:
+        assert file.read() == server.content
+
+    os.replace(destination, destination + ".part")
+    with open(destination + ".part", "r+b") as file:
+        file.truncate(5000)
+    with open(destination + ".part.validator", "w") as file:
+        file.write('"' + hashlib.md5(server.content).hexdigest() + '"')
+    access.download(url(server), destination, display=False)
+    assert server.requests[-1]["Range"] == "bytes=5000-"
+    assert server.requests[-1]["If-Range"] == '"' + hashlib.md5(server.content).hexdigest() + '"'
+    with open(destination, "rb") as file:
+        assert file.read() == server.content
+    assert not os.path.exists(destination + ".part.validator")
+
+
+def test_download_restarts_when_file_is_republished(server):
+    destination = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    with open(destination + ".part", "wb") as file:
+        file.write(server.content[:5000])
+    with open(destination + ".part.validator", "w") as file:
+        file.write('"' + hashlib.md5(server.content).hexdigest() + '"')
+    server.content = b"version two " * 1000
+    access.download(url(server), destination, display=False)
+    with open(destination, "rb") as file:
+        assert file.read() == server.content
+
+
+def test_download_restarts_when_part_is_larger_than_file(server):
+    destination = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    with open(destination + ".part", "wb") as file:
+        file.write(server.content + b"extra")
+    with open(destination + ".part.validator", "w") as file:
+        file.write('"' + hashlib.md5(server.content).hexdigest() + '"')
+    access.download(url(server), destination, display=False)
+    with open(destination, "rb") as file:
+        assert file.read() == server.content
+
+
+def test_download_replaces_partial_destination(server):
+    destination = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    with open(destination, "wb") as file:
+        file.write(server.content[:100])
+    access.download(url(server), destination, display=False)
+    with open(destination, "rb") as file:
+        assert file.read() == server.content
+
+
+def test_download_keeps_destination_offline():
+    destination = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    with open(destination, "wb") as file:
+        file.write(b"local")
+    access.download("http://127.0.0.1:9/pp-2020.csv", destination, display=False)
+    with open(destination, "rb") as file:
+        assert file.read() == b"local"
+
+
+def csv_rows(n, start=0):
+    return "".join(
+        f'"{{{i:08d}-0000-0000-0000-000000000000}}","{100000 + i}","2020-01-01 00:00","CB1 1AA","S","N","F","{i}","","ROAD","","TOWN","DISTRICT","COUNTY","A","A"\n'
+        for i in range(start, start + n))
+
+
+def test_ingest_skips_unchanged_files_without_reading_them(monkeypatch):
+    pytest.importorskip("duckdb")
+    conn = access.connect_duckdb(":memory:")
+    access.create_pricepaid_table(conn)
+    file = os.path.join(tempfile.mkdtemp(), "pp-2020.csv")
+    with open(file, "w") as f:
+        f.write(csv_rows(10))
+    assert access.ingest_file(conn, "pp_data", file, enclosed_by_double_quote=True)
+    assert access.is_ingested(conn, file)
+
+    def unexpected(file):
+        raise AssertionError("an unchanged file was read")
+    monkeypatch.setattr(access, "file_checksum", unexpected)
+    assert not access.ingest_file(conn, "pp_data", file, enclosed_by_double_quote=True)
+    monkeypatch.undo()
+
+    # A touched but identical file is checksummed once and not reloaded
+    os.utime(file, (0, 0))
+    assert not access.is_ingested(conn, file)
+    assert not access.ingest_file(conn, "pp_data", file, enclosed_by_double_quote=True)
+    assert access.is_ingested(conn, file)
+
+    with open(file, "w") as f:
+        f.write(csv_rows(12, start=100))
+    assert access.ingest_file(conn, "pp_data", file, enclosed_by_double_quote=True)
+    assert access.execute(conn, "SELECT COUNT(*), MIN(price) FROM `pp_data`")[0] == (12, 100100)
+
+
+def test_load_pricepaid_data_skips_loaded_files_offline():
+    pytest.importorskip("duckdb")
+    conn = access.connect_duckdb(":memory:")
+    access.create_pricepaid_table(conn)
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "pp-2020.csv"), "w") as f:
+        f.write(csv_rows(10))
+    access.ingest_file(conn, "pp_data", os.path.join(directory, "pp-2020.csv"), enclosed_by_double_quote=True)
+    access.load_pricepaid_data(conn, directory, years=[2020], source_base="http://127.0.0.1:9")
+    assert access.execute(conn, "SELECT COUNT(*) FROM `pp_data`")[0][0] == 10
+    with pytest.raises(urllib.error.URLError):
+        access.load_pricepaid_data(conn, directory, years=[2021], source_base="http://127.0.0.1:9")
+
+
+def test_rolling_back_a_crashed_load_keeps_later_loads(monkeypatch):
+    pytest.importorskip("duckdb")
+    conn = access.connect_duckdb(":memory:")
+    access.create_pricepaid_table(conn)
+    directory = tempfile.mkdtemp()
+    files = {}
+    for i, year in enumerate((2020, 2021, 2022)):
+        files[year] = os.path.join(directory, f"pp-{year}.csv")
+        with open(files[year], "w") as f:
+            f.write(csv_rows(10, start=100 * i))
+    access.ingest_file(conn, "pp_data", files[2020], enclosed_by_double_quote=True)
+
+    # 2021 crashes after loading some of its rows
+    load_file = access.load_file
+
+    def crash(conn, table, file, **kwargs):
+        partial = file + ".partial"
+        with open(partial, "w") as f:
+            f.write(csv_rows(4, start=100))
+        load_file(conn, table, partial, **kwargs)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(access, "load_file", crash)
+    with pytest.raises(KeyboardInterrupt):
+        access.ingest_file(conn, "pp_data", files[2021], enclosed_by_double_quote=True)
+    monkeypatch.undo()
+
+    access.ingest_file(conn, "pp_data", files[2022], enclosed_by_double_quote=True)
+    assert access.ingest_file(conn, "pp_data", files[2021], enclosed_by_double_quote=True)
+    prices = sorted(price for price, in access.execute(conn, "SELECT price FROM `pp_data`"))
+    assert prices == sorted(100000 + i for start in (0, 100, 200) for i in range(start, start + 10))
+    assert all(access.is_ingested(conn, file) for file in files.values())
@@ -0,0 +1,34 @@
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, address, benchmark
+
+
+def test_comparables_match_brute_force():
+    pytest.importorskip("duckdb")
+    directory = tempfile.mkdtemp()
+    conn = access.connect_duckdb(":memory:")
+    pp_file, postcode_file = benchmark.write_synthetic_files(directory, 20000, seed=3)
+    benchmark.benchmark_load(conn, pp_file, postcode_file)
+    address.create_comparables_snapshot(conn, f"{directory}/comparables", chunk_size=7000)
+    index = address.ComparablesIndex(f"{directory}/comparables")
+
+    sales = pd.DataFrame(access.execute(conn, """
+    SELECT date_of_transfer, lattitude, longitude, property_type
+    FROM `pp_data` INNER JOIN `postcode_data` ON `pp_data`.postcode_key = `postcode_data`.postcode_key"""),
+        columns=["date", "latitude", "longitude", "property_type"])
+    sales["date"] = pd.to_datetime(sales.date)
+    sales[["latitude", "longitude"]] = sales[["latitude", "longitude"]].astype(float)
+
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        sale = sales.iloc[rng.integers(len(sales))]
+        latitude, longitude = sale.latitude + 0.01, sale.longitude
+        found = index.comparables(latitude, longitude, sale.date, sale.property_type, k=8, window_days=400)
+        window = sales[(sales.property_type == sale.property_type) & (sales.date <= sale.date) & (sales.date >= sale.date - pd.Timedelta(days=400))]
+        chord = np.linalg.norm(address.unit_sphere(window.latitude, window.longitude) - address.unit_sphere([latitude], [longitude]), axis=1)
+        expected = np.sort(2 * address.earth_radius_km * np.arcsin(chord / 2))[:8]
+        assert np.allclose(np.sort(found.distance_km.to_numpy()), expected)
@@ -0,0 +1,25 @@
+import numpy as np
+
+from fynesse import address
+
+
+def regression(n=300, p=5, seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.column_stack((np.ones(n), rng.normal(size=(n, p - 1))))
+    y = X @ rng.normal(size=p) + rng.normal(size=n)
+    return y, X
+
+
+def test_downdated_ols_matches_fitting_each_fold():
+    y, X = regression()
+    downdated = address.cross_validate(y, X, n_splits=5)
+    fitted = address.cross_validate(y, X, n_splits=5, train=address.train_model, processes=1)
+    assert np.allclose(downdated, fitted)
+
+
+def test_downdated_ols_matches_fitting_each_fold_when_rank_deficient():
+    y, X = regression(seed=1)
+    X = np.column_stack((X, X[:, 1] + X[:, 2]))
+    downdated = address.cross_validate(y, X, n_splits=4)
+    fitted = address.cross_validate(y, X, n_splits=4, train=address.train_model, processes=1)
+    assert np.allclose(downdated, fitted)
@@ -0,0 +1,20 @@
+import pandas as pd
+import pytest
+
+from fynesse import address
+
+
+def test_query_transactions_geometry_is_longitude_latitude():
+    targets = pd.DataFrame({"latitude": [51.52], "longitude": [-0.05], "date": ["2020-01-01"], "property_type": ["F"]})
+    queries = address.query_transactions(targets, 10)
+    point = queries.geometry.iloc[0]
+    assert (point.x, point.y) == (-0.05, 51.52)
+    assert list(queries.index) == [10]
+
+
+def test_predict_prices_requires_a_connection():
+    targets = pd.DataFrame({"latitude": [51.52], "longitude": [-0.05], "date": ["2020-01-01"], "property_type": ["F"]})
+    with pytest.raises(ValueError, match="conn and connection_args"):
+        address.predict_prices(targets, {}, {}, None)
+    with pytest.raises(ValueError, match="connection_args"):
+        address.predict_prices(targets, {}, {}, None, conn=object(), processes=2)
@@ -0,0 +1,41 @@
+import csv
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, address, benchmark
+
+
+def test_repeat_sales_index_recovers_national_index():
+    pytest.importorskip("duckdb")
+    directory = tempfile.mkdtemp()
+    conn = access.connect_duckdb(":memory:")
+    _, postcode_file = benchmark.write_synthetic_files(directory, 1000, seed=1)
+    access.create_pricepaid_table(conn)
+    access.create_postcode_table(conn)
+    access.load_file(conn, "postcode_data", postcode_file)
+    postcodes = access.execute(conn, "SELECT postcode FROM `postcode_data`")
+
+    # Properties resold at random months of a known index, with noise
+    rng = np.random.default_rng(0)
+    months = 120
+    index = np.cumsum(np.r_[0, rng.normal(0.004, 0.01, months - 1)])
+    rows = []
+    for i in range(20000):
+        postcode = postcodes[rng.integers(len(postcodes))][0]
+        level = rng.normal(12, 0.5)
+        for month in np.sort(rng.choice(months, rng.integers(1, 4), replace=False)):
+            date = pd.Timestamp("1995-01-01") + pd.DateOffset(months=int(month)) + pd.Timedelta(days=int(rng.integers(28)))
+            price = int(np.exp(level + index[month] + rng.normal(0, 0.05)))
+            rows.append(("{x}", price, date.strftime("%Y-%m-%d 00:00"), postcode, "DSTF"[i % 4], "N", "F", str(i), "", f"ROAD {i % 50}", "", "TOWN", "DISTRICT", "COUNTY", "A", "A"))
+    pp_file = os.path.join(directory, "repeat_sales.csv")
+    with open(pp_file, "w", newline="") as file:
+        csv.writer(file, quoting=csv.QUOTE_ALL).writerows(rows)
+    access.load_file(conn, "pp_data", pp_file, enclosed_by_double_quote=True)
+
+    fitted = address.fit_repeat_sales_index(conn, region_km=100, smoothing=1.0, shrinkage=5.0)
+    national = fitted.loc["national"].to_numpy()[:months]
+    assert np.sqrt(np.mean((national - index) ** 2)) < 0.02
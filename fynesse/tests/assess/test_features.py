@@ -0,0 +1,76 @@
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pytest
+
+from fynesse import assess
+
+bbox = (52.0, 52.3, 0.0, 0.45)
+
+
+def random_points(n, seed, north=52.3, south=52.0, east=0.45, west=0.0):
+    rng = np.random.default_rng(seed)
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(
+        rng.uniform(west, east, n), rng.uniform(south, north, n), crs="EPSG:4326"))
+
+
+def test_store_requires_snapshot():
+    transactions = random_points(10, 0)
+    transactions["postcode"] = [f"P{i}" for i in range(10)]
+    store = assess.FeatureStore(tempfile.mkdtemp())
+    with pytest.raises(ValueError):
+        assess.make_poi_features(bbox, transactions, {"a": {"amenity": True}}, [("closest", "a")], store=store, pois={"a": random_points(5, 1)})
+
+
+def test_store_features_are_keyed_by_snapshot():
+    transactions = random_points(10, 0)
+    transactions["postcode"] = [f"P{i}" for i in range(10)]
+    store = assess.FeatureStore(tempfile.mkdtemp())
+    tagsets = {"a": {"amenity": True}}
+    first = assess.make_poi_features(bbox, transactions, tagsets, [("closest", "a")], store=store, snapshot="1", pois={"a": random_points(5, 1)})
+    second = assess.make_poi_features(bbox, transactions, tagsets, [("closest", "a")], store=store, snapshot="2", pois={"a": random_points(5, 2)})
+    assert not np.array_equal(first.values, second.values)
+    assert np.all(np.isnan(store.get(["P0"], tagsets["a"], "closest", "3")))
+
+
+def test_stored_features_do_not_depend_on_the_collection_bbox():
+    transactions = random_points(500, 8, north=52.2, south=52.1, east=0.3, west=0.15)
+    transactions["postcode"] = [f"P{i}" for i in range(500)]
+    pois = random_points(300, 9)
+    tagsets = {"a": {"amenity": True}}
+    to_make = [("closest", "a"), (("count", 1000), "a"), (("count", 3000), "a")]
+    # Pois collected from a bbox barely containing the transactions first
+    small = (52.1, 52.2, 0.15, 0.3)
+    inside = pois.cx[small[2]:small[3], small[0]:small[1]]
+    store = assess.FeatureStore(tempfile.mkdtemp())
+    assess.make_poi_features(small, transactions, tagsets, to_make, max_dist=20000, store=store, snapshot="1", pois={"a": inside})
+    reused = assess.make_poi_features(bbox, transactions, tagsets, to_make, max_dist=20000, store=store, snapshot="1", pois={"a": pois})
+    fresh = assess.make_poi_features(bbox, transactions, tagsets, to_make, max_dist=20000, pois={"a": pois})
+    assert reused.equals(fresh)
+
+
+def test_sharded_features_match_serial():
+    transactions = random_points(3000, 3)
+    transactions["postcode"] = [f"P{i % 2000}" for i in range(3000)]
+    # A tagset with pois in one corner, so most tiles have none within their halo
+    pois = {"dense": random_points(2000, 4), "sparse": random_points(3, 5), "corner": random_points(40, 6, north=52.05, east=0.05)}
+    tagsets = {tagset: {"amenity": tagset} for tagset in pois}
+    to_make = [(metric, tagset) for tagset in pois for metric in ("closest", ("count", 300), ("count", 1500))]
+    serial = assess.make_poi_features(bbox, transactions, tagsets, to_make, max_dist=2000, pois=dict(pois))
+    sharded = assess.make_poi_features(bbox, transactions, tagsets, to_make, max_dist=2000, pois=dict(pois), processes=2, tile_km=1)
+    assert serial.equals(sharded)
+
+
+def test_sharded_distances_fall_back_beyond_halo():
+    rng = np.random.default_rng(7)
+    points = rng.uniform(0, 20000, (500, 2))
+    corner = rng.uniform(0, 1000, (20, 2))
+    needed = np.ones(len(points), dtype=bool)
+    needed[::3] = False
+    sharded = assess.sharded_k_smallest_distances(points, {"corner": (needed, corner)}, halo=500, processes=2, tile_m=1000, k=5)["corner"]
+    serial = assess.k_smallest_distances(points[needed], corner, k=5)
+    assert np.any(serial[:, 0] > 500)
+    assert np.array_equal(sharded[:, 0], serial[:, 0])
+    within = serial <= 500
+    assert np.array_equal(sharded[within], serial[within])
@@ -0,0 +1,47 @@
+import tempfile
+
+import numpy as np
+import pytest
+
+from fynesse import access, assess, benchmark
+
+
+@pytest.fixture(scope="module")
+def conn():
+    pytest.importorskip("duckdb")
+    conn = access.connect_duckdb(":memory:")
+    pp_file, postcode_file = benchmark.write_synthetic_files(tempfile.mkdtemp(), 2000, seed=1)
+    benchmark.benchmark_load(conn, pp_file, postcode_file)
+    return conn
+
+
+def test_group_count_by_year(conn):
+    expected = access.execute(conn, "SELECT YEAR(date_of_transfer), COUNT(*) FROM `pp_data` GROUP BY YEAR(date_of_transfer)")
+    assert sorted(assess.group_count(conn, "pp_data", "YEAR(date_of_transfer)")) == sorted(expected)
+    assert sorted(assess.group_count(conn, "pp_data", "year")) == sorted(expected)
+    assert sum(count for _, _, count in assess.group_count(conn, "pp_data", "YEAR(date_of_transfer), property_type")) == 2000
+
+
+def test_group_count_by_columns(conn):
+    assert sorted(assess.group_count(conn, "pp_data", "property_type, tenure_type")) == sorted(assess.group_count(conn, "pp_data", ("property_type", "tenure_type")))
+
+
+def test_summaries_reject_other_expressions(conn):
+    with pytest.raises(ValueError):
+        assess.group_count(conn, "pp_data", "1; DROP TABLE pp_data")
+    with pytest.raises(ValueError):
+        assess.numcol_summary(conn, "pp_data", "SLEEP(10)")
+    assert assess.numcol_summary(conn, "pp_data", "log_price")["max"] > 0
+
+
+def test_logprice_histograms_count_every_filtered_price(conn):
+    centre = benchmark.synthetic_areas["CB"][0]
+    filters = {"bbox": (centre[0] - 0.2, centre[0] + 0.2, centre[1] - 0.3, centre[1] + 0.3), "date_bound": ("2000-01-01", "2015-12-31")}
+    transactions = access.inner_join(conn, **filters)
+    histograms = assess.logprice_histograms_sql(conn, **filters)
+    assert histograms["all"].sum() == len(transactions) > 0
+    expected = assess.grouped_histograms(
+        np.log(transactions.price.to_numpy(dtype=float)), transactions.property_type, access.property_types, histograms["edges"])
+    for name in ["all"] + access.property_types:
+        assert np.array_equal(histograms[name], expected[name])
+    assert assess.logprice_histograms_sql(conn)["all"].sum() == 2000
@@ -0,0 +1,244 @@
+# This file contains instrumentation for finding where time goes across access, assess and address
+
+"""Record timed spans around database queries, open street maps fetches, feature stages and model fits. Tracing is off by default and can be switched on and off at runtime; when off, a span costs a single flag check. Functions run in pool workers are wrapped in Remote so the spans they record come back with their results and are merged into this process's spans."""
+
+import collections
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+enabled = bool(os.environ.get("FYNESSE_TRACE"))
+spans = []
+# Spans beyond max_spans are counted in dropped rather than recorded, until
+# they are cleared or flushed
+max_spans = int(os.environ.get("FYNESSE_TRACE_MAX_SPANS", 1000000))
+dropped = 0
+
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+class NullSpan:
+    """
+    The span returned while tracing is disabled, which records nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Span:
+    """
+    A timed region of work with a name and attributes, recorded when it exits
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.id = next(_ids)
+        self.parent = stack[-1].id if len(stack) > 0 else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        if exc_type is not None:
+            self.attrs["error"] = repr(exc)
+        record({
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "attrs": self.attrs})
+        return False
+
+    def set(self, **attrs):
+        """
+        Add attributes known only once work has started, such as a row count
+        """
+        self.attrs.update(attrs)
+
+
+def record(s):
+    """
+    Record a finished span, unless max_spans are already recorded
+    :param s: the span as a dictionary
+    """
+    global dropped
+    if len(spans) < max_spans:
+        spans.append(s)
+    else:
+        dropped += 1
+
+
+def span(name, **attrs):
+    """
+    Time a region of work, as a context manager
+    :param name: the name of the span, such as "sql" or "osm.collect_pois"
+    :param **attrs: attributes to record with the span
+    :return a Span, or null_span if tracing is disabled
+    """
+    if not enabled:
+        return null_span
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    """
+    Decorate a function so each call is recorded as a span
+    :param name: the name of the span, if None the function's qualified name
+    """
+    def decorator(function):
+        span_name = name or f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Remote:
+    """
+    A picklable wrapper of a function run in another process, such as a pool worker, returning the spans recorded by each call along with its result so they can be merged into this process's spans
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.enabled = enabled
+
+    def __call__(self, *args, **kwargs):
+        global enabled
+        if not self.enabled:
+            return self.function(*args, **kwargs), []
+        enabled = True
+        start = len(spans)
+        try:
+            result = self.function(*args, **kwargs)
+        finally:
+            recorded = spans[start:]
+            del spans[start:]
+        return result, recorded
+
+
+def merge(output):
+    """
+    Record the spans returned by a Remote call under the current span, giving them ids of this process
+    :param output: the (result, spans) pair returned by a Remote call
+    :return the result
+    """
+    result, recorded = output
+    stack = getattr(_local, "stack", None)
+    parent = stack[-1].id if stack else None
+    ids = {s["id"]: next(_ids) for s in recorded}
+    for s in recorded:
+        record(dict(s, id=ids[s["id"]], parent=ids.get(s["parent"], parent)))
+    return result
+
+
+def enable(clear_spans=True):
+    """
+    Start recording spans
+    :param clear_spans: whether previously recorded spans should be discarded
+    """
+    global enabled
+    if clear_spans:
+        clear()
+    enabled = True
+
+
+def disable():
+    """
+    Stop recording spans, keeping those already recorded
+    """
+    global enabled
+    enabled = False
+
+
+def clear():
+    global dropped
+    del spans[:]
+    dropped = 0
+
+
+def flush(path):
+    """
+    Append recorded spans to a jsonl file and clear them, so long traced runs stay within max_spans
+    :param path: the file to append to
+    """
+    with open(path, "a") as file:
+        for s in spans:
+            file.write(json.dumps(s, default=str) + "\n")
+    clear()
+
+
+def export(path, format=None):
+    """
+    Write recorded spans to a file
+    :param path: the file to write
+    :param format: "chrome" for the Chrome trace event format (viewable in chrome://tracing or Perfetto) or "jsonl" for one JSON span per line. If None, .jsonl files are written as jsonl and others as chrome
+    """
+    if format is None:
+        format = "jsonl" if path.endswith(".jsonl") else "chrome"
+    with open(path, "w") as file:
+        if format == "jsonl":
+            for s in spans:
+                file.write(json.dumps(s, default=str) + "\n")
+        elif format == "chrome":
+            origin = min((s["start"] for s in spans), default=0)
+            events = [{
+                "name": s["name"],
+                "cat": s["name"].split(".")[0],
+                "ph": "X",
+                "ts": (s["start"] - origin) * 1e6,
+                "dur": s["duration"] * 1e6,
+                "pid": s["pid"],
+                "tid": s["tid"],
+                "args": s["attrs"]} for s in spans]
+            json.dump({"traceEvents": events}, file, default=str)
+        else:
+            raise ValueError("format should be 'chrome' or 'jsonl'")
+
+
+def summary(display=True):
+    """
+    Total the recorded time by span name
+    :param display: whether the totals should be printed
+    :return a dictionary mapping each name to a (count, total seconds) tuple, slowest first
+    """
+    totals = collections.defaultdict(lambda: [0, 0.0])
+    for s in spans:
+        totals[s["name"]][0] += 1
+        totals[s["name"]][1] += s["duration"]
+    totals = dict(sorted(((name, tuple(total)) for name, total in totals.items()), key=lambda item: -item[1][1]))
+    if display:
+        for name, (count, seconds) in totals.items():
+            print(f"{name}: {count} spans, {seconds:.3f}s")
+        if dropped > 0:
+            print(f"{dropped} spans dropped beyond max_spans")
+    return totals